@@ -1257,6 +1257,10 @@ def set_backend_weight(x, k, v):
     x.backend_weight = int(v)
 
 
+def set_server_slots(x, k, v):
+    x.server_slots = int(v)
+
+
 def set_mode(x, k, v):
     x.mode = v.lower()
 
@@ -1565,6 +1569,17 @@ HAPROXY_0_BACKEND_HEALTHCHECK_PORT_INDEX=1 will make it so that the port 9001
 is used to perform the backend healthchecks.
                     ''',
                     ))
+labels.append(Label(name='BACKEND_SERVER_SLOTS',
+                    func=set_server_slots,
+                    description='''\
+Emit the backend with a pool of server slots, so that tasks can be added
+and removed through the runtime API without reloading HAProxy (see
+`--runtime-api`). The pool is sized to the next power of two which fits
+both this number and the number of tasks, and unused slots are disabled.
+Overrides `--server-slots`; 0 disables server slots for the backend.
+
+Ex: `HAPROXY_0_BACKEND_SERVER_SLOTS = 8`
+                    '''))
 labels.append(Label(name='FRONTEND_HEAD',
                     func=set_label,
                     description=''))
@@ -1690,3 +1705,16 @@ for label in labels:
     if not label.func:
         continue
     label_keys[label.full_name] = label.func
+
+# The labels in label_keys by their full name, for the labels of the app, or
+# by the name after HAPROXY_{n}_, for the labels of each service port. The
+# labels are applied in the order of label_keys, which is kept along with
+# the full name and the setter.
+app_label_setters = {}
+port_label_setters = {}
+for position, (full_name, func) in enumerate(label_keys.items()):
+    if full_name.startswith('HAPROXY_{0}_'):
+        name = full_name[len('HAPROXY_{0}_'):]
+        port_label_setters[name] = (position, full_name, func)
+    else:
+        app_label_setters[full_name] = (position, full_name, func)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+"""
+Structured comparison of the running HAProxy config (and maps) with a newly
+generated one.
+
+Both configs are split into their sections and the servers of each backend,
+so that we can tell what actually changed and pick the cheapest way of
+applying the change:
+
+- nothing, if the configs and maps are equivalent
+- a map update through the runtime API, if only map entries changed
+- a runtime API update, if only the address, port, weight or state of
+  existing servers (and possibly map entries) changed
+- a reload, for everything else
+"""
+
+import ipaddress
+from collections import OrderedDict
+
+ACTION_NONE = 'none'
+ACTION_MAPS = 'maps'
+ACTION_RUNTIME = 'runtime'
+ACTION_RELOAD = 'reload'
+
+SECTION_KEYWORDS = frozenset([
+    'global', 'defaults', 'frontend', 'backend', 'listen', 'userlist',
+    'peers', 'resolvers', 'mailers', 'cache'])
+
+
+class ServerLine(object):
+    """
+    A `server` line of a backend, split into the parts which can be changed
+    through the runtime API and the parts which can't.
+    """
+
+    def __init__(self, backend, name, ip, port, weight, disabled, options):
+        self.backend = backend
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.weight = weight
+        self.disabled = disabled
+        self.options = options
+
+    @classmethod
+    def parse(cls, backend, words):
+        """
+        Parse the words of a server line. Returns None for servers whose
+        address can't be changed at runtime (e.g. host names or mapped
+        ports).
+        """
+        if len(words) < 3:
+            return None
+        ip, sep, port = words[2].rpartition(':')
+        if not sep or not port.isdigit():
+            return None
+        ip = ip.strip('[]')
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        weight = None
+        disabled = False
+        options = []
+        params = iter(words[3:])
+        for param in params:
+            if param == 'disabled':
+                disabled = True
+            elif param == 'weight':
+                weight = next(params, None)
+            else:
+                options.append(param)
+        return cls(backend, words[1], ip, int(port), weight, disabled,
+                   tuple(options))
+
+    @property
+    def target(self):
+        return '{0}/{1}'.format(self.backend, self.name)
+
+    def skeleton(self):
+        return ('server', self.name) + self.options
+
+    def commands_to(self, new):
+        """
+        Return the runtime API commands turning this server into `new`.
+        """
+        commands = []
+        if new.disabled and not self.disabled:
+            commands.append('set server {0} state maint'.format(self.target))
+        if (new.ip, new.port) != (self.ip, self.port):
+            commands.append('set server {0} addr {1} port {2}'.format(
+                self.target, new.ip, new.port))
+        if new.weight != self.weight:
+            commands.append('set weight {0} {1}'.format(
+                self.target, new.weight or 1))
+        if self.disabled and not new.disabled:
+            commands.append('set server {0} state ready'.format(self.target))
+        return commands
+
+
+class Section(object):
+    """
+    A section of the config. `lines` holds every line of the section except
+    the runtime changeable parts of its server lines, which are parsed into
+    `servers`.
+    """
+
+    def __init__(self, keyword, name):
+        self.keyword = keyword
+        self.name = name
+        self.lines = []
+        self.servers = OrderedDict()
+
+    def __str__(self):
+        if self.name is None:
+            return self.keyword or '(preamble)'
+        return '{0} {1}'.format(self.keyword, self.name)
+
+    def options(self):
+        """
+        The lines of the section other than its server lines.
+        """
+        return [line for line in self.lines if not isinstance(line, tuple)]
+
+
+def parse_config(config):
+    """
+    Split a config into an ordered dict of its sections, keyed by keyword,
+    name and the number of previous sections with the same keyword and name.
+    Lines before the first section are kept in a section without keyword.
+    """
+    sections = OrderedDict()
+    section = Section(None, None)
+    sections[(None, None, 0)] = section
+    for line in config.splitlines():
+        words = line.split()
+        if words and not line[0].isspace() and words[0] in SECTION_KEYWORDS:
+            name = words[1] if len(words) > 1 else None
+            section = Section(words[0], name)
+            key = (words[0], name, 0)
+            while key in sections:
+                key = (key[0], key[1], key[2] + 1)
+            sections[key] = section
+        elif section.keyword in ('backend', 'listen') and \
+                words and words[0] == 'server':
+            server = ServerLine.parse(section.name, words)
+            if server is not None:
+                section.lines.append(server.skeleton())
+                section.servers[server.name] = server
+                continue
+        section.lines.append(line)
+    return sections
+
+
+def parse_map(map_string):
+    """
+    Parse the entries of a map file into a list of (key, value) pairs.
+    """
+    entries = []
+    for line in map_string.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        key, _, value = line.partition(' ')
+        entries.append((key, value.strip()))
+    return entries
+
+
+class MapDiff(object):
+    """
+    The difference between the running and the new contents of a map file.
+    """
+
+    def __init__(self, path, running_map, new_map):
+        self.path = path
+        self.changed = running_map != new_map
+        running = parse_map(running_map)
+        new = parse_map(new_map)
+        running_values = OrderedDict(running)
+        new_values = OrderedDict(new)
+
+        self.added = [(key, value) for key, value in new_values.items()
+                      if key not in running_values]
+        self.removed = [key for key in running_values
+                        if key not in new_values]
+        self.updated = [(key, value) for key, value in new_values.items()
+                        if key in running_values and
+                        running_values[key] != value]
+
+        # Entries deleted at runtime disappear and added ones are appended,
+        # which only gives the same map (where the first match wins) as
+        # loading the new file if the remaining entries keep their order
+        # and the new ones come last.
+        expected_order = [key for key in running_values
+                          if key in new_values] + \
+            [key for key, _ in self.added]
+        self.runtime = (len(running_values) == len(running) and
+                        len(new_values) == len(new) and
+                        list(new_values) == expected_order)
+
+    def commands(self):
+        commands = ['del map {0} {1}'.format(self.path, key)
+                    for key in self.removed]
+        commands.extend('set map {0} {1} {2}'.format(self.path, key, value)
+                        for key, value in self.updated)
+        commands.extend('add map {0} {1} {2}'.format(self.path, key, value)
+                        for key, value in self.added)
+        return commands
+
+
+class ConfigDiff(object):
+    """
+    The difference between the running config and maps and the new ones.
+
+    :param running_maps: A dict of map file path to the running contents.
+    :param new_maps: A dict of map file path to the new contents.
+    """
+
+    def __init__(self, running_config, new_config, running_maps=None,
+                 new_maps=None):
+        running_maps = running_maps or {}
+        new_maps = new_maps or {}
+        self.config_changed = running_config != new_config
+        running = parse_config(running_config)
+        new = parse_config(new_config)
+
+        self.added_sections = [str(new[key]) for key in new
+                               if key not in running]
+        self.removed_sections = [str(running[key]) for key in running
+                                 if key not in new]
+        self.changed_sections = []
+        self.added_servers = []
+        self.removed_servers = []
+        self.changed_servers = []
+        self.updated_servers = []
+        self.enabled_servers = []
+        self.structural = list(running) != list(new)
+        for key in new:
+            if key not in running:
+                continue
+            old_section = running[key]
+            new_section = new[key]
+            if old_section.lines != new_section.lines:
+                self.structural = True
+            if old_section.options() != new_section.options():
+                self.changed_sections.append(str(new_section))
+            self._diff_servers(old_section.servers, new_section.servers)
+
+        self.maps = [MapDiff(path, running_maps.get(path, ''),
+                             new_maps.get(path, ''))
+                     for path in sorted(set(running_maps) | set(new_maps))]
+
+    def _diff_servers(self, running, new):
+        for name, server in running.items():
+            if name not in new:
+                self.removed_servers.append(server.target)
+        for name, server in new.items():
+            old = running.get(name)
+            if old is None:
+                self.added_servers.append(server.target)
+                continue
+            if old.skeleton() != server.skeleton():
+                self.changed_servers.append(server.target)
+            elif old.commands_to(server):
+                self.updated_servers.append((old, server))
+            if old.disabled and not server.disabled:
+                self.enabled_servers.append(old)
+
+    @property
+    def changed(self):
+        """
+        Whether the config or any of the maps differ at all.
+        """
+        return self.config_changed or any(m.changed for m in self.maps)
+
+    @property
+    def action(self):
+        """
+        The cheapest way of applying the new config and maps to HAProxy.
+        """
+        if self.structural or not all(m.runtime for m in self.maps):
+            return ACTION_RELOAD
+        if self.updated_servers:
+            return ACTION_RUNTIME
+        if any(m.commands() for m in self.maps):
+            return ACTION_MAPS
+        return ACTION_NONE
+
+    def commands(self):
+        """
+        The runtime API commands applying the new config and maps, when the
+        action isn't a reload. Servers are updated before the maps, so that
+        map entries never point to servers which aren't ready.
+        """
+        commands = []
+        for old, new in self.updated_servers:
+            commands.extend(old.commands_to(new))
+        for map_diff in self.maps:
+            commands.extend(map_diff.commands())
+        return commands
+
+    def server_enables(self):
+        """
+        The commands enabling the servers which are disabled in the running
+        config and enabled in the new one.
+
+        Servers we put into maintenance through the runtime API stay in
+        forced maintenance across a reload (through the server state file)
+        unless they are enabled at runtime before reloading.
+        """
+        return ['set server {0} state ready'.format(server.target)
+                for server in self.enabled_servers]
+
+    def summary(self):
+        """
+        A one line description of what changed, for the logs.
+        """
+        parts = []
+        for label, items in [('added', self.added_sections),
+                             ('removed', self.removed_sections),
+                             ('changed', self.changed_sections)]:
+            if items:
+                parts.append('{0} {1}'.format(label, ', '.join(items)))
+        for label, items in [('added', self.added_servers),
+                             ('removed', self.removed_servers),
+                             ('changed', self.changed_servers),
+                             ('updated', self.updated_servers)]:
+            if items:
+                parts.append('{0} servers {1}'.format(len(items), label))
+        for map_diff in self.maps:
+            counts = [(len(map_diff.added), 'added'),
+                      (len(map_diff.removed), 'removed'),
+                      (len(map_diff.updated), 'updated')]
+            parts.extend('{0} {1} entries {2}'.format(
+                count, map_diff.path, label) for count, label in counts
+                if count)
+        return '; '.join(parts) or 'no effective changes'
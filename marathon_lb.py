@@ -18,6 +18,7 @@ Marathon-lb just needs to know where to find Marathon.
 ### Command Line Usage
 """
 import argparse
+import bisect
 import hashlib
 import json
 import logging
@@ -38,24 +39,71 @@ from collections import defaultdict
 from operator import attrgetter
 from shutil import move, copy
 from tempfile import mkstemp
+from urllib.parse import urlparse
 
 import dateutil.parser
 import requests
 import pycurl
+from urllib3.util.retry import Retry
 
 from common import (get_marathon_auth_params, set_logging_args,
                     set_marathon_auth_args, setup_logging, cleanup_json)
-from config import ConfigTemplater, label_keys
+from config import app_label_setters, ConfigTemplater, port_label_setters
+from config_diff import ACTION_NONE, ACTION_RELOAD, ConfigDiff, parse_config
 from lrucache import LRUCache
-from utils import (CurlHttpEventStream, get_task_ip_and_ports, ip_cache,
-                   ServicePortAssigner)
+from runtime_api import (apply_commands, get_stats_socket,
+                         get_stats_socket_level, RuntimeApi,
+                         RuntimeApiError)
+from utils import (compact_app, CurlHttpEventStream, drop_null_values,
+                   FragmentCache, get_task_ip_and_ports, HaproxyMap,
+                   Histogram, ip_cache, iter_json_array, ServerSlotAssigner,
+                   ServicePortAssigner, UNUSED_SLOT_IP)
 
 
 logger = logging.getLogger('marathon_lb')
 SERVICE_PORT_ASSIGNER = ServicePortAssigner()
+SERVER_SLOT_ASSIGNER = ServerSlotAssigner()
+# The fields of the tasks which make up the fingerprint of the apps, beside
+# whether their health checks passed
+FINGERPRINT_TASK_FIELDS = ('id', 'host', 'ports', 'ipAddresses', 'state')
+# How long reloads took until the new haproxy process was running, in seconds
+RELOAD_DURATIONS = Histogram([0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60])
+# The ids and versions of the apps make_config_valid_and_regenerate() last
+# excluded from the config
+INVALID_APP_VERSIONS = set()
+# The frontend and backend sections of the services in the last config
+CONFIG_FRAGMENTS = FragmentCache()
+# Whether haproxy accepted a config, by getValidationKey()
+VALIDATION_CACHE = LRUCache(128)
+# The paths of the files (or directories) haproxy loads when checking a
+# config: certificates, error files, lua scripts and ACL pattern files
+CONFIG_FILE_PATTERN = re.compile(
+    r'(?:^|\s)(?:crt|crt-list|ca-file|crl-file|lua-load|errorfile\s+\d+|-f)'
+    r'\s+([^\s,]+)')
+
+# Events which only concern the tasks of an app, and which can be dropped
+# without decoding them if the app isn't served.
+TASK_EVENT_TYPES = frozenset(['status_update_event',
+                              'health_status_changed_event'])
+EVENT_TYPE_PATTERN = re.compile(r'"eventType"\s*:\s*"([^"]*)"')
+EVENT_APP_ID_PATTERN = re.compile(r'"appId"\s*:\s*"([^"]*)"')
+PORT_GROUP_LABEL_PATTERN = re.compile(r'^HAPROXY_\d+_GROUP$')
+PORT_LABEL_PATTERN = re.compile(r'^HAPROXY_(0|[1-9]\d*)_(.+)$')
+# The setters of the labels of the apps in the last get_apps(), by labels
+LABEL_SETTERS = {}
+
+# The ISO 8601 timestamps Marathon and zdd.py write, which are parsed
+# without dateutil. The parsed timestamps are kept by their text, as they
+# only change with the version of an app.
+TIMESTAMP_PATTERN = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})'
+    r'(?:\.(\d{1,6})\d*)?(?:(Z)|([+-])(\d{2})(?::?(\d{2}))?)?$')
+PARSED_TIMESTAMPS = LRUCache(1024)
 
 
 class MarathonBackend(object):
+    # There is one per task and service port, so they're kept small.
+    __slots__ = ('host', 'ip', 'port', 'draining')
 
     def __init__(self, host, ip, port, draining):
         self.host = host
@@ -90,11 +138,21 @@ class MarathonBackend(object):
 
 
 class MarathonService(object):
+    __slots__ = ('appId', 'servicePort', 'backends', '__backend_keys',
+                 'hostname', 'proxypath', 'revproxypath', 'redirpath',
+                 'haproxy_groups', 'path', 'authRealm', 'authUser',
+                 'authPasswd', 'sticky', 'enabled', 'redirectHttpToHttps',
+                 'useHsts', 'sslCert', 'bindOptions', 'bindAddr', 'groups',
+                 'mode', 'balance', 'healthCheck', 'labels', 'backend_weight',
+                 'network_allowed', 'healthcheck_port_index', 'server_slots')
 
     def __init__(self, appId, servicePort, healthCheck, strictMode):
         self.appId = appId
         self.servicePort = servicePort
-        self.backends = set()
+        # The backends are kept sorted by host and port, in the order they
+        # were added for the same host and port.
+        self.backends = []
+        self.__backend_keys = []
         self.hostname = None
         self.proxypath = None
         self.revproxypath = None
@@ -119,12 +177,21 @@ class MarathonService(object):
         self.backend_weight = 0
         self.network_allowed = None
         self.healthcheck_port_index = None
+        self.server_slots = None
         if healthCheck:
             if healthCheck['protocol'] == 'HTTP':
                 self.mode = 'http'
 
     def add_backend(self, host, ip, port, draining):
-        self.backends.add(MarathonBackend(host, ip, port, draining))
+        key = (host, port)
+        idx = bisect.bisect_right(self.__backend_keys, key)
+        self.__backend_keys.insert(idx, key)
+        self.backends.insert(idx, MarathonBackend(host, ip, port, draining))
+
+    def settings(self):
+        # The attributes of the service, other than its backends
+        return [(name, getattr(self, name)) for name in self.__slots__
+                if name != 'backends' and not name.startswith('__')]
 
     def __hash__(self):
         return hash(self.servicePort)
@@ -137,6 +204,7 @@ class MarathonService(object):
 
 
 class MarathonApp(object):
+    __slots__ = ('app', 'groups', 'appId', 'services')
 
     def __init__(self, marathon, appId, app):
         self.app = app
@@ -154,7 +222,13 @@ class MarathonApp(object):
 
 
 class Marathon(object):
-    def __init__(self, hosts, health_check, strict_mode, auth, ca_cert=None):
+    # A host which fails to respond is tried last for this many seconds,
+    # doubling with each consecutive failure up to the maximum.
+    HOST_BACKOFF_SECONDS = 2
+    MAX_HOST_BACKOFF_SECONDS = 60
+
+    def __init__(self, hosts, health_check, strict_mode, auth, ca_cert=None,
+                 pool_size=10, retries=3, compact_apps=False):
         # TODO(cmaloney): Support getting master list from zookeeper
         self.__hosts = hosts
         self.__health_check = health_check
@@ -164,31 +238,139 @@ class Marathon(object):
         self.__verify = False
         if ca_cert:
             self.__verify = ca_cert
+        self.__session = self.__create_session(pool_size, retries)
+        self.__compact_apps = compact_apps
+        self.__current_host = None
+        self.__host_failures = {}
+        self.__host_dead_until = {}
+
+    def __create_session(self, pool_size, retries):
+        # Keep the connections to Marathon alive between requests, so that
+        # fetching the apps doesn't pay for a TCP and TLS handshake each
+        # time. Idempotent requests are retried with a backoff on the
+        # responses Marathon sends while it is failing over. Connection and
+        # read errors aren't retried, so that api_req_raw() moves on to the
+        # next host right away.
+        retry = Retry(total=retries,
+                      connect=0,
+                      read=0,
+                      backoff_factor=0.2,
+                      status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=len(self.__hosts),
+            pool_maxsize=pool_size,
+            max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        })
+        return session
+
+    def __hosts_to_try(self):
+        # The host which answered last comes first, then the other hosts in
+        # the configured order. Hosts which recently failed come last, so
+        # that they are still tried when no other host answers.
+        now = time.time()
+        alive = [host for host in self.__hosts
+                 if self.__host_dead_until.get(host, 0) <= now]
+        dead = sorted((host for host in self.__hosts if host not in alive),
+                      key=lambda host: self.__host_dead_until[host])
+        if self.__current_host in alive:
+            alive.remove(self.__current_host)
+            alive.insert(0, self.__current_host)
+        return alive + dead
+
+    def __host_failed(self, host, error):
+        failures = self.__host_failures.get(host, 0) + 1
+        backoff = min(self.HOST_BACKOFF_SECONDS * 2 ** (failures - 1),
+                      self.MAX_HOST_BACKOFF_SECONDS)
+        self.__host_failures[host] = failures
+        self.__host_dead_until[host] = time.time() + backoff
+        if host == self.__current_host:
+            self.__current_host = None
+        logger.warning("Marathon at %s failed (%s), trying it last for the "
+                       "next %ds", host, error, backoff)
+
+    def __host_succeeded(self, host):
+        self.__host_failures.pop(host, None)
+        self.__host_dead_until.pop(host, None)
+        self.__current_host = host
+
+    def __find_leader(self):
+        # Requests to a Marathon which isn't the leader are proxied to the
+        # leader, so send them to the leader directly if it is one of the
+        # configured hosts.
+        for host in self.__hosts_to_try():
+            try:
+                response = self.__session.get(
+                    os.path.join(host, 'v2', 'leader'),
+                    auth=self.__auth,
+                    verify=self.__verify,
+                    timeout=(3.05, 5))
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                self.__host_failed(host, e)
+                continue
+            if response.status_code != 200:
+                continue
+            try:
+                leader = response.json().get('leader')
+            except ValueError:
+                # e.g. the page of a proxy in front of Marathon
+                continue
+            for candidate in self.__hosts:
+                if urlparse(candidate).netloc == leader:
+                    logger.info("Marathon leader is %s", candidate)
+                    return candidate
+            return None
+        return None
 
     def api_req_raw(self, method, path, auth, body=None, **kwargs):
-        for host in self.__hosts:
+        if self.__current_host is None:
+            self.__current_host = self.__find_leader()
+
+        response = None
+        error = None
+        for host in self.__hosts_to_try():
             path_str = os.path.join(host, 'v2')
 
             for path_elem in path:
                 path_str = path_str + "/" + path_elem
 
-            response = requests.request(
-                method,
-                path_str,
-                auth=auth,
-                headers={
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/json'
-                },
-                timeout=(3.05, 46),
-                **kwargs
-            )
+            try:
+                response = self.__session.request(
+                    method,
+                    path_str,
+                    auth=auth,
+                    timeout=(3.05, 46),
+                    **kwargs
+                )
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                self.__host_failed(host, e)
+                error = e
+                continue
 
             logger.debug("%s %s", method, response.url)
-            if response.status_code == 200:
+            # 304 is the answer to a conditional request (see
+            # list_if_modified) when nothing changed.
+            if response.status_code in (200, 304):
+                self.__host_succeeded(host)
                 break
+            if kwargs.get('stream'):
+                # The body of a streamed response isn't read, so its
+                # connection only goes back to the pool once it's closed.
+                response.close()
 
+        if response is None:
+            raise error
         response.raise_for_status()
+        if kwargs.get('stream'):
+            return response
 
         resp_json = cleanup_json(response.json())
         if 'message' in resp_json:
@@ -204,7 +386,7 @@ class Marathon(object):
         return cleanup_json(data)
 
     def create(self, app_json):
-        return self.api_req('POST', ['apps'], app_json)
+        return self.api_req('POST', ['apps'], json=app_json)
 
     def get_app(self, appid):
         logger.info('fetching app %s', appid)
@@ -212,9 +394,54 @@ class Marathon(object):
 
     # Lists all running apps.
     def list(self):
+        return list(self.iter_apps())
+
+    def iter_apps(self):
+        return self.__iter_response_apps(self.__request_apps())
+
+    def list_if_modified(self, etag=None, last_modified=None):
+        """
+        Fetch the apps unless they didn't change since the response with the
+        given ETag or Last-Modified header, if Marathon (or a proxy in front
+        of it) provides them.
+        :return: Tuple of (apps, etag, last_modified). The apps are None if
+        they didn't change.
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = self.__request_apps(headers)
+        etag = response.headers.get('ETag', etag)
+        last_modified = response.headers.get('Last-Modified', last_modified)
+        if response.status_code == 304:
+            response.close()
+            return None, etag, last_modified
+        apps = list(self.__iter_response_apps(response))
+        return apps, etag, last_modified
+
+    def __request_apps(self, headers=None):
         logger.info('fetching apps')
-        return self.api_req('GET', ['apps'],
-                            params={'embed': 'apps.tasks'})["apps"]
+        return self.api_req_raw('GET', ['apps'], self.__auth,
+                                verify=self.__verify,
+                                params={'embed': 'apps.tasks'},
+                                headers=headers,
+                                stream=True)
+
+    def __iter_response_apps(self, response):
+        # The apps are decoded one at a time while the response is read, so
+        # that the (potentially huge) response body is never held in memory
+        # in full, nor decoded and cleaned up in separate passes. The callers
+        # still keep all the decoded apps, see list().
+        try:
+            chunks = response.iter_content(chunk_size=65536)
+            for app in iter_json_array(chunks, 'apps', drop_null_values):
+                if self.__compact_apps:
+                    app = compact_app(app)
+                yield app
+        finally:
+            response.close()
 
     def health_check(self):
         return self.__health_check
@@ -241,13 +468,8 @@ class Marathon(object):
             def __init__(self, data):
                 self.data = data
 
-        for line in stream.iter_lines():
-            if line.strip() != '':
-                for real_event_data in re.split(r'\r\n',
-                                                line.decode('utf-8')):
-                    if real_event_data[:6] == "data: ":
-                        event = Event(data=real_event_data[6:])
-                        yield event
+        for data in stream.iter_data():
+            yield Event(data=data)
 
     @property
     def host(self):
@@ -270,6 +492,34 @@ def has_group(groups, app_groups):
     return False
 
 
+def get_unserved_app_ids(groups, apps):
+    """
+    Return the ids of the apps which can't have any service port in one of
+    the groups, whatever the state of their tasks. Only a change of the app
+    definition (an api_post_event) can change that.
+    """
+    groups = frozenset(groups)
+    if '*' in groups:
+        return frozenset()
+
+    unserved = set()
+    for app in apps:
+        labels = app.get('labels', {})
+        # The apps of a deployment group are merged before they are
+        # filtered.
+        if 'HAPROXY_DEPLOYMENT_GROUP' in labels:
+            continue
+        app_groups = labels.get('HAPROXY_GROUP', '').split(',')
+        if has_group(groups, app_groups):
+            continue
+        if any(has_group(groups, value.split(','))
+               for key, value in labels.items()
+               if PORT_GROUP_LABEL_PATTERN.match(key)):
+            continue
+        unserved.add(app['id'])
+    return frozenset(unserved)
+
+
 def get_backend_port(apps, app, idx):
     """
     Return the port of the idx-th backend of the app which index in apps
@@ -295,24 +545,19 @@ def get_backend_port(apps, app, idx):
     then the app idx-th backend is returned instead.
 
     """
-    def get_backends(app):
-        key_func = attrgetter('host', 'port')
-        return sorted(list(app.backends), key=key_func)
-
     apps = [_app for _app in apps if _app.appId == app.appId]
 
     # If no healthcheck port index is defined, or if its value is nonsense
     # simply return the app port
     if app.healthcheck_port_index is None \
             or abs(app.healthcheck_port_index) > len(apps):
-        return get_backends(app)[idx].port
+        return app.backends[idx].port
 
     # If a healthcheck port index is defined, fetch the app corresponding
     # to the argument app healthcheck port index,
     # and return its idx-th backend port
     apps = sorted(apps, key=attrgetter('appId', 'servicePort'))
-    backends = get_backends(apps[app.healthcheck_port_index])
-    return backends[idx].port
+    return apps[app.healthcheck_port_index].backends[idx].port
 
 
 def _get_health_check_options(template, health_check, health_check_port):
@@ -356,9 +601,12 @@ def calculate_server_id(server_name, taken_server_ids):
         * is stable - i.e. calling this function repeatably with the same
           server name must yield the same server id.
 
-        THE STABILITY OF SERVER_ID IS GUARANTEED IF THE ORDER OF CALLS OF THIS
-        FUNCTION IS PRESERVED, I.E. THE BACKEND LIST IS SORTED BEFORE
-        PROCESSING
+        On its own, the id only depends on the ids which are already taken,
+        so it depends on the order of the calls. ServerIdAssigner only calls
+        it for the servers which are new to a backend, and keeps the ids of
+        the other servers, also from the running config after a restart.
+        A server thus keeps its id for as long as it's part of the backend,
+        whichever servers come and go.
 
         [1] http://cbonte.github.io/haproxy-dconv/1.8/configuration.html#5.2-id
         [2] http://cbonte.github.io/haproxy-dconv/1.8/configuration.html#5.2
@@ -433,30 +681,108 @@ def calculate_server_id(server_name, taken_server_ids):
     return calculate_server_id(new_server_name, taken_server_ids)
 
 
+class ServerIdAssigner(object):
+    """
+    Helper class to assign stable ids to the servers of each backend.
+
+    A new server gets the id calculate_server_id() derives from its name,
+    and keeps it for as long as it is part of the backend, whatever the
+    order of the servers and whichever servers are added to the backend
+    later on.  Only new servers are hashed.  The assignments are seeded from
+    the running HAProxy config on startup, so they survive restarts of
+    marathon-lb.
+    """
+    def __init__(self):
+        self.ids_by_backend = {}
+
+    def reset(self):
+        """
+        Reset the assigner so that ids are newly assigned.
+        """
+        self.ids_by_backend = {}
+
+    def load(self, config):
+        """
+        Seed the id assignments from an existing HAProxy config.
+        :param config: The text of the config.
+        """
+        for section in parse_config(config).values():
+            for server in section.servers.values():
+                options = server.options
+                for idx in range(len(options) - 1):
+                    if options[idx] == 'id' and options[idx + 1].isdigit():
+                        self.ids_by_backend.setdefault(server.backend, {})[
+                            server.name] = int(options[idx + 1])
+
+    def retain(self, backends):
+        """
+        Forget the assignments of backends which no longer exist.
+        :param backends: The names of the backends to keep.
+        """
+        backends = set(backends)
+        for backend in list(self.ids_by_backend):
+            if backend not in backends:
+                del self.ids_by_backend[backend]
+
+    def assign(self, backend, server_names):
+        """
+        Assign ids to the servers of a backend.
+        :param backend: The name of the backend.
+        :param server_names: The name of each server.
+        :return: The id of each server.
+        """
+        previous = self.ids_by_backend.get(backend, {})
+        server_ids = [None] * len(server_names)
+        taken_server_ids = set()
+        for idx, server_name in enumerate(server_names):
+            server_id = previous.get(server_name)
+            if server_id is not None and server_id not in taken_server_ids:
+                server_ids[idx] = server_id
+                taken_server_ids.add(server_id)
+        for idx, server_name in enumerate(server_names):
+            if server_ids[idx] is None:
+                server_ids[idx] = calculate_server_id(server_name,
+                                                      taken_server_ids)
+
+        self.ids_by_backend[backend] = dict(zip(server_names, server_ids))
+        return server_ids
+
+
+SERVER_ID_ASSIGNER = ServerIdAssigner()
+
+
 def config(apps, groups, bind_http_https, ssl_certs, templater,
-           haproxy_map=False, domain_map_array=[], app_map_array=[],
+           haproxy_map=False, domain_map=None, app_map=None,
            config_file="/etc/haproxy/haproxy.cfg",
-           group_https_by_vhosts=False):
+           group_https_by_vhosts=False, retain=True):
     logger.info("generating config")
-    config = templater.haproxy_head
+    fragment_hits = CONFIG_FRAGMENTS.hits
+    fragment_misses = CONFIG_FRAGMENTS.misses
+    if domain_map is None:
+        domain_map = HaproxyMap()
+    if app_map is None:
+        app_map = HaproxyMap()
+    head = templater.haproxy_head
     groups = frozenset(groups)
     duplicate_map = {}
     # do not repeat use backend multiple times since map file is same.
     _ssl_certs = ssl_certs or "/etc/ssl/cert.pem"
     _ssl_certs = _ssl_certs.split(",")
 
+    # The sections are collected in lists and joined once at the end, as
+    # appending to strings copies them over and over for large configs.
     if bind_http_https:
-        http_frontends = templater.haproxy_http_frontend_head
+        http_frontends = [templater.haproxy_http_frontend_head]
         if group_https_by_vhosts:
-            https_frontends = templater.haproxy_https_grouped_frontend_head
+            https_frontends = [templater.haproxy_https_grouped_frontend_head]
         else:
-            https_frontends = templater.haproxy_https_frontend_head.format(
+            https_frontends = [templater.haproxy_https_frontend_head.format(
                 sslCerts=" ".join(map(lambda cert: "crt " + cert, _ssl_certs))
-            )
+            )]
 
     # This should handle situations where customers have a custom HAPROXY_HEAD
     # that includes the 'daemon' flag or does not expose listener fds:
-    if 'daemon' in config.split() or "expose-fd listeners" not in config:
+    if 'daemon' in head.split() or "expose-fd listeners" not in head:
         upgrade_warning = '''\
 Error in custom HAPROXY_HEAD template: \
 In Marathon-LB 1.12, the default HAPROXY_HEAD section changed, please \
@@ -467,14 +793,20 @@ https://docs.mesosphere.com/services/marathon-lb/advanced/#global-template.\
 '''
         raise Exception(upgrade_warning)
 
-    userlists = str()
-    frontends = str()
-    backends = str()
-    http_appid_frontends = templater.haproxy_http_frontend_appid_head
-    apps_with_http_appid_backend = []
+    userlists = []
+    frontends = []
+    backends = []
+    http_appid_frontends = [templater.haproxy_http_frontend_appid_head]
+    apps_with_http_appid_backend = set()
     http_frontend_list = []
     https_frontend_list = []
     https_grouped_frontend_list = defaultdict(lambda: ([], set(), set()))
+    service_backends = []
+    slot_backends = []
+    templates_key = getTemplatesKey(templater)
+    apps_by_id = defaultdict(list)
+    for app in apps:
+        apps_by_id[app.appId].append(app)
     haproxy_dir = os.path.dirname(config_file)
     logger.debug("HAProxy dir is %s", haproxy_dir)
 
@@ -514,28 +846,37 @@ https://docs.mesosphere.com/services/marathon-lb/advanced/#global-template.\
 
         if app.authUser:
             userlist_head = templater.haproxy_userlist_head(app)
-            userlists += userlist_head.format(
+            userlists.append(userlist_head.format(
                 backend=backend,
                 user=app.authUser,
                 passwd=app.authPasswd
-            )
-
-        frontend_head = templater.haproxy_frontend_head(app)
-        frontends += frontend_head.format(
-            bindAddr=app.bindAddr,
-            backend=backend,
-            servicePort=app.servicePort,
-            mode=app.mode,
-            sslCert=' ssl crt ' + app.sslCert if app.sslCert else '',
-            bindOptions=' ' + app.bindOptions if app.bindOptions else ''
-        )
-
-        backend_head = templater.haproxy_backend_head(app)
-        backends += backend_head.format(
-            backend=backend,
-            balance=app.balance,
-            mode=app.mode
-        )
+            ))
+
+        sorted_backends = app.backends
+        # With server slots, the servers are emitted in slot order and the
+        # unused slots as disabled placeholders.
+        slots = SERVER_SLOT_ASSIGNER.assign(
+            backend,
+            [(server.ip, server.port) for server in sorted_backends],
+            app.server_slots)
+        if slots is not None:
+            slot_backends.append(backend)
+        service_backends.append(backend)
+
+        # The sections of the service only depend on the service, its
+        # servers, the other services of the app and the templates, so
+        # they're rendered again only if one of those changed.
+        fragment_key = getServiceConfigKey(templates_key,
+                                           apps_by_id[app.appId], app,
+                                           backend, sorted_backends, slots)
+        fragment = CONFIG_FRAGMENTS.get(backend, fragment_key)
+        if fragment is None:
+            fragment = generateServiceConfig(templater,
+                                             apps_by_id[app.appId], app,
+                                             backend, sorted_backends, slots)
+            CONFIG_FRAGMENTS.set(backend, fragment_key, fragment)
+        frontends.append(fragment[0])
+        backends.append(fragment[1])
 
         # if a hostname is set we add the app to the vhost section
         # of our haproxy config
@@ -547,7 +888,7 @@ https://docs.mesosphere.com/services/marathon-lb/advanced/#global-template.\
                                      app,
                                      backend,
                                      haproxy_map,
-                                     domain_map_array,
+                                     domain_map,
                                      haproxy_dir,
                                      duplicate_map)
             http_frontend_list.append((backend_weight, p_fe))
@@ -563,200 +904,72 @@ https://docs.mesosphere.com/services/marathon-lb/advanced/#global-template.\
                 app.appId not in apps_with_http_appid_backend:
             logger.debug("adding virtual host for app with id %s", app.appId)
             # remember appids to prevent multiple entries for the same app
-            apps_with_http_appid_backend += [app.appId]
+            apps_with_http_appid_backend.add(app.appId)
             cleanedUpAppId = re.sub(r'[^a-zA-Z0-9\-]', '_', app.appId)
 
             if haproxy_map:
                 if 'map_http_frontend_appid_acl' not in duplicate_map:
                     http_appid_frontend_acl = templater \
                         .haproxy_map_http_frontend_appid_acl(app)
-                    http_appid_frontends += http_appid_frontend_acl.format(
+                    http_appid_frontends.append(http_appid_frontend_acl.format(
                         haproxy_dir=haproxy_dir
-                    )
+                    ))
                     duplicate_map['map_http_frontend_appid_acl'] = 1
-                map_element = {}
-                map_element[app.appId] = backend
-                if map_element not in app_map_array:
-                    app_map_array.append(map_element)
+                app_map.add(app.appId, backend)
             else:
                 http_appid_frontend_acl = templater \
                     .haproxy_http_frontend_appid_acl(app)
-                http_appid_frontends += http_appid_frontend_acl.format(
+                http_appid_frontends.append(http_appid_frontend_acl.format(
                     cleanedUpAppId=cleanedUpAppId,
                     hostname=app.hostname,
                     appId=app.appId,
                     backend=backend
-                )
-
-        if app.mode == 'http':
-            if app.useHsts:
-                backends += templater.haproxy_backend_hsts_options(app)
-            backends += templater.haproxy_backend_http_options(app)
-            backend_http_backend_proxypass = templater \
-                .haproxy_http_backend_proxypass_glue(app)
-            if app.proxypath:
-                backends += backend_http_backend_proxypass.format(
-                    hostname=app.hostname,
-                    proxypath=app.proxypath
-                )
-            backend_http_backend_revproxy = templater \
-                .haproxy_http_backend_revproxy_glue(app)
-            if app.revproxypath:
-                backends += backend_http_backend_revproxy.format(
-                    hostname=app.hostname,
-                    rootpath=app.revproxypath
-                )
-            backend_http_backend_redir = templater \
-                .haproxy_http_backend_redir(app)
-            if app.redirpath:
-                backends += backend_http_backend_redir.format(
-                    hostname=app.hostname,
-                    redirpath=app.redirpath
-                )
-
-        # Set network allowed ACLs
-        if app.mode == 'http' and app.network_allowed:
-            for network in app.network_allowed.split():
-                backends += templater.\
-                    haproxy_http_backend_network_allowed_acl(app).\
-                    format(network_allowed=network)
-            backends += templater.haproxy_http_backend_acl_allow_deny
-        elif app.mode == 'tcp' and app.network_allowed:
-            for network in app.network_allowed.split():
-                backends += templater.\
-                    haproxy_tcp_backend_network_allowed_acl(app).\
-                    format(network_allowed=network)
-            backends += templater.haproxy_tcp_backend_acl_allow_deny
-
-        if app.sticky:
-            logger.debug("turning on sticky sessions")
-            backends += templater.haproxy_backend_sticky_options(app)
-
-        frontend_backend_glue = templater.haproxy_frontend_backend_glue(app)
-        frontends += frontend_backend_glue.format(backend=backend)
-
-        do_backend_healthcheck_options_once = True
-        key_func = attrgetter('host', 'port')
-        taken_server_ids = set()
-        for backend_service_idx, backendServer\
-                in enumerate(sorted(app.backends, key=key_func)):
-            if do_backend_healthcheck_options_once:
-                if app.healthCheck:
-                    template_backend_health_check = None
-                    if app.mode == 'tcp' \
-                            or app.healthCheck['protocol'] == 'TCP' \
-                            or app.healthCheck['protocol'] == 'MESOS_TCP':
-                        template_backend_health_check = templater \
-                            .haproxy_backend_tcp_healthcheck_options(app)
-                    elif app.mode == 'http':
-                        template_backend_health_check = templater \
-                            .haproxy_backend_http_healthcheck_options(app)
-                    if template_backend_health_check:
-                        health_check_port = get_backend_port(
-                            apps,
-                            app,
-                            backend_service_idx)
-                        backends += _get_health_check_options(
-                            template_backend_health_check,
-                            app.healthCheck,
-                            health_check_port)
-                do_backend_healthcheck_options_once = False
-
-            logger.debug(
-                "backend server %s:%d on %s",
-                backendServer.ip,
-                backendServer.port,
-                backendServer.host)
-
-            # Create a unique, friendly name for the backend server.  We concat
-            # the host, task IP and task port together.  If the host and task
-            # IP are actually the same then omit one for clarity.
-            if backendServer.host != backendServer.ip:
-                serverName = re.sub(
-                    r'[^a-zA-Z0-9\-]', '_',
-                    (backendServer.host + '_' +
-                     backendServer.ip + '_' +
-                     str(backendServer.port)))
-            else:
-                serverName = re.sub(
-                    r'[^a-zA-Z0-9\-]', '_',
-                    (backendServer.ip + '_' +
-                     str(backendServer.port)))
-            shortHashedServerName = hashlib.sha1(serverName.encode()) \
-                .hexdigest()[:10]
-
-            # In order to keep the state of backend servers consistent between
-            # reloads, server IDs need to be stable. See
-            # calculate_backend_id()'s docstring to learn how it is achieved.
-            server_id = calculate_server_id(serverName, taken_server_ids)
-
-            server_health_check_options = None
-            if app.healthCheck:
-                template_server_healthcheck_options = None
-                if app.mode == 'tcp' \
-                        or app.healthCheck['protocol'] == 'TCP' \
-                        or app.healthCheck['protocol'] == 'MESOS_TCP':
-                    template_server_healthcheck_options = templater \
-                        .haproxy_backend_server_tcp_healthcheck_options(app)
-                elif app.mode == 'http':
-                    template_server_healthcheck_options = templater \
-                        .haproxy_backend_server_http_healthcheck_options(app)
-                if template_server_healthcheck_options:
-                    if app.healthcheck_port_index is not None:
-                        health_check_port = \
-                            get_backend_port(apps, app, backend_service_idx)
-                    else:
-                        health_check_port = app.healthCheck.get('port')
-                    server_health_check_options = _get_health_check_options(
-                        template_server_healthcheck_options,
-                        app.healthCheck,
-                        health_check_port)
-            backend_server_options = templater \
-                .haproxy_backend_server_options(app)
-            backends += backend_server_options.format(
-                host=backendServer.host,
-                host_ipv4=backendServer.ip,
-                port=backendServer.port,
-                serverName=serverName,
-                serverId=server_id,
-                cookieOptions=' check cookie ' + shortHashedServerName
-                              if app.sticky else '',
-                healthCheckOptions=server_health_check_options
-                              if server_health_check_options else '',
-                otherOptions=' disabled' if backendServer.draining else ''
-            )
+                ))
+
+    hits = CONFIG_FRAGMENTS.hits - fragment_hits
+    misses = CONFIG_FRAGMENTS.misses - fragment_misses
+    logger.debug("reused the config of %d of %d services",
+                 hits, hits + misses)
+    # Only the config of all the apps forgets about the services which are
+    # gone, see get_apps().
+    if retain:
+        SERVER_SLOT_ASSIGNER.retain(slot_backends)
+        SERVER_ID_ASSIGNER.retain(service_backends)
+        CONFIG_FRAGMENTS.retain()
 
     http_frontend_list.sort(key=lambda x: x[0], reverse=True)
     https_frontend_list.sort(key=lambda x: x[0], reverse=True)
 
     for backend in http_frontend_list:
-        http_frontends += backend[1]
+        http_frontends.append(backend[1])
     if group_https_by_vhosts:
         for backend in sorted(https_grouped_frontend_list.keys()):
-            https_frontends +=\
+            https_frontends.append(
                 templater.haproxy_https_grouped_vhost_frontend_acl.format(
                     backend=re.sub(r'[^a-zA-Z0-9\-]', '_', backend),
-                    host=backend)
+                    host=backend))
 
     else:
         for backend in https_frontend_list:
-            https_frontends += backend[1]
+            https_frontends.append(backend[1])
 
-    config += userlists
+    config = [head]
+    config.extend(userlists)
     if bind_http_https:
-        config += http_frontends
-    config += http_appid_frontends
+        config.extend(http_frontends)
+    config.extend(http_appid_frontends)
     if bind_http_https:
-        config += https_frontends
+        config.extend(https_frontends)
         if group_https_by_vhosts:
             for vhost in sorted(https_grouped_frontend_list.keys()):
-                config +=\
-                    templater\
-                    .haproxy_https_grouped_vhost_backend_head\
+                config.append(
+                    templater
+                    .haproxy_https_grouped_vhost_backend_head
                     .format(
-                        name=re.sub(r'[^a-zA-Z0-9\-]', '_', vhost))
-                frontend = templater \
-                    .haproxy_https_grouped_vhost_frontend_head \
+                        name=re.sub(r'[^a-zA-Z0-9\-]', '_', vhost)))
+                config.append(
+                    templater
+                    .haproxy_https_grouped_vhost_frontend_head
                     .format(name=re.sub(r'[^a-zA-Z0-9\-]', '_', vhost),
                             sslCerts=" ".join(
                                 map(lambda cert: "crt " + cert,
@@ -766,17 +979,222 @@ https://docs.mesosphere.com/services/marathon-lb/advanced/#global-template.\
                             bindOpts=" ".join(
                                 map(lambda opts: " " + opts,
                                     https_grouped_frontend_list[vhost][2]))
-                            )
+                            ))
                 for v in sorted(
                         https_grouped_frontend_list[vhost][0],
                         key=lambda x: x[0],
                         reverse=True):
-                    frontend += v[1]
-                config += frontend
-    config += frontends
-    config += backends
-
-    return config
+                    config.append(v[1])
+    config.extend(frontends)
+    config.extend(backends)
+
+    return ''.join(config)
+
+
+def getTemplatesKey(templater):
+    digest = hashlib.sha1()
+    for name in sorted(templater.t):
+        digest.update(name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(templater.t[name].value.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def getServiceConfigKey(templates_key, apps, app, backend, sorted_backends,
+                        slots):
+    # A digest of everything generateServiceConfig() uses: the service and
+    # its labels, its servers and slots, the servers of the other services
+    # of the app if the health checks use their ports, and the templates.
+    other_servers = None
+    if app.healthcheck_port_index is not None:
+        other_servers = [
+            (other.servicePort,
+             [(server.host, server.port) for server in other.backends])
+            for other in apps]
+    key = (templates_key, backend, slots, other_servers,
+           app.settings(),
+           [(server.host, server.ip, server.port, server.draining)
+            for server in sorted_backends])
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def generateServiceConfig(templater, apps, app, backend, sorted_backends,
+                          slots):
+    # The frontend and backend sections of a service. `apps` are the
+    # services of the same app, whose backends the health checks may use.
+    frontend = []
+    backend_config = []
+
+    frontend_head = templater.haproxy_frontend_head(app)
+    frontend.append(frontend_head.format(
+        bindAddr=app.bindAddr,
+        backend=backend,
+        servicePort=app.servicePort,
+        mode=app.mode,
+        sslCert=' ssl crt ' + app.sslCert if app.sslCert else '',
+        bindOptions=' ' + app.bindOptions if app.bindOptions else ''
+    ))
+
+    backend_head = templater.haproxy_backend_head(app)
+    backend_config.append(backend_head.format(
+        backend=backend,
+        balance=app.balance,
+        mode=app.mode
+    ))
+
+    if app.mode == 'http':
+        if app.useHsts:
+            backend_config.append(templater.haproxy_backend_hsts_options(app))
+        backend_config.append(templater.haproxy_backend_http_options(app))
+        backend_http_backend_proxypass = templater \
+            .haproxy_http_backend_proxypass_glue(app)
+        if app.proxypath:
+            backend_config.append(backend_http_backend_proxypass.format(
+                hostname=app.hostname,
+                proxypath=app.proxypath
+            ))
+        backend_http_backend_revproxy = templater \
+            .haproxy_http_backend_revproxy_glue(app)
+        if app.revproxypath:
+            backend_config.append(backend_http_backend_revproxy.format(
+                hostname=app.hostname,
+                rootpath=app.revproxypath
+            ))
+        backend_http_backend_redir = templater \
+            .haproxy_http_backend_redir(app)
+        if app.redirpath:
+            backend_config.append(backend_http_backend_redir.format(
+                hostname=app.hostname,
+                redirpath=app.redirpath
+            ))
+
+    # Set network allowed ACLs
+    if app.mode == 'http' and app.network_allowed:
+        for network in app.network_allowed.split():
+            backend_config.append(
+                templater.haproxy_http_backend_network_allowed_acl(app)
+                .format(network_allowed=network))
+        backend_config.append(templater.haproxy_http_backend_acl_allow_deny)
+    elif app.mode == 'tcp' and app.network_allowed:
+        for network in app.network_allowed.split():
+            backend_config.append(
+                templater.haproxy_tcp_backend_network_allowed_acl(app)
+                .format(network_allowed=network))
+        backend_config.append(templater.haproxy_tcp_backend_acl_allow_deny)
+
+    if app.sticky:
+        logger.debug("turning on sticky sessions")
+        backend_config.append(templater.haproxy_backend_sticky_options(app))
+
+    frontend_backend_glue = templater.haproxy_frontend_backend_glue(app)
+    frontend.append(frontend_backend_glue.format(backend=backend))
+
+    if app.healthCheck:
+        template_backend_health_check = None
+        if app.mode == 'tcp' \
+                or app.healthCheck['protocol'] == 'TCP' \
+                or app.healthCheck['protocol'] == 'MESOS_TCP':
+            template_backend_health_check = templater \
+                .haproxy_backend_tcp_healthcheck_options(app)
+        elif app.mode == 'http':
+            template_backend_health_check = templater \
+                .haproxy_backend_http_healthcheck_options(app)
+        if template_backend_health_check:
+            health_check_port = get_backend_port(apps, app, 0)
+            backend_config.append(_get_health_check_options(
+                template_backend_health_check,
+                app.healthCheck,
+                health_check_port))
+
+    # The unused slots are emitted as disabled placeholders
+    if slots is None:
+        servers = list(enumerate(sorted_backends))
+    else:
+        servers = [(idx, sorted_backends[idx] if idx is not None else None)
+                   for idx in slots]
+
+    server_names = []
+    for slot_idx, (_, backendServer) in enumerate(servers):
+        if slots is not None:
+            serverName = 'slot{0}'.format(slot_idx + 1)
+        elif backendServer.host != backendServer.ip:
+            # Create a unique, friendly name for the backend server.  We
+            # concat the host, task IP and task port together.  If the
+            # host and task IP are actually the same then omit one for
+            # clarity.
+            serverName = re.sub(
+                r'[^a-zA-Z0-9\-]', '_',
+                (backendServer.host + '_' +
+                 backendServer.ip + '_' +
+                 str(backendServer.port)))
+        else:
+            serverName = re.sub(
+                r'[^a-zA-Z0-9\-]', '_',
+                (backendServer.ip + '_' +
+                 str(backendServer.port)))
+        server_names.append(serverName)
+
+    # In order to keep the state of backend servers consistent between
+    # reloads, server IDs need to be stable. See ServerIdAssigner and
+    # calculate_server_id()'s docstring to learn how it is achieved.
+    server_ids = SERVER_ID_ASSIGNER.assign(backend, server_names)
+
+    for slot_idx, (backend_service_idx, backendServer) \
+            in enumerate(servers):
+        serverName = server_names[slot_idx]
+        server_id = server_ids[slot_idx]
+        shortHashedServerName = hashlib.sha1(serverName.encode()) \
+            .hexdigest()[:10]
+
+        if backendServer is not None:
+            logger.debug(
+                "backend server %s:%d on %s",
+                backendServer.ip,
+                backendServer.port,
+                backendServer.host)
+        else:
+            backendServer = MarathonBackend(
+                UNUSED_SLOT_IP, UNUSED_SLOT_IP, 1, True)
+
+        server_health_check_options = None
+        if app.healthCheck:
+            template_server_healthcheck_options = None
+            if app.mode == 'tcp' \
+                    or app.healthCheck['protocol'] == 'TCP' \
+                    or app.healthCheck['protocol'] == 'MESOS_TCP':
+                template_server_healthcheck_options = templater \
+                    .haproxy_backend_server_tcp_healthcheck_options(app)
+            elif app.mode == 'http':
+                template_server_healthcheck_options = templater \
+                    .haproxy_backend_server_http_healthcheck_options(app)
+            if template_server_healthcheck_options:
+                if app.healthcheck_port_index is not None \
+                        and backend_service_idx is not None:
+                    health_check_port = \
+                        get_backend_port(apps, app, backend_service_idx)
+                else:
+                    health_check_port = app.healthCheck.get('port')
+                server_health_check_options = _get_health_check_options(
+                    template_server_healthcheck_options,
+                    app.healthCheck,
+                    health_check_port)
+        backend_server_options = templater \
+            .haproxy_backend_server_options(app)
+        backend_config.append(backend_server_options.format(
+            host=backendServer.host,
+            host_ipv4=backendServer.ip,
+            port=backendServer.port,
+            serverName=serverName,
+            serverId=server_id,
+            cookieOptions=' check cookie ' + shortHashedServerName
+                          if app.sticky else '',
+            healthCheckOptions=server_health_check_options
+                          if server_health_check_options else '',
+            otherOptions=' disabled' if backendServer.draining else ''
+        ))
+
+    return ''.join(frontend), ''.join(backend_config)
 
 
 def defaultValue(col, default):
@@ -789,14 +1207,32 @@ def defaultValue(col, default):
 def get_haproxy_pids():
     try:
         return set(map(lambda i: int(i), subprocess.check_output(
-            "pidof haproxy",
-            stderr=subprocess.STDOUT,
-            shell=True).split()))
-    except subprocess.CalledProcessError as ex:
+            ['pidof', 'haproxy'],
+            stderr=subprocess.STDOUT).split()))
+    except (OSError, subprocess.CalledProcessError) as ex:
         logger.debug("Unable to get haproxy pids: %s", ex)
         return set()
 
 
+def get_haproxy_socket_pid(socket_path):
+    # The pid of the haproxy process answering on the stats socket, which
+    # is the one running the most recently loaded config.
+    try:
+        return int(RuntimeApi(socket_path, timeout=1).show_info()['Pid'])
+    except (RuntimeApiError, KeyError, ValueError) as ex:
+        logger.debug("Unable to get haproxy pid from %s: %s",
+                     socket_path, ex)
+        return None
+
+
+def get_config_stats_socket(config_file):
+    try:
+        with open(config_file, 'r') as f:
+            return get_stats_socket(f.read())
+    except IOError:
+        return None
+
+
 def reloadConfig():
     reloadCommand = []
     if args.command:
@@ -834,17 +1270,34 @@ def reloadConfig():
                 enable_retries = False
             elif reload_retries < 0:
                 infinite_retries = True
-            old_pids = get_haproxy_pids()
+            # The reload is done once another haproxy process answers on
+            # the stats socket, which means that it loaded the new config.
+            # Without a stats socket, wait until there's a new haproxy pid.
+            socket_path = get_config_stats_socket(args.haproxy_config)
+            old_pid = None
+            if socket_path:
+                old_pid = get_haproxy_socket_pid(socket_path)
+            if old_pid is not None:
+                old_pids = {old_pid}
+            else:
+                old_pids = get_haproxy_pids()
             subprocess.check_call(reloadCommand, close_fds=True)
-            new_pids = get_haproxy_pids()
-            logger.debug("Waiting for new haproxy pid (old pids: [%s], " +
-                         "new_pids: [%s])...", old_pids, new_pids)
-            # Wait until the reload actually occurs and there's a new PID
+            # Check often at first, as a reload usually takes well below a
+            # second, then back off.
+            wait_seconds = 0.01
             while True:
+                if old_pid is not None:
+                    new_pid = get_haproxy_socket_pid(socket_path)
+                    new_pids = {new_pid} if new_pid is not None else old_pids
+                else:
+                    new_pids = get_haproxy_pids()
                 if len(new_pids - old_pids) >= 1:
+                    duration = time.time() - start_time
+                    RELOAD_DURATIONS.observe(duration)
                     logger.debug("new pids: [%s]", new_pids)
-                    logger.debug("reload finished, took %s seconds",
-                                 time.time() - start_time)
+                    logger.info("reload finished, took %.3f seconds "
+                                "(reload durations: %s)", duration,
+                                RELOAD_DURATIONS)
                     break
                 timeSinceCheckpoint = time.time() - checkpoint_time
                 if (timeSinceCheckpoint >= reload_frequency):
@@ -862,8 +1315,8 @@ def reloadConfig():
                                 break
                         logger.debug("Attempting reload again...")
                         subprocess.check_call(reloadCommand, close_fds=True)
-                time.sleep(0.1)
-                new_pids = get_haproxy_pids()
+                time.sleep(wait_seconds)
+                wait_seconds = min(wait_seconds * 2, 0.5)
         except OSError as ex:
             logger.error("unable to reload config using command %s",
                          " ".join(reloadCommand))
@@ -874,14 +1327,40 @@ def reloadConfig():
             logger.error("reload returned non-zero: %s", ex)
 
 
+def reloadOrUpdateConfig(running_config, diff):
+    # Make haproxy pick up the config and maps which have just been written,
+    # through the runtime API if the change allows it, otherwise by
+    # reloading.
+    if diff.action == ACTION_NONE:
+        logger.info("no effective changes - skipping reload")
+        return
+    if args.runtime_api:
+        socket_path = get_stats_socket(running_config)
+        if socket_path and \
+                get_stats_socket_level(running_config) != 'admin':
+            logger.warning("--runtime-api requires 'level admin' on the "
+                           "stats socket %s in HAPROXY_HEAD - reloading "
+                           "instead", socket_path)
+            socket_path = None
+        if socket_path and diff.action != ACTION_RELOAD:
+            commands = diff.commands()
+            if apply_commands(socket_path, commands):
+                logger.info("applied %d changes through the runtime API - "
+                            "skipping reload", len(commands))
+                return
+        if socket_path:
+            apply_commands(socket_path, diff.server_enables())
+    reloadConfig()
+
+
 def generateHttpVhostAcl(
-        templater, app, backend, haproxy_map, map_array,
+        templater, app, backend, haproxy_map, vhost_map,
         haproxy_dir, duplicate_map):
     # If the hostname contains the delimiter ',', then the marathon app is
     # requesting multiple hostname matches for the same backend, and we need
     # to use alternate templates from the default one-acl/one-use_backend.
-    staging_http_frontends = ""
-    staging_https_frontends = ""
+    staging_http_frontends = []
+    staging_https_frontends = []
     https_grouped_frontend_list = defaultdict(lambda: ([], set(), set()))
 
     if "," in app.hostname:
@@ -898,39 +1377,39 @@ def generateHttpVhostAcl(
                 http_frontend_acl = \
                     templater.\
                     haproxy_http_frontend_acl_only_with_path_and_auth(app)
-                staging_http_frontends += http_frontend_acl.format(
+                staging_http_frontends.append(http_frontend_acl.format(
                     path=app.path,
                     cleanedUpHostname=acl_name,
                     hostname=vhosts[0],
                     realm=app.authRealm,
                     backend=backend
-                )
+                ))
                 https_frontend_acl = \
                     templater.\
                     haproxy_https_frontend_acl_only_with_path(app)
-                staging_https_frontends += https_frontend_acl.format(
+                staging_https_frontends.append(https_frontend_acl.format(
                     path=app.path,
                     cleanedUpHostname=acl_name,
                     hostname=vhosts[0],
                     realm=app.authRealm,
                     backend=backend
-                )
+                ))
             else:
                 # Set the path ACL if it exists
                 logger.debug("adding path acl, path=%s", app.path)
                 http_frontend_acl = \
                     templater.haproxy_http_frontend_acl_only_with_path(app)
-                staging_http_frontends += http_frontend_acl.format(
+                staging_http_frontends.append(http_frontend_acl.format(
                     path=app.path,
                     backend=backend
-                )
+                ))
                 https_frontend_acl = \
                     templater.haproxy_https_frontend_acl_only_with_path(app)
-                staging_https_frontends += https_frontend_acl.format(
+                staging_https_frontends.append(https_frontend_acl.format(
                     path=app.path,
                     backend=backend
-                )
-        temp_frontend_head = staging_https_frontends
+                ))
+        temp_frontend_head = ''.join(staging_https_frontends)
 
         for vhost_hostname in vhosts:
             https_grouped_frontend_list[vhost_hostname][0].append(
@@ -948,21 +1427,18 @@ def generateHttpVhostAcl(
                     app.backend_weight = -1
                     http_frontend_acl = templater.\
                         haproxy_map_http_frontend_acl_only(app)
-                    staging_http_frontends += http_frontend_acl.format(
+                    staging_http_frontends.append(http_frontend_acl.format(
                         haproxy_dir=haproxy_dir
-                    )
+                    ))
                     duplicate_map['map_http_frontend_acl'] = 1
-                map_element = {}
-                map_element[vhost_hostname] = backend
-                if map_element not in map_array:
-                    map_array.append(map_element)
+                vhost_map.add(vhost_hostname, backend)
             else:
                 http_frontend_acl = templater.\
                     haproxy_http_frontend_acl_only(app)
-                staging_http_frontends += http_frontend_acl.format(
+                staging_http_frontends.append(http_frontend_acl.format(
                     cleanedUpHostname=acl_name,
                     hostname=vhost_hostname
-                )
+                ))
 
             # Tack on the SSL ACL as well
             if app.path:
@@ -976,7 +1452,7 @@ def generateHttpVhostAcl(
                         realm=app.authRealm,
                         backend=backend
                     )
-                    staging_https_frontends += staging_https_frontend
+                    staging_https_frontends.append(staging_https_frontend)
                     https_grouped_frontend_list[vhost_hostname][0].append(
                         (app.backend_weight, staging_https_frontend))
                 else:
@@ -988,7 +1464,7 @@ def generateHttpVhostAcl(
                         appId=app.appId,
                         backend=backend
                     )
-                    staging_https_frontends += staging_https_frontend
+                    staging_https_frontends.append(staging_https_frontend)
                     https_grouped_frontend_list[vhost_hostname][0].append(
                         (app.backend_weight, staging_https_frontend))
             else:
@@ -1002,7 +1478,7 @@ def generateHttpVhostAcl(
                         realm=app.authRealm,
                         backend=backend
                     )
-                    staging_https_frontends += staging_https_frontend
+                    staging_https_frontends.append(staging_https_frontend)
                     https_grouped_frontend_list[vhost_hostname][0].append(
                         (app.backend_weight, staging_https_frontend))
                 else:
@@ -1016,15 +1492,13 @@ def generateHttpVhostAcl(
                                     hostname=vhost_hostname,
                                     haproxy_dir=haproxy_dir
                                 )
-                            staging_https_frontends += staging_https_frontend
+                            staging_https_frontends.append(
+                                staging_https_frontend)
                             https_grouped_frontend_list[vhost_hostname][0]\
                                 .append(
                                 (app.backend_weight, staging_https_frontend))
                             duplicate_map['map_https_frontend_acl'] = 1
-                        map_element = {}
-                        map_element[vhost_hostname] = backend
-                        if map_element not in map_array:
-                            map_array.append(map_element)
+                        vhost_map.add(vhost_hostname, backend)
 
                     else:
                         https_frontend_acl = templater.\
@@ -1035,7 +1509,7 @@ def generateHttpVhostAcl(
                             appId=app.appId,
                             backend=backend
                         )
-                        staging_https_frontends += staging_https_frontend
+                        staging_https_frontends.append(staging_https_frontend)
                         https_grouped_frontend_list[vhost_hostname][0].append(
                             (app.backend_weight, staging_https_frontend))
 
@@ -1051,7 +1525,7 @@ def generateHttpVhostAcl(
                     cleanedUpHostname=acl_name,
                     backend=backend
                 )
-                staging_http_frontends += frontend
+                staging_http_frontends.append(frontend)
             else:
                 haproxy_backend_redirect_http_to_https = \
                     templater.haproxy_backend_redirect_http_to_https(app)
@@ -1059,42 +1533,42 @@ def generateHttpVhostAcl(
                     bindAddr=app.bindAddr,
                     cleanedUpHostname=acl_name
                 )
-                staging_http_frontends += frontend
+                staging_http_frontends.append(frontend)
         elif app.path:
             if app.authRealm:
                 http_frontend_route = \
                     templater.\
                     haproxy_http_frontend_routing_only_with_path_and_auth(app)
-                staging_http_frontends += http_frontend_route.format(
+                staging_http_frontends.append(http_frontend_route.format(
                     cleanedUpHostname=acl_name,
                     realm=app.authRealm,
                     backend=backend
-                )
+                ))
             else:
                 http_frontend_route = \
                     templater.haproxy_http_frontend_routing_only_with_path(app)
-                staging_http_frontends += http_frontend_route.format(
+                staging_http_frontends.append(http_frontend_route.format(
                     cleanedUpHostname=acl_name,
                     backend=backend
-                )
+                ))
         else:
             if app.authRealm:
                 http_frontend_route = \
                     templater.\
                     haproxy_http_frontend_routing_only_with_auth(app)
-                staging_http_frontends += http_frontend_route.format(
+                staging_http_frontends.append(http_frontend_route.format(
                     cleanedUpHostname=acl_name,
                     realm=app.authRealm,
                     backend=backend
-                )
+                ))
             else:
                 if not haproxy_map:
                     http_frontend_route = \
                         templater.haproxy_http_frontend_routing_only(app)
-                    staging_http_frontends += http_frontend_route.format(
+                    staging_http_frontends.append(http_frontend_route.format(
                         cleanedUpHostname=acl_name,
                         backend=backend
-                    )
+                    ))
 
     else:
         # A single hostname in the VHOST label
@@ -1111,18 +1585,18 @@ def generateHttpVhostAcl(
             if app.redirectHttpToHttps:
                 http_frontend_acl = \
                     templater.haproxy_http_frontend_acl_only(app)
-                staging_http_frontends += http_frontend_acl.format(
+                staging_http_frontends.append(http_frontend_acl.format(
                     cleanedUpHostname=acl_name,
                     hostname=app.hostname
-                )
+                ))
                 http_frontend_acl = \
                     templater.haproxy_http_frontend_acl_only_with_path(app)
-                staging_http_frontends += http_frontend_acl.format(
+                staging_http_frontends.append(http_frontend_acl.format(
                     cleanedUpHostname=acl_name,
                     hostname=app.hostname,
                     path=app.path,
                     backend=backend
-                )
+                ))
                 haproxy_backend_redirect_http_to_https = \
                     templater.\
                     haproxy_backend_redirect_http_to_https_with_path(app)
@@ -1131,37 +1605,37 @@ def generateHttpVhostAcl(
                     cleanedUpHostname=acl_name,
                     backend=backend
                 )
-                staging_http_frontends += frontend
+                staging_http_frontends.append(frontend)
             else:
                 if app.authRealm:
                     http_frontend_acl = \
                         templater.\
                         haproxy_http_frontend_acl_with_auth_and_path(app)
-                    staging_http_frontends += http_frontend_acl.format(
+                    staging_http_frontends.append(http_frontend_acl.format(
                         cleanedUpHostname=acl_name,
                         hostname=app.hostname,
                         path=app.path,
                         appId=app.appId,
                         realm=app.authRealm,
                         backend=backend
-                    )
+                    ))
                 else:
                     http_frontend_acl = \
                         templater.haproxy_http_frontend_acl_with_path(app)
-                    staging_http_frontends += http_frontend_acl.format(
+                    staging_http_frontends.append(http_frontend_acl.format(
                         cleanedUpHostname=acl_name,
                         hostname=app.hostname,
                         path=app.path,
                         appId=app.appId,
                         backend=backend
-                    )
+                    ))
             https_frontend_acl = \
                 templater.haproxy_https_frontend_acl_only_with_path(app)
             staging_https_frontend = https_frontend_acl.format(
                 path=app.path,
                 backend=backend
             )
-            staging_https_frontends += staging_https_frontend
+            staging_https_frontends.append(staging_https_frontend)
             https_grouped_frontend_list[app.hostname][0].append(
                 (app.backend_weight, staging_https_frontend))
 
@@ -1177,7 +1651,7 @@ def generateHttpVhostAcl(
                     realm=app.authRealm,
                     backend=backend
                 )
-                staging_https_frontends += staging_https_frontend
+                staging_https_frontends.append(staging_https_frontend)
                 https_grouped_frontend_list[app.hostname][0].append(
                     (app.backend_weight, staging_https_frontend))
             else:
@@ -1189,17 +1663,17 @@ def generateHttpVhostAcl(
                     appId=app.appId,
                     backend=backend
                 )
-                staging_https_frontends += staging_https_frontend
+                staging_https_frontends.append(staging_https_frontend)
                 https_grouped_frontend_list[app.hostname][0].append(
                     (app.backend_weight, staging_https_frontend))
         else:
             if app.redirectHttpToHttps:
                 http_frontend_acl = \
                     templater.haproxy_http_frontend_acl_only(app)
-                staging_http_frontends += http_frontend_acl.format(
+                staging_http_frontends.append(http_frontend_acl.format(
                     cleanedUpHostname=acl_name,
                     hostname=app.hostname
-                )
+                ))
                 haproxy_backend_redirect_http_to_https = \
                     templater.\
                     haproxy_backend_redirect_http_to_https(app)
@@ -1207,41 +1681,39 @@ def generateHttpVhostAcl(
                     bindAddr=app.bindAddr,
                     cleanedUpHostname=acl_name
                 )
-                staging_http_frontends += frontend
+                staging_http_frontends.append(frontend)
             else:
                 if app.authRealm:
                     http_frontend_acl = \
                         templater.haproxy_http_frontend_acl_with_auth(app)
-                    staging_http_frontends += http_frontend_acl.format(
+                    staging_http_frontends.append(http_frontend_acl.format(
                         cleanedUpHostname=acl_name,
                         hostname=app.hostname,
                         appId=app.appId,
                         realm=app.authRealm,
                         backend=backend
-                    )
+                    ))
                 else:
                     if haproxy_map:
                         if 'map_http_frontend_acl' not in duplicate_map:
                             app.backend_weight = -1
                             http_frontend_acl = \
                                 templater.haproxy_map_http_frontend_acl(app)
-                            staging_http_frontends += http_frontend_acl.format(
-                                haproxy_dir=haproxy_dir
-                            )
+                            staging_http_frontends.append(
+                                http_frontend_acl.format(
+                                    haproxy_dir=haproxy_dir
+                                ))
                             duplicate_map['map_http_frontend_acl'] = 1
-                        map_element = {}
-                        map_element[app.hostname] = backend
-                        if map_element not in map_array:
-                            map_array.append(map_element)
+                        vhost_map.add(app.hostname, backend)
                     else:
                         http_frontend_acl = \
                             templater.haproxy_http_frontend_acl(app)
-                        staging_http_frontends += http_frontend_acl.format(
+                        staging_http_frontends.append(http_frontend_acl.format(
                             cleanedUpHostname=acl_name,
                             hostname=app.hostname,
                             appId=app.appId,
                             backend=backend
-                        )
+                        ))
             if app.authRealm:
                 https_frontend_acl = \
                     templater.haproxy_https_frontend_acl_with_auth(app)
@@ -1252,7 +1724,7 @@ def generateHttpVhostAcl(
                     realm=app.authRealm,
                     backend=backend
                 )
-                staging_https_frontends += staging_https_frontend
+                staging_https_frontends.append(staging_https_frontend)
                 https_grouped_frontend_list[app.hostname][0].append(
                     (app.backend_weight, staging_https_frontend))
             else:
@@ -1265,14 +1737,11 @@ def generateHttpVhostAcl(
                             hostname=app.hostname,
                             haproxy_dir=haproxy_dir
                         )
-                        staging_https_frontends += staging_https_frontend
+                        staging_https_frontends.append(staging_https_frontend)
                         https_grouped_frontend_list[app.hostname][0].append(
                             (app.backend_weight, staging_https_frontend))
                         duplicate_map['map_https_frontend_acl'] = 1
-                    map_element = {}
-                    map_element[app.hostname] = backend
-                    if map_element not in map_array:
-                        map_array.append(map_element)
+                    vhost_map.add(app.hostname, backend)
                 else:
                     https_frontend_acl = templater.\
                         haproxy_https_frontend_acl(app)
@@ -1282,12 +1751,12 @@ def generateHttpVhostAcl(
                         appId=app.appId,
                         backend=backend
                     )
-                    staging_https_frontends += staging_https_frontend
+                    staging_https_frontends.append(staging_https_frontend)
                     https_grouped_frontend_list[app.hostname][0].append(
                         (app.backend_weight, staging_https_frontend))
     return (app.backend_weight,
-            staging_http_frontends,
-            staging_https_frontends,
+            ''.join(staging_http_frontends),
+            ''.join(staging_https_frontends),
             https_grouped_frontend_list)
 
 
@@ -1318,7 +1787,18 @@ def writeConfigAndValidate(
     # Write the new config to a temporary file
     haproxyTempConfigFile = writeReplacementTempFile(temp_config, config_file)
 
-    if validateConfig(haproxyTempConfigFile):
+    # Don't validate the same config, maps and files twice
+    validation_key = getValidationKey(config, domain_map_string,
+                                      app_map_string)
+    config_valid = VALIDATION_CACHE.get(validation_key, None)
+    if config_valid is None:
+        config_valid = validateConfig(haproxyTempConfigFile)
+        VALIDATION_CACHE.set(validation_key, config_valid)
+    else:
+        logger.debug("config was already validated, valid: %s",
+                     config_valid)
+
+    if config_valid:
         # Move into place
         if haproxy_map:
             moveTempFile(domain_temp_map_file, domain_map_file, "domain_map")
@@ -1361,6 +1841,30 @@ def writeReplacementTempFile(content, file_to_replace):
     return tempFile
 
 
+def getValidationKey(config, *maps):
+    # A digest of everything the validity of a config depends on: the
+    # config itself, the contents of the maps, and the size and modification
+    # time of the files it loads (of every file in the directories it loads,
+    # as certificates can be loaded from a directory).
+    digest = hashlib.sha1()
+    for content in (config,) + maps:
+        digest.update(content.encode('utf-8'))
+        digest.update(b'\0')
+    for path in sorted(set(CONFIG_FILE_PATTERN.findall(config))):
+        paths = [path]
+        if os.path.isdir(path):
+            paths.extend(sorted(os.path.join(path, name)
+                                for name in os.listdir(path)))
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            digest.update('{0} {1} {2} {3}\0'.format(
+                path, st.st_ino, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
+
+
 def validateConfig(haproxy_config_file):
     # If skip validation flag is provided, don't check.
     if args.skip_validation:
@@ -1409,8 +1913,8 @@ def removeTempFileIfExist(temp_file):
         os.remove(temp_file)
 
 
-def generateAndValidateTempConfig(config, config_file, domain_map_array,
-                                  app_map_array, haproxy_map):
+def generateAndValidateTempConfig(config, config_file, domain_map,
+                                  app_map, haproxy_map):
     temp_config_file = "%s.tmp" % config_file
     domain_map_file = os.path.join(os.path.dirname(temp_config_file),
                                    "domain2backend.map.tmp")
@@ -1421,16 +1925,16 @@ def generateAndValidateTempConfig(config, config_file, domain_map_array,
     app_map_string = str()
 
     if haproxy_map:
-        domain_map_string = generateMapString(domain_map_array)
-        app_map_string = generateMapString(app_map_array)
+        domain_map_string = domain_map.render()
+        app_map_string = app_map.render()
 
     return writeConfigAndValidate(
                 config, temp_config_file, domain_map_string, domain_map_file,
                 app_map_string, app_map_file, haproxy_map)
 
 
-def compareWriteAndReloadConfig(config, config_file, domain_map_array,
-                                app_map_array, haproxy_map):
+def compareWriteAndReloadConfig(config, config_file, domain_map,
+                                app_map, haproxy_map):
     changed = False
     config_valid = False
 
@@ -1451,68 +1955,50 @@ def compareWriteAndReloadConfig(config, config_file, domain_map_array,
     except IOError:
         logger.warning("couldn't open config file for reading")
 
+    running_maps = {}
+    new_maps = {}
     if haproxy_map:
-        domain_map_string = generateMapString(domain_map_array)
-        app_map_string = generateMapString(app_map_array)
-
-        if (runningConfig != config or
-                compareMapFile(domain_map_file, domain_map_string) or
-                compareMapFile(app_map_file, app_map_string)):
-            logger.info(
-                "running config/map is different from generated"
-                " config - reloading")
-            if writeConfigAndValidate(
-                    config, config_file, domain_map_string, domain_map_file,
-                    app_map_string, app_map_file, haproxy_map):
-                reloadConfig()
-                changed = True
-                config_valid = True
-            else:
-                logger.warning("skipping reload: config/map not valid")
-                changed = True
-                config_valid = False
-        else:
-            logger.debug("skipping reload: config/map unchanged")
-            changed = False
-            config_valid = True
+        domain_map_string = domain_map.render()
+        app_map_string = app_map.render()
+        running_maps[domain_map_file] = readMapFile(domain_map_file)
+        running_maps[app_map_file] = readMapFile(app_map_file)
+        new_maps[domain_map_file] = domain_map_string
+        new_maps[app_map_file] = app_map_string
     else:
         truncateMapFileIfExists(domain_map_file)
         truncateMapFileIfExists(app_map_file)
-        if runningConfig != config:
-            logger.info(
-                "running config is different from generated config"
-                " - reloading")
-            if writeConfigAndValidate(
-                    config, config_file, domain_map_string, domain_map_file,
-                    app_map_string, app_map_file, haproxy_map):
-                reloadConfig()
-                changed = True
-                config_valid = True
-            else:
-                logger.warning("skipping reload: config not valid")
-                changed = True
-                config_valid = False
-        else:
-            changed = False
-            config_valid = True
-            logger.debug("skipping reload: config unchanged")
 
-    return changed, config_valid
+    # Parsing the configs is only worth it if they differ at all, which
+    # they usually don't.
+    if runningConfig == config and running_maps == new_maps:
+        logger.debug("skipping reload: config/map unchanged")
+        return False, True
 
+    diff = ConfigDiff(runningConfig, config, running_maps, new_maps)
+    if diff.changed:
+        logger.info(
+            "running config/map is different from generated config"
+            " (%s) - %s", diff.summary(), diff.action)
+        if writeConfigAndValidate(
+                config, config_file, domain_map_string, domain_map_file,
+                app_map_string, app_map_file, haproxy_map):
+            reloadOrUpdateConfig(runningConfig, diff)
+            changed = True
+            config_valid = True
+        else:
+            logger.warning("skipping reload: config/map not valid")
+            changed = True
+            config_valid = False
+    else:
+        logger.debug("skipping reload: config/map unchanged")
+        changed = False
+        config_valid = True
 
-def generateMapString(map_array):
-    # Generate the string representation of the map file from a map array
-    map_string = str()
-    for element in map_array:
-        for key, value in list(element.items()):
-            map_string = map_string + str(key) + " " + str(value) + "\n"
-    return map_string
+    return changed, config_valid
 
 
-def compareMapFile(map_file, map_string):
-    # Read the map file (creating an empty file if it does not exist) and
-    # compare its contents to the given map string. Returns true if the map
-    # string is different to the contents of the file.
+def readMapFile(map_file):
+    # Read the map file, creating an empty file if it does not exist.
     if not os.path.isfile(map_file):
         open(map_file, 'a').close()
 
@@ -1524,7 +2010,7 @@ def compareMapFile(map_file, map_string):
     except IOError:
         logger.warning("couldn't open map file for reading")
 
-    return runningmap != map_string
+    return runningmap
 
 
 def get_health_check(app, portIndex):
@@ -1541,11 +2027,75 @@ def get_health_check(app, portIndex):
 healthCheckResultCache = LRUCache()
 
 
-def get_apps(marathon, apps=[]):
-    if len(apps) == 0:
-        apps = marathon.list()
+def parse_timestamp(value):
+    parsed = PARSED_TIMESTAMPS.get(value, None)
+    if parsed is not None:
+        return parsed
+    match = TIMESTAMP_PATTERN.match(value)
+    if match is None:
+        parsed = dateutil.parser.parse(value)
+    else:
+        (year, month, day, hour, minute, second, fraction,
+         utc, sign, offset_hours, offset_minutes) = match.groups()
+        tzinfo = None
+        if utc:
+            tzinfo = datetime.timezone.utc
+        elif sign:
+            offset = datetime.timedelta(hours=int(offset_hours),
+                                        minutes=int(offset_minutes or 0))
+            tzinfo = datetime.timezone(-offset if sign == '-' else offset)
+        parsed = datetime.datetime(
+            int(year), int(month), int(day), int(hour), int(minute),
+            int(second), int((fraction or '0').ljust(6, '0')), tzinfo)
+    PARSED_TIMESTAMPS.set(value, parsed)
+    return parsed
+
+
+def get_label_setters(labels, label_setters):
+    # The labels of an app to apply to its service ports, as the (position,
+    # full name, setter, value) of each label, in the order of label_keys:
+    # by port index for the ports with labels of their own, and for the
+    # other ports. They're looked up in LABEL_SETTERS and kept in
+    # label_setters.
+    key = tuple(sorted(labels.items()))
+    setters = LABEL_SETTERS.get(key)
+    if setters is None:
+        app_setters = []
+        port_setters = defaultdict(list)
+        for name, value in labels.items():
+            match = PORT_LABEL_PATTERN.match(name)
+            if match is not None:
+                setter = port_label_setters.get(match.group(2))
+                if setter is not None:
+                    port_setters[int(match.group(1))].append(
+                        setter + (value,))
+            elif name in app_label_setters:
+                app_setters.append(app_label_setters[name] + (value,))
+        setters = (dict((index, sorted(app_setters + port))
+                        for index, port in port_setters.items()),
+                   sorted(app_setters))
+    label_setters[key] = setters
+    return setters
+
+
+def copy_apps(apps):
+    """
+    Return a copy of the apps which is safe to hand to get_apps(), which
+    rewrites app ids and task lists of apps in deployment groups.
+    """
+    copies = []
+    for app in apps:
+        app = dict(app)
+        app['tasks'] = [dict(task) for task in app.get('tasks', [])]
+        copies.append(app)
+    return copies
 
-    logger.debug("got apps %s", [app["id"] for app in apps])
+
+def get_apps(marathon, apps=None, retain=True):
+    # With retain=False, the state kept about the apps across calls is only
+    # added to.
+    if apps is None:
+        apps = marathon.list()
 
     excluded_states = {'TASK_KILLING', 'TASK_KILLED',
                        'TASK_FINISHED', 'TASK_ERROR'}
@@ -1555,7 +2105,9 @@ def get_apps(marathon, apps=[]):
     # to a deployment group.
     processed_apps = []
     deployment_groups = {}
+    app_ids = []
     for app in apps:
+        app_ids.append(app['id'])
         deployment_group = None
         if 'HAPROXY_DEPLOYMENT_GROUP' in app['labels']:
             deployment_group = app['labels']['HAPROXY_DEPLOYMENT_GROUP']
@@ -1577,11 +2129,11 @@ def get_apps(marathon, apps=[]):
             cur_date = datetime.datetime.min
             prev_date = datetime.datetime.min
             if 'HAPROXY_DEPLOYMENT_STARTED_AT' in prev['labels']:
-                prev_date = dateutil.parser.parse(
+                prev_date = parse_timestamp(
                     prev['labels']['HAPROXY_DEPLOYMENT_STARTED_AT'])
 
             if 'HAPROXY_DEPLOYMENT_STARTED_AT' in cur['labels']:
-                cur_date = dateutil.parser.parse(
+                cur_date = parse_timestamp(
                     cur['labels']['HAPROXY_DEPLOYMENT_STARTED_AT'])
 
             old = new = None
@@ -1594,9 +2146,9 @@ def get_apps(marathon, apps=[]):
 
             if 'HAPROXY_DEPLOYMENT_NEW_INSTANCES' in new['labels']:
                 if int(new['labels']['HAPROXY_DEPLOYMENT_NEW_INSTANCES'] != 0):
-                    new_scale_time = dateutil.parser.parse(
+                    new_scale_time = parse_timestamp(
                         new['versionInfo']['lastScalingAt'])
-                    old_scale_time = dateutil.parser.parse(
+                    old_scale_time = parse_timestamp(
                         old['versionInfo']['lastScalingAt'])
                     if old_scale_time > new_scale_time:
                         temp = old
@@ -1647,15 +2199,10 @@ def get_apps(marathon, apps=[]):
         else:
             deployment_groups[deployment_group] = app
 
+    logger.debug("got apps %s", app_ids)
     processed_apps.extend(deployment_groups.values())
 
-    # Reset the service port assigner.  This forces the port assigner to
-    # re-assign ports for IP-per-task applications.  The upshot is that
-    # the service port for a particular app may change dynamically, but
-    # the service port will be deterministic and identical across all
-    # instances of the marathon-lb.
-    SERVICE_PORT_ASSIGNER.reset()
-
+    label_setters = {}
     for app in processed_apps:
         appId = app['id']
         if appId[1:] == os.environ.get("FRAMEWORK_NAME"):
@@ -1668,6 +2215,8 @@ def get_apps(marathon, apps=[]):
                 marathon_app.app['labels']['HAPROXY_GROUP'].split(',')
         marathon_apps.append(marathon_app)
 
+        port_setters, app_setters = get_label_setters(app['labels'],
+                                                      label_setters)
         service_ports = SERVICE_PORT_ASSIGNER.get_service_ports(app)
         for i, servicePort in enumerate(service_ports):
             if servicePort is None:
@@ -1678,13 +2227,8 @@ def get_apps(marathon, apps=[]):
                                       get_health_check(app, i),
                                       marathon.strict_mode())
 
-            for key_unformatted in label_keys:
-                key = key_unformatted.format(i)
-                if key in marathon_app.app['labels']:
-                    func = label_keys[key_unformatted]
-                    func(service,
-                         key_unformatted,
-                         marathon_app.app['labels'][key])
+            for _, key, func, value in port_setters.get(i, app_setters):
+                func(service, key, value)
 
             # https://github.com/mesosphere/marathon-lb/issues/198
             # Marathon app manifest which defines healthChecks is
@@ -1762,6 +2306,19 @@ def get_apps(marathon, apps=[]):
                                         task_port,
                                         draining)
 
+    # Only a call with all the apps forgets about the apps which are gone,
+    # not the calls with some of the apps made while looking for the apps
+    # which make the config invalid.
+    if retain:
+        LABEL_SETTERS.clear()
+        LABEL_SETTERS.update(label_setters)
+        # IP-per-task applications keep the service ports they were
+        # assigned for as long as they exist, so that their ports don't
+        # change when other apps come and go.  The first port an app is
+        # assigned only depends on its id, so it is usually the same on all
+        # instances of marathon-lb.
+        SERVICE_PORT_ASSIGNER.retain()
+
     # Convert into a list for easier consumption
     apps_list = []
     for marathon_app in marathon_apps:
@@ -1773,16 +2330,20 @@ def get_apps(marathon, apps=[]):
 
 
 def regenerate_config(marathon, config_file, groups, bind_http_https,
-                      ssl_certs, templater, haproxy_map, group_https_by_vhost):
-    domain_map_array = []
-    app_map_array = []
-    raw_apps = marathon.list()
-    apps = get_apps(marathon, raw_apps)
+                      ssl_certs, templater, haproxy_map, group_https_by_vhost,
+                      raw_apps=None):
+    domain_map = HaproxyMap()
+    app_map = HaproxyMap()
+    if raw_apps is None:
+        raw_apps = marathon.list()
+    # The apps are looked at again as they were fetched if the config turns
+    # out to be invalid.
+    apps = get_apps(marathon, copy_apps(raw_apps))
     generated_config = config(apps, groups, bind_http_https, ssl_certs,
-                              templater, haproxy_map, domain_map_array,
-                              app_map_array, config_file, group_https_by_vhost)
+                              templater, haproxy_map, domain_map,
+                              app_map, config_file, group_https_by_vhost)
     (changed, config_valid) = compareWriteAndReloadConfig(
-        generated_config, config_file, domain_map_array, app_map_array,
+        generated_config, config_file, domain_map, app_map,
         haproxy_map)
     if changed and not config_valid:
         apps = make_config_valid_and_regenerate(marathon,
@@ -1792,11 +2353,113 @@ def regenerate_config(marathon, config_file, groups, bind_http_https,
                                                 ssl_certs,
                                                 templater,
                                                 haproxy_map,
-                                                domain_map_array,
-                                                app_map_array,
+                                                domain_map,
+                                                app_map,
                                                 config_file,
                                                 group_https_by_vhost)
-    return apps
+    return apps, config_valid
+
+
+def get_apps_fingerprint(raw_apps, health_check):
+    # What get_apps() and config() use of an app: its definition (through
+    # the labels, ports and health checks) and the address and state of its
+    # tasks. The results of the health checks carry timestamps and counters
+    # Marathon updates on every check, so only whether they passed is used,
+    # and only if it matters: with --health-check, or to drain the tasks of
+    # deployment groups.
+    digest = hashlib.sha1()
+    for app in raw_apps:
+        app = compact_app(app)
+        tasks = app.pop('tasks', [])
+        use_health = health_check or \
+            'HAPROXY_DEPLOYMENT_GROUP' in app.get('labels', {})
+        app['tasks'] = [
+            [task.get(field) for field in FINGERPRINT_TASK_FIELDS] +
+            [[result.get('alive') for result in task['healthCheckResults']]
+             if use_health and 'healthCheckResults' in task else None]
+            for task in tasks]
+        digest.update(json.dumps(app, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_inputs_fingerprint(templater):
+    # The inputs of config() other than the apps: the command line, the
+    # templates, and the code generating the config.
+    digest = hashlib.sha1()
+    digest.update(repr(sorted(vars(args).items())).encode('utf-8'))
+    for name in sorted(templater.t):
+        digest.update(name.encode('utf-8'))
+        digest.update(templater.t[name].value.encode('utf-8'))
+    for module in [__file__, sys.modules[ConfigTemplater.__module__].__file__]:
+        with open(module, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_files_fingerprint(paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        except IOError:
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def regenerate_config_if_changed(marathon, config_file, groups,
+                                 bind_http_https, ssl_certs, templater,
+                                 haproxy_map, group_https_by_vhost):
+    # Regenerate the config unless neither the apps nor any other input
+    # changed since the config on disk was generated. The fingerprint of
+    # the inputs is kept next to the config.
+    haproxy_dir = os.path.dirname(config_file)
+    state_file = os.path.join(haproxy_dir, 'apps.fingerprint')
+    files = [config_file,
+             os.path.join(haproxy_dir, 'domain2backend.map'),
+             os.path.join(haproxy_dir, 'app2backend.map')]
+    state = {}
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        pass
+
+    inputs = get_inputs_fingerprint(templater)
+    if state.get('inputs') != inputs or \
+            state.get('files') != get_files_fingerprint(files):
+        state = {}
+
+    raw_apps, etag, last_modified = marathon.list_if_modified(
+        state.get('etag'), state.get('last_modified'))
+    if raw_apps is None:
+        logger.info("apps not modified - skipping config generation")
+        return
+    apps = get_apps_fingerprint(raw_apps, marathon.health_check())
+    if state.get('apps') == apps:
+        logger.info("apps unchanged - skipping config generation")
+        return
+
+    try:
+        os.remove(state_file)
+    except OSError:
+        pass
+    _, config_valid = regenerate_config(marathon, config_file, groups,
+                                        bind_http_https, ssl_certs,
+                                        templater, haproxy_map,
+                                        group_https_by_vhost, raw_apps)
+    if not config_valid:
+        return
+
+    state = {
+        'inputs': inputs,
+        'files': get_files_fingerprint(files),
+        'apps': apps,
+        'etag': etag,
+        'last_modified': last_modified
+    }
+    with open(state_file, 'w') as f:
+        json.dump(state, f)
 
 
 # Build up a valid configuration by adding one app at a time and checking
@@ -1808,54 +2471,96 @@ def make_config_valid_and_regenerate(marathon,
                                      ssl_certs,
                                      templater,
                                      haproxy_map,
-                                     domain_map_array,
-                                     app_map_array,
+                                     domain_map,
+                                     app_map,
                                      config_file,
                                      group_https_by_vhost):
     try:
         start_time = time.time()
         apps = []
-        valid_apps = []
-        excluded_ids = []
-        included_ids = []
-
-        for app in raw_apps:
-            domain_map_array = []
-            app_map_array = []
-            valid_apps.append(app)
-            apps = get_apps(marathon, valid_apps)
+        # Each call to get_apps() gets its own copy of the apps, as it
+        # renames the apps of deployment groups and merges their tasks.
+        raw_apps = list(raw_apps)
+        app_keys = [(app['id'], app.get('version')) for app in raw_apps]
+        validations = [0]
+
+        def is_valid(indexes):
+            validations[0] += 1
+            domain_map = HaproxyMap()
+            app_map = HaproxyMap()
+            apps = get_apps(marathon,
+                            copy_apps(raw_apps[i] for i in indexes),
+                            retain=False)
             generated_config = config(apps, groups, bind_http_https,
                                       ssl_certs, templater, haproxy_map,
-                                      domain_map_array, app_map_array,
-                                      config_file, group_https_by_vhost)
-            config_valid = generateAndValidateTempConfig(generated_config,
-                                                         config_file,
-                                                         domain_map_array,
-                                                         app_map_array,
-                                                         haproxy_map)
-            if not config_valid:
+                                      domain_map, app_map,
+                                      config_file, group_https_by_vhost,
+                                      retain=False)
+            return generateAndValidateTempConfig(generated_config,
+                                                 config_file,
+                                                 domain_map,
+                                                 app_map,
+                                                 haproxy_map)
+
+        def find_valid(valid, candidates, known_invalid=False):
+            # Return the candidates which can be added to the valid apps,
+            # in order. Splitting the candidates in halves finds k invalid
+            # apps out of n in O(k log n) validations.
+            if not candidates:
+                return []
+            if not known_invalid and is_valid(valid + candidates):
+                return candidates
+            if len(candidates) == 1:
                 logger.warn(
                     "invalid configuration caused by app %s; "
-                    "it will be excluded", app["id"])
-                del valid_apps[-1]
-                excluded_ids.append(app["id"])
-            else:
-                included_ids.append(app["id"])
+                    "it will be excluded", app_keys[candidates[0]][0])
+                return []
+            middle = len(candidates) // 2
+            first = find_valid(valid, candidates[:middle])
+            return first + find_valid(valid + first, candidates[middle:])
+
+        indexes = list(range(len(raw_apps)))
+        # Start from the apps which were valid the last time, if the same
+        # versions of the other apps still make the config invalid.
+        previously_invalid = [i for i in indexes
+                              if app_keys[i] in INVALID_APP_VERSIONS]
+        others = [i for i in indexes if app_keys[i] not in
+                  INVALID_APP_VERSIONS]
+        INVALID_APP_VERSIONS.clear()
+        if previously_invalid and is_valid(others):
+            valid_indexes = others
+        elif not is_valid([]):
+            # The apps aren't the problem
+            valid_indexes = []
+        else:
+            valid_indexes = find_valid([], indexes, known_invalid=True)
+        valid_set = set(valid_indexes)
+        excluded = [i for i in indexes if i not in valid_set]
+        if valid_indexes:
+            INVALID_APP_VERSIONS.update(app_keys[i] for i in excluded)
 
-        if len(valid_apps) > 0:
+        if len(valid_indexes) > 0:
             logger.debug("reloading valid config including apps: %s, and "
-                         "excluding apps: %s", included_ids, excluded_ids)
-            domain_map_array = []
-            app_map_array = []
-            apps = get_apps(marathon, valid_apps)
+                         "excluding apps: %s, after %d validations",
+                         [app_keys[i][0] for i in valid_indexes],
+                         [app_keys[i][0] for i in excluded],
+                         validations[0])
+            domain_map = HaproxyMap()
+            app_map = HaproxyMap()
+            # The invalid apps keep their ports, slots and ids, as they
+            # are part of the next regeneration again.
+            apps = get_apps(marathon,
+                            copy_apps(raw_apps[i] for i in valid_indexes),
+                            retain=False)
             valid_config = config(apps, groups, bind_http_https,
                                   ssl_certs, templater, haproxy_map,
-                                  domain_map_array, app_map_array,
-                                  config_file, group_https_by_vhost)
+                                  domain_map, app_map,
+                                  config_file, group_https_by_vhost,
+                                  retain=False)
             compareWriteAndReloadConfig(valid_config,
                                         config_file,
-                                        domain_map_array,
-                                        app_map_array, haproxy_map)
+                                        domain_map,
+                                        app_map, haproxy_map)
         else:
             logger.error("A valid config file could not be generated after "
                          "excluding all apps! skipping reload")
@@ -1868,6 +2573,118 @@ def make_config_valid_and_regenerate(marathon,
         logger.exception("Unexpected error!")
 
 
+class MarathonAppsCache(object):
+    """
+    In-memory copy of the Marathon apps (with their embedded tasks), kept up
+    to date by applying the deltas carried by status_update_event and
+    health_status_changed_event payloads.
+
+    Any event that cannot be applied with certainty (unknown app, unknown
+    task, ambiguous health check) is rejected, and the caller is expected to
+    fall back to fetching the full app list from Marathon.
+    """
+
+    # Task states after which Marathon no longer lists a task for its app
+    terminal_task_states = frozenset([
+        'TASK_FINISHED', 'TASK_FAILED', 'TASK_KILLED', 'TASK_ERROR',
+        'TASK_DROPPED', 'TASK_GONE', 'TASK_GONE_BY_OPERATOR'])
+
+    # status_update_event field -> task field
+    status_update_fields = {
+        'appId': 'appId',
+        'host': 'host',
+        'ports': 'ports',
+        'ipAddresses': 'ipAddresses',
+        'taskStatus': 'state',
+        'version': 'version',
+        'slaveId': 'slaveId',
+    }
+
+    def __init__(self):
+        # appId -> raw app, or None if we have never been reset
+        self.__apps = None
+
+    def is_loaded(self):
+        return self.__apps is not None
+
+    def reset(self, raw_apps):
+        self.__apps = {app['id']: app for app in raw_apps}
+
+    def invalidate(self):
+        self.__apps = None
+
+    def snapshot(self):
+        """
+        Return a copy of the apps which is safe to hand to get_apps(), which
+        rewrites app ids and task lists of apps in deployment groups.
+        """
+        return copy_apps(self.__apps.values())
+
+    def apply_event(self, event):
+        """
+        Apply the event to the cached apps.
+        :return: True if the event was applied, False if the cache could not
+        be updated and all apps must be fetched again.
+        """
+        if self.__apps is None:
+            return False
+        app = self.__apps.get(event.get('appId'))
+        if app is None:
+            return False
+        if event['eventType'] == 'status_update_event':
+            return self._apply_status_update(app, event)
+        if event['eventType'] == 'health_status_changed_event':
+            return self._apply_health_status_changed(app, event)
+        return False
+
+    def _apply_status_update(self, app, event):
+        task_id = event.get('taskId')
+        if not task_id:
+            return False
+        tasks = app.setdefault('tasks', [])
+        for idx, task in enumerate(tasks):
+            if task['id'] == task_id:
+                break
+        else:
+            idx = None
+
+        if event.get('taskStatus') in self.terminal_task_states:
+            if idx is not None:
+                del tasks[idx]
+            return True
+
+        if idx is None:
+            task = {'id': task_id}
+            tasks.append(task)
+        for event_field, task_field in self.status_update_fields.items():
+            if event_field in event:
+                task[task_field] = event[event_field]
+        return True
+
+    def _apply_health_status_changed(self, app, event):
+        # We only track a single result per task, so we can't tell which
+        # result to update if the app has more than one health check.
+        if len(app.get('healthChecks', [])) != 1 or 'alive' not in event:
+            return False
+
+        # Marathon < 1.4 sends the task id, later versions send the instance
+        # id, which prefixes the ids of the tasks belonging to the instance.
+        task_id = event.get('taskId')
+        instance_id = event.get('instanceId')
+        matched = False
+        for task in app.get('tasks', []):
+            if task_id is not None:
+                if task['id'] != task_id:
+                    continue
+            elif instance_id is None or not (
+                    task['id'] == instance_id or
+                    task['id'].startswith(instance_id + '.')):
+                continue
+            task['healthCheckResults'] = [{'alive': event['alive']}]
+            matched = True
+        return matched
+
+
 class MarathonEventProcessor(object):
 
     def __init__(self, marathon,
@@ -1876,10 +2693,15 @@ class MarathonEventProcessor(object):
                  bind_http_https,
                  ssl_certs,
                  haproxy_map,
-                 group_https_by_vhost):
+                 group_https_by_vhost,
+                 incremental=False,
+                 debounce=0,
+                 max_delay=0):
         self.__marathon = marathon
         # appId -> MarathonApp
         self.__apps = dict()
+        self.__incremental = incremental
+        self.__apps_cache = MarathonAppsCache()
         self.__config_file = config_file
         self.__groups = groups
         self.__templater = ConfigTemplater()
@@ -1890,9 +2712,33 @@ class MarathonEventProcessor(object):
         self.__condition = threading.Condition()
         self.__pending_reset = False
         self.__pending_reload = False
+        self.__pending_events = []
         self.__haproxy_map = haproxy_map
 
+        # Coalescing of bursts of events: wait until no new event arrived
+        # for `debounce` seconds, but never delay the first pending event by
+        # more than `max_delay` seconds.
+        self.__debounce = debounce
+        self.__max_delay = max_delay
+        self.__pending_count = 0
+        self.__first_pending_at = 0
+        self.__last_pending_at = 0
+        self.events_received = 0
+        self.updates_done = 0
+
+        # The ids of the apps whose task events can't change the config
+        self.__unserved_app_ids = frozenset()
+        self.events_dropped = 0
+
+        # The snapshot of the apps (or the reload of the existing config)
+        # waiting for the applier thread
+        self.__apply_condition = threading.Condition()
+        self.__next_apps = None
+        self.__next_reload = False
+        self.snapshots_skipped = 0
+
         self.__thread = None
+        self.__applier = None
 
         # Fetch the base data
         self.reset_from_tasks()
@@ -1902,58 +2748,158 @@ class MarathonEventProcessor(object):
         if self.__thread is not None and self.__thread.is_alive():
             self.reset_from_tasks()
             return
+        if self.__applier is None or not self.__applier.is_alive():
+            self.__applier = threading.Thread(target=self.try_apply)
+            self.__applier.start()
         self.__thread = threading.Thread(target=self.try_reset)
         self.__thread.start()
 
     def try_reset(self):
-        with self.__condition:
-            logger.info('({}): starting event processor thread'.format(
-                threading.get_ident()))
-            while True:
-                self.__condition.acquire()
+        # Fetches the apps (or applies events to the cached apps) and queues
+        # them for the applier thread, so that the next snapshot is fetched
+        # while the previous one is still being applied.
+        logger.info('({}): starting event processor thread'.format(
+            threading.get_ident()))
+        while True:
+            with self.__condition:
+                if not self.__stop and \
+                        not self.__pending_reset and \
+                        not self.__pending_reload and \
+                        not self.__pending_events:
+                    if not self.__condition.wait(300):
+                        logger.info('({}): condition wait expired'.format(
+                            threading.get_ident()))
 
                 if self.__stop:
                     logger.info('({}): stopping event processor thread'.format(
                         threading.get_ident()))
-                    self.__condition.release()
                     return
 
-                if not self.__pending_reset and not self.__pending_reload:
-                    if not self.__condition.wait(300):
-                        logger.info('({}): condition wait expired'.format(
-                            threading.get_ident()))
+                self.__wait_for_quiet_period()
+                self.__log_coalesced()
 
                 pending_reset = self.__pending_reset
                 pending_reload = self.__pending_reload
+                pending_events = self.__pending_events
                 self.__pending_reset = False
                 self.__pending_reload = False
+                self.__pending_events = []
+
+            # Reset takes precedence over events, which take precedence
+            # over reload
+            if pending_reset:
+                self.do_reset()
+            elif pending_events:
+                self.do_apply_events(pending_events)
+            elif pending_reload:
+                self.__queue(reload=True)
+            else:
+                # Timed out waiting on the condition variable, just do a
+                # full reset for good measure (as was done before).
+                self.do_reset()
+
+    def try_apply(self):
+        # Generates and applies the config for the latest queued snapshot of
+        # the apps. Snapshots queued while the previous one is being applied
+        # replace each other, so only the latest one is applied.
+        logger.info('({}): starting config applier thread'.format(
+            threading.get_ident()))
+        while True:
+            with self.__apply_condition:
+                while not self.__stop and self.__next_apps is None and \
+                        not self.__next_reload:
+                    self.__apply_condition.wait()
 
-                self.__condition.release()
+                if self.__stop:
+                    logger.info('({}): stopping config applier thread'.format(
+                        threading.get_ident()))
+                    return
 
-                # Reset takes precedence over reload
-                if pending_reset:
-                    self.do_reset()
-                elif pending_reload:
-                    self.do_reload()
-                else:
-                    # Timed out waiting on the condition variable, just do a
-                    # full reset for good measure (as was done before).
-                    self.do_reset()
+                raw_apps = self.__next_apps
+                reload = self.__next_reload
+                self.__next_apps = None
+                self.__next_reload = False
+
+            if raw_apps is not None:
+                self.do_regenerate(raw_apps)
+            elif reload:
+                self.do_reload()
+
+    def __queue(self, raw_apps=None, reload=False):
+        with self.__apply_condition:
+            if raw_apps is not None:
+                if self.__next_apps is not None:
+                    self.snapshots_skipped += 1
+                self.__next_apps = raw_apps
+            self.__next_reload = self.__next_reload or reload
+            self.__apply_condition.notify()
 
     def do_reset(self):
         try:
             start_time = time.time()
 
-            self.__apps = regenerate_config(self.__marathon,
-                                            self.__config_file,
-                                            self.__groups,
-                                            self.__bind_http_https,
-                                            self.__ssl_certs,
-                                            self.__templater,
-                                            self.__haproxy_map,
-                                            self.__group_https_by_vhost)
+            # Don't drop any events until we know which apps we serve
+            self.__unserved_app_ids = frozenset()
+            if self.__incremental:
+                # Drop the cache first so that a failed fetch can't leave us
+                # applying events to stale state
+                self.__apps_cache.invalidate()
+                self.__apps_cache.reset(self.__marathon.list())
+                raw_apps = self.__apps_cache.snapshot()
+            else:
+                raw_apps = self.__marathon.list()
+            # All the apps are kept in memory until they're regenerated:
+            # they're handed over to the thread which applies them, which
+            # needs them again to find the apps which make the config
+            # invalid, and the apps we don't serve are only known once
+            # they've all been seen.
+            self.__unserved_app_ids = get_unserved_app_ids(self.__groups,
+                                                           raw_apps)
+            self.__queue(raw_apps)
+
+            logger.debug("({0}): fetching apps finished, "
+                         "took {1} seconds".format(
+                             threading.get_ident(),
+                             time.time() - start_time))
+        except requests.exceptions.ConnectionError as e:
+            logger.error("({0}): Connection error({1}): {2}".format(
+                threading.get_ident(), e.errno, e.strerror))
+        except Exception:
+            logger.exception("Unexpected error!")
 
-            logger.debug("({0}): updating tasks finished, "
+    def do_apply_events(self, events):
+        for event in events:
+            if not self.__apps_cache.apply_event(event):
+                logger.debug("({0}): unable to apply {1} for {2} "
+                             "incrementally, fetching all apps".format(
+                                 threading.get_ident(),
+                                 event['eventType'],
+                                 event.get('appId')))
+                self.do_reset()
+                return
+
+        try:
+            self.__queue(self.__apps_cache.snapshot())
+            logger.debug("({0}): applied {1} events to the cached "
+                         "apps".format(threading.get_ident(), len(events)))
+        except Exception:
+            logger.exception("Unexpected error!")
+
+    def do_regenerate(self, raw_apps):
+        try:
+            start_time = time.time()
+
+            self.__apps, _ = regenerate_config(self.__marathon,
+                                               self.__config_file,
+                                               self.__groups,
+                                               self.__bind_http_https,
+                                               self.__ssl_certs,
+                                               self.__templater,
+                                               self.__haproxy_map,
+                                               self.__group_https_by_vhost,
+                                               raw_apps)
+
+            logger.debug("({0}): updating config finished, "
                          "took {1} seconds".format(
                              threading.get_ident(),
                              time.time() - start_time))
@@ -1974,28 +2920,93 @@ class MarathonEventProcessor(object):
         except Exception:
             logger.exception("Unexpected error!")
 
+    def __wait_for_quiet_period(self):
+        # Must be called with the condition held
+        while self.__pending_count > 0 and not self.__stop:
+            wake_at = min(self.__last_pending_at + self.__debounce,
+                          self.__first_pending_at + self.__max_delay)
+            remaining = wake_at - time.time()
+            if remaining <= 0:
+                return
+            self.__condition.wait(remaining)
+
+    def __log_coalesced(self):
+        # Must be called with the condition held
+        if self.__pending_count == 0:
+            return
+        self.updates_done += 1
+        logger.info("({0}): coalesced {1} events into one update, the "
+                    "oldest waited {2:.3f} seconds ({3} events in {4} "
+                    "updates so far)".format(
+                        threading.get_ident(),
+                        self.__pending_count,
+                        time.time() - self.__first_pending_at,
+                        self.events_received,
+                        self.updates_done))
+        self.__pending_count = 0
+
+    def __mark_pending(self):
+        # Must be called with the condition held
+        now = time.time()
+        if self.__pending_count == 0:
+            self.__first_pending_at = now
+        self.__last_pending_at = now
+        self.__pending_count += 1
+        self.events_received += 1
+        self.__condition.notify()
+
     def stop(self):
         self.__condition.acquire()
         self.__stop = True
         self.__condition.notify()
         self.__condition.release()
+        with self.__apply_condition:
+            self.__apply_condition.notify()
 
     def reset_from_tasks(self):
         self.__condition.acquire()
         self.__pending_reset = True
-        self.__condition.notify()
+        self.__mark_pending()
         self.__condition.release()
 
     def reload_existing_config(self):
         self.__condition.acquire()
         self.__pending_reload = True
-        self.__condition.notify()
+        self.__mark_pending()
         self.__condition.release()
 
+    def apply_event(self, event):
+        self.__condition.acquire()
+        self.__pending_events.append(event)
+        self.__mark_pending()
+        self.__condition.release()
+
+    def is_relevant(self, data):
+        """
+        Peek at the type and app id of an event, without decoding it, and
+        return whether it can change the config. The task events of the
+        apps which aren't in our groups can't.
+        """
+        match = EVENT_TYPE_PATTERN.search(data)
+        if match is None or match.group(1) not in TASK_EVENT_TYPES:
+            return True
+        match = EVENT_APP_ID_PATTERN.search(data)
+        if match is None or match.group(1) not in self.__unserved_app_ids:
+            return True
+        self.events_dropped += 1
+        return False
+
     def handle_event(self, event):
         if event['eventType'] == 'status_update_event' or \
-           event['eventType'] == 'health_status_changed_event' or \
-           event['eventType'] == 'api_post_event':
+           event['eventType'] == 'health_status_changed_event':
+            if self.__incremental:
+                self.apply_event(event)
+            else:
+                self.reset_from_tasks()
+        elif event['eventType'] == 'api_post_event':
+            # The app may have been moved into one of our groups, so keep
+            # its events until the apps have been fetched again.
+            self.__unserved_app_ids = frozenset()
             self.reset_from_tasks()
 
     def handle_signal(self, sig, stack):
@@ -2009,6 +3020,103 @@ class MarathonEventProcessor(object):
             logger.warning('received unknown signal %d' % (sig,))
 
 
+class MarathonPoller(object):
+    """
+    Polls Marathon every `interval` seconds (plus or minus `jitter` times
+    the interval, so that several instances don't poll in lockstep) and
+    regenerates the config when something changed, keeping the process, its
+    caches and its connections to Marathon alive between polls.
+    """
+
+    def __init__(self, marathon,
+                 config_file,
+                 groups,
+                 bind_http_https,
+                 ssl_certs,
+                 haproxy_map,
+                 group_https_by_vhost,
+                 interval,
+                 jitter=0):
+        self.__marathon = marathon
+        self.__config_file = config_file
+        self.__groups = groups
+        self.__templater = ConfigTemplater()
+        self.__bind_http_https = bind_http_https
+        self.__ssl_certs = ssl_certs
+        self.__haproxy_map = haproxy_map
+        self.__group_https_by_vhost = group_https_by_vhost
+        self.__interval = interval
+        self.__jitter = jitter
+
+        self.__wakeup = threading.Event()
+        self.__pending_reload = False
+        self.__stop = False
+        self.polls_done = 0
+
+    def next_delay(self):
+        return self.__interval * \
+            (1 + self.__jitter * (2 * random.random() - 1))
+
+    def run(self):
+        while not self.__stop:
+            if self.__pending_reload:
+                self.__pending_reload = False
+                self.do_reload()
+            else:
+                self.do_poll()
+            self.__wakeup.wait(self.next_delay())
+            self.__wakeup.clear()
+
+    def do_poll(self):
+        try:
+            start_time = time.time()
+            regenerate_config_if_changed(self.__marathon,
+                                         self.__config_file,
+                                         self.__groups,
+                                         self.__bind_http_https,
+                                         self.__ssl_certs,
+                                         self.__templater,
+                                         self.__haproxy_map,
+                                         self.__group_https_by_vhost)
+            self.polls_done += 1
+            logger.debug("poll finished, took {0} seconds".format(
+                time.time() - start_time))
+        except requests.exceptions.ConnectionError as e:
+            logger.error("Connection error({0}): {1}".format(
+                e.errno, e.strerror))
+        except Exception:
+            logger.exception("Unexpected error!")
+
+    def do_reload(self):
+        try:
+            logger.debug("attempting to reload existing config...")
+            if validateConfig(self.__config_file):
+                reloadConfig()
+        except Exception:
+            logger.exception("Unexpected error!")
+
+    def stop(self):
+        self.__stop = True
+        self.__wakeup.set()
+
+    def poll_now(self):
+        self.__wakeup.set()
+
+    def reload_existing_config(self):
+        self.__pending_reload = True
+        self.__wakeup.set()
+
+    def handle_signal(self, sig, stack):
+        if sig == signal.SIGHUP:
+            logger.debug('received signal SIGHUP - polling now')
+            self.poll_now()
+        elif sig == signal.SIGUSR1:
+            logger.debug('received signal SIGUSR1 - reloading existing config')
+            self.reload_existing_config()
+        else:
+            logger.warning('received unknown signal %d' % (sig,))
+
+
 def get_arg_parser():
     parser = argparse.ArgumentParser(
         description="Marathon HAProxy Load Balancer",
@@ -2021,6 +3129,21 @@ def get_arg_parser():
                         help="[required] Marathon endpoint, eg. " +
                         "-m http://marathon1:8080 http://marathon2:8080",
                         default=["http://master.mesos:8080"])
+    parser.add_argument("--marathon-pool-size",
+                        help="Number of keep-alive connections to keep open"
+                        " to each Marathon endpoint",
+                        type=int, default=10)
+    parser.add_argument("--marathon-retries",
+                        help="Number of times to retry an idempotent request"
+                        " to Marathon which got a 502, 503 or 504 response."
+                        " Requests which fail to connect are sent to the next"
+                        " Marathon endpoint instead",
+                        type=int, default=3)
+    parser.add_argument("--compact-apps",
+                        help="Only keep the fields of the apps and tasks"
+                        " fetched from Marathon which marathon-lb uses,"
+                        " which reduces the memory used for large clusters",
+                        action="store_true")
     parser.add_argument("--haproxy-config",
                         help="Location of haproxy configuration",
                         default="/etc/haproxy/haproxy.cfg")
@@ -2050,6 +3173,52 @@ def get_arg_parser():
     parser.add_argument("--sse", "-s",
                         help="Use Server Sent Events",
                         action="store_true")
+    parser.add_argument("--poll-interval",
+                        help="Without --sse, keep running and poll Marathon"
+                        " every this number of seconds instead of exiting"
+                        " after generating the config once. Set to 0 to"
+                        " poll once and exit.",
+                        type=float, default=0)
+    parser.add_argument("--poll-jitter",
+                        help="With --poll-interval, randomly shorten or"
+                        " lengthen each interval by up to this fraction of"
+                        " it, so that several instances don't poll Marathon"
+                        " at the same time.",
+                        type=float, default=0.1)
+    parser.add_argument("--incremental-updates",
+                        help="Apply the task status and health check events"
+                        " received with --sse to an in-memory copy of the"
+                        " Marathon apps instead of fetching all apps for"
+                        " every event. All apps are still fetched on"
+                        " startup, on stream reconnect, on api_post_event"
+                        " and on SIGHUP.",
+                        action="store_true")
+    parser.add_argument("--event-debounce",
+                        help="With --sse, wait until no new event has been"
+                        " received for this number of seconds before"
+                        " updating the config, so that bursts of events"
+                        " result in a single reload. Set to 0 to disable.",
+                        type=float, default=0.5)
+    parser.add_argument("--event-max-delay",
+                        help="With --sse, never delay applying an event by"
+                        " more than this number of seconds, however busy"
+                        " the event stream is.",
+                        type=float, default=5)
+    parser.add_argument("--runtime-api",
+                        help="Apply config changes which only affect the"
+                        " address, weight or enabled state of existing"
+                        " backend servers through the HAProxy stats socket"
+                        " instead of reloading HAProxy.",
+                        action="store_true")
+    parser.add_argument("--server-slots",
+                        help="Emit each backend with a pool of at least this"
+                        " many server slots (rounded up to a power of two),"
+                        " so that tasks can be added and removed through"
+                        " --runtime-api without reloading HAProxy. Can be"
+                        " overridden per app with the"
+                        " HAPROXY_{n}_BACKEND_SERVER_SLOTS label. Set to 0 to"
+                        " disable.",
+                        type=int, default=0)
     parser.add_argument("--archive-versions",
                         help="Number of config versions to archive",
                         type=int, default=5)
@@ -2128,6 +3297,10 @@ if __name__ == '__main__':
             arg_parser.error(
                 'cannot set --min-serv-port-ip-per-task to a higher value '
                 'than --max-serv-port-ip-per-task')
+        if args.poll_interval < 0 or not 0 <= args.poll_jitter < 1:
+            arg_parser.error(
+                '--poll-interval must not be negative and --poll-jitter '
+                'must be at least 0 and less than 1')
         if len(args.group) == 0:
             arg_parser.error('argument --group is required: please' +
                              'specify at least one group name')
@@ -2137,10 +3310,16 @@ if __name__ == '__main__':
         SERVICE_PORT_ASSIGNER.set_ports(args.min_serv_port_ip_per_task,
                                         args.max_serv_port_ip_per_task)
 
-    # Set request retries
-    s = requests.Session()
-    a = requests.adapters.HTTPAdapter(max_retries=3)
-    s.mount('http://', a)
+    # Keep the servers in the slots and with the ids they have in the
+    # running config.
+    SERVER_SLOT_ASSIGNER.set_default_slots(args.server_slots)
+    try:
+        with open(args.haproxy_config, 'r') as f:
+            running_config = f.read()
+        SERVER_SLOT_ASSIGNER.load(running_config)
+        SERVER_ID_ASSIGNER.load(running_config)
+    except IOError:
+        pass
 
     # Setup logging
     setup_logging(logger, args.syslog_socket, args.log_format, args.log_level)
@@ -2155,7 +3334,10 @@ if __name__ == '__main__':
                         args.health_check,
                         args.strict_mode,
                         get_marathon_auth_params(args),
-                        args.marathon_ca_cert)
+                        args.marathon_ca_cert,
+                        args.marathon_pool_size,
+                        args.marathon_retries,
+                        args.compact_apps)
 
     # If we're going to be handling events, set up the event processor and
     # hook it up to the process signals.
@@ -2166,7 +3348,10 @@ if __name__ == '__main__':
                                            not args.dont_bind_http_https,
                                            args.ssl_certs,
                                            args.haproxy_map,
-                                           args.group_https_by_vhost)
+                                           args.group_https_by_vhost,
+                                           args.incremental_updates,
+                                           args.event_debounce,
+                                           args.event_max_delay)
         signal.signal(signal.SIGHUP, processor.handle_signal)
         signal.signal(signal.SIGUSR1, processor.handle_signal)
         backoffFactor = 1.5
@@ -2183,17 +3368,20 @@ if __name__ == '__main__':
                 processor.start()
                 events = marathon.iter_events(stream)
                 for event in events:
-                    if (event.data.strip() != ''):
-                        # marathon sometimes sends more than one json per event
-                        # e.g. {}\r\n{}\r\n\r\n
-                        for real_event_data in re.split(r'\r\n', event.data):
-                                data = load_json(real_event_data)
-                                logger.info(
-                                    "received event of type {0}"
-                                    .format(data['eventType']))
-                                processor.handle_event(data)
-                    else:
+                    # marathon sometimes sends more than one json per event
+                    # e.g. data: {}\r\ndata: {}\r\n\r\n, which are
+                    # iterated over separately
+                    if (event.data.strip() == ''):
                         logger.info("skipping empty message")
+                    elif not processor.is_relevant(event.data):
+                        logger.debug("skipping event of an app which isn't"
+                                     " in our groups")
+                    else:
+                        data = load_json(event.data)
+                        logger.info(
+                            "received event of type {0}"
+                            .format(data['eventType']))
+                        processor.handle_event(data)
             except pycurl.error as e:
                 errno, e_msg = e.args
                 # Error number 28:
@@ -2230,13 +3418,26 @@ if __name__ == '__main__':
                     waitSeconds = 3
                 time.sleep(currentWaitSeconds)
         processor.stop()
+    elif args.poll_interval > 0:
+        poller = MarathonPoller(marathon,
+                                args.haproxy_config,
+                                args.group,
+                                not args.dont_bind_http_https,
+                                args.ssl_certs,
+                                args.haproxy_map,
+                                args.group_https_by_vhost,
+                                args.poll_interval,
+                                args.poll_jitter)
+        signal.signal(signal.SIGHUP, poller.handle_signal)
+        signal.signal(signal.SIGUSR1, poller.handle_signal)
+        poller.run()
     else:
         # Generate base config
-        regenerate_config(marathon,
-                          args.haproxy_config,
-                          args.group,
-                          not args.dont_bind_http_https,
-                          args.ssl_certs,
-                          ConfigTemplater(),
-                          args.haproxy_map,
-                          args.group_https_by_vhost)
+        regenerate_config_if_changed(marathon,
+                                     args.haproxy_config,
+                                     args.group,
+                                     not args.dont_bind_http_https,
+                                     args.ssl_certs,
+                                     ConfigTemplater(),
+                                     args.haproxy_map,
+                                     args.group_https_by_vhost)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Helpers to update a running HAProxy through its runtime API (the stats
+socket) instead of reloading it.
+
+Only changes which are confined to map entries and to the address, port,
+weight and enabled/disabled state of backend servers which already exist in
+the running HAProxy can be applied this way (see config_diff). Everything
+else requires a reload.
+"""
+
+import logging
+import socket
+
+logger = logging.getLogger('marathon_lb')
+
+# Responses of `set server` and `set weight` which indicate success. Any
+# other response is treated as an error.
+SUCCESS_PREFIXES = ('IP changed', 'port changed', 'no need to change')
+
+
+class RuntimeApiError(Exception):
+    pass
+
+
+class RuntimeApi(object):
+    def __init__(self, socket_path, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def execute(self, command):
+        """
+        Run a single command in non-interactive mode and return its output.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall((command + '\n').encode('utf-8'))
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except OSError as ex:
+            raise RuntimeApiError("{0}: {1}".format(command, ex))
+        finally:
+            sock.close()
+        return b''.join(chunks).decode('utf-8', 'replace')
+
+    def show_info(self):
+        """
+        Return the fields of `show info` as a dict.
+        """
+        info = {}
+        for line in self.execute('show info').splitlines():
+            key, sep, value = line.partition(':')
+            if sep:
+                info[key.strip()] = value.strip()
+        return info
+
+    def update(self, command):
+        """
+        Run a command which changes state and raise RuntimeApiError unless
+        HAProxy reported success.
+        """
+        output = self.execute(command).strip()
+        if output and not output.startswith(SUCCESS_PREFIXES):
+            raise RuntimeApiError("{0}: {1}".format(command, output))
+        return output
+
+
+def get_stats_socket(config):
+    for line in config.splitlines():
+        words = line.split()
+        if len(words) >= 3 and words[:2] == ['stats', 'socket']:
+            return words[2]
+    return None
+
+
+def get_stats_socket_level(config):
+    """
+    Return the level of the socket get_stats_socket() returns. HAProxy only
+    accepts `set server` and `set weight` at the admin level, while sockets
+    which don't set one are at the operator level.
+    """
+    for line in config.splitlines():
+        words = line.split()
+        if len(words) >= 3 and words[:2] == ['stats', 'socket']:
+            options = words[3:]
+            if 'level' in options[:-1]:
+                return options[options.index('level') + 1]
+            return 'operator'
+    return None
+
+
+def apply_commands(socket_path, commands):
+    """
+    Apply the commands in order. Returns False if any of them failed.
+    """
+    api = RuntimeApi(socket_path)
+    for command in commands:
+        logger.debug("runtime API: %s", command)
+        try:
+            api.update(command)
+        except RuntimeApiError as ex:
+            logger.warning("runtime API command failed: %s", ex)
+            return False
+    return True
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of decoding the /v2/apps?embed=apps.tasks response.
+
+Builds a synthetic response from the apps in tests/marathon15_apps.json and
+compares decoding it in one go (response.json() plus cleanup_json), with
+streaming decoding (Marathon.iter_apps) and with streaming decoding of
+compact apps (--compact-apps).
+
+Marathon can't leave out fields, so the number of bytes transferred is the
+same for all of them; what differs is the time spent decoding and the size
+of the apps which are kept in memory.
+
+Run from the repository root:
+
+    python -m tests.benchmark_apps [--apps N] [--tasks N]
+"""
+
+import argparse
+import copy
+import json
+import time
+
+from common import cleanup_json
+from utils import compact_app, drop_null_values, iter_json_array
+
+
+def make_response(num_apps, num_tasks):
+    with open('tests/marathon15_apps.json') as data_file:
+        template = json.load(data_file)['apps'][0]
+    apps = []
+    for i in range(num_apps):
+        app = copy.deepcopy(template)
+        app['id'] = '/app-%d' % i
+        task = app['tasks'][0]
+        app['tasks'] = []
+        for j in range(num_tasks):
+            task = copy.deepcopy(task)
+            task['id'] = 'app-%d.%d' % (i, j)
+            app['tasks'].append(task)
+        apps.append(app)
+    return json.dumps({'apps': apps}).encode('utf-8')
+
+
+def chunked(body, size=65536):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+def decode_whole(body):
+    return cleanup_json(json.loads(body.decode('utf-8')))['apps']
+
+
+def decode_streaming(body):
+    return list(iter_json_array(chunked(body), 'apps', drop_null_values))
+
+
+def decode_compact(body):
+    return [compact_app(app) for app in
+            iter_json_array(chunked(body), 'apps', drop_null_values)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--apps', type=int, default=1000)
+    parser.add_argument('--tasks', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    body = make_response(args.apps, args.tasks)
+    print("%d apps with %d tasks each, %d bytes transferred" %
+          (args.apps, args.tasks, len(body)))
+    for name, decode in [('whole', decode_whole),
+                         ('streaming', decode_streaming),
+                         ('compact', decode_compact)]:
+        timings = []
+        for _ in range(args.runs):
+            start = time.time()
+            apps = decode(body)
+            timings.append(time.time() - start)
+        print("%-10s decode %.3fs, %d bytes of apps kept" %
+              (name, min(timings), len(json.dumps(apps))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of merging the apps of blue/green deployment groups in get_apps.
+
+Builds a number of deployment groups from the blue and green apps in
+tests/zdd_apps.json, each with its own timestamps, and compares get_apps
+parsing the deployment timestamps with dateutil (as it used to) with
+marathon_lb.parse_timestamp, both when it parses them for the first time
+and when they were parsed by a previous regeneration.
+
+Run from the repository root:
+
+    python -m tests.benchmark_deployment_groups [--groups N]
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import time
+
+import dateutil.parser
+from mock import patch
+
+import marathon_lb
+
+
+class Marathon(object):
+
+    def health_check(self):
+        return True
+
+    def strict_mode(self):
+        return False
+
+
+def make_apps(num_groups):
+    with open('tests/zdd_apps.json') as data_file:
+        green, blue = json.load(data_file)['apps']
+    green['labels']['HAPROXY_DEPLOYMENT_NEW_INSTANCES'] = '1'
+    apps = []
+    for i in range(num_groups):
+        for template in (green, blue):
+            app = copy.deepcopy(template)
+            app['id'] = '{0}-{1}'.format(app['id'], i)
+            app['labels']['HAPROXY_DEPLOYMENT_GROUP'] = 'nginx-%d' % i
+            app['labels']['HAPROXY_0_PORT'] = str(10000 + i)
+            # Marathon's timestamps are in milliseconds and UTC, zdd.py's
+            # in microseconds and local time.
+            started_at = marathon_lb.parse_timestamp(
+                app['labels']['HAPROXY_DEPLOYMENT_STARTED_AT']) + \
+                datetime.timedelta(seconds=i)
+            scaled_at = started_at + datetime.timedelta(hours=8)
+            app['labels']['HAPROXY_DEPLOYMENT_STARTED_AT'] = \
+                started_at.isoformat()
+            app['versionInfo']['lastScalingAt'] = \
+                scaled_at.isoformat()[:23] + 'Z'
+            apps.append(app)
+    return apps
+
+
+def run(apps, runs):
+    timings = []
+    for _ in range(runs):
+        apps_copy = copy.deepcopy(apps)
+        start = time.time()
+        services = marathon_lb.get_apps(Marathon(), apps_copy)
+        timings.append(time.time() - start)
+    return min(timings), len(services)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--groups', type=int, default=300)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    apps = make_apps(args.groups)
+    print("%d deployment groups of 2 apps" % args.groups)
+    with patch('marathon_lb.parse_timestamp', dateutil.parser.parse):
+        timing, num_services = run(apps, args.runs)
+    print("%-10s get_apps %.3fs, %d services" %
+          ('dateutil', timing, num_services))
+    marathon_lb.PARSED_TIMESTAMPS.cache.clear()
+    timing, num_services = run(apps, 1)
+    print("%-10s get_apps %.3fs, %d services" %
+          ('parsed', timing, num_services))
+    timing, num_services = run(apps, args.runs)
+    print("%-10s get_apps %.3fs, %d services" %
+          ('memoized', timing, num_services))
+
+
+if __name__ == '__main__':
+    main()
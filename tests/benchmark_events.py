@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of splitting the Marathon event stream into event payloads.
+
+Replays an event stream in the chunks curl hands them to us, and compares
+the previous way of splitting it (copying the received buffer for every
+chunk, splitting the pending data and each chunk into lines and splitting
+each decoded line again) with utils.EventStreamParser.
+
+The stream is either a recording of /v2/events (e.g. captured with
+`curl -N -H 'Accept: text/event-stream' $MARATHON/v2/events > events.txt`)
+or a synthetic one made of status_update_events and api_post_events
+carrying the apps in tests/marathon15_apps.json.
+
+Run from the repository root:
+
+    python -m tests.benchmark_events [--stream FILE] [--events N]
+"""
+
+import argparse
+from io import BytesIO
+import json
+import re
+import time
+
+from utils import EventStreamParser
+
+
+def make_stream(num_events, app_size):
+    with open('tests/marathon15_apps.json') as data_file:
+        app = json.load(data_file)['apps'][0]
+    app['labels'] = {'LABEL_%d' % i: 'x' * 100 for i in range(app_size)}
+    events = []
+    for i in range(num_events):
+        if i % 10 == 0:
+            event = {'eventType': 'api_post_event',
+                     'appDefinition': app}
+        else:
+            event = {'eventType': 'status_update_event',
+                     'appId': '/app-%d' % i,
+                     'taskId': 'app-%d.1' % i,
+                     'taskStatus': 'TASK_RUNNING',
+                     'host': '10.0.0.1',
+                     'ports': [31000 + i],
+                     'ipAddresses': [{'ipAddress': '10.0.0.1'}]}
+        events.append('event: {0}\r\ndata: {1}\r\n\r\n'.format(
+            event['eventType'], json.dumps(event)))
+    return ''.join(events).encode('utf-8')
+
+
+def chunked(body, size):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+def split_lines_from_chunks(chunks):
+    # The line splitting CurlHttpEventStream used to do
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        for line in lines:
+            yield line
+    if pending is not None:
+        yield pending
+
+
+def split_previous(body, size):
+    received_buffer = BytesIO()
+
+    def iter_chunks():
+        for chunk in chunked(body, size):
+            received_buffer.write(chunk)
+            result = received_buffer.getvalue()
+            received_buffer.truncate(0)
+            received_buffer.seek(0)
+            yield result
+
+    payloads = []
+    for line in split_lines_from_chunks(iter_chunks()):
+        if line.strip() != '':
+            for data in re.split(r'\r\n', line.decode('utf-8')):
+                if data[:6] == "data: ":
+                    payloads.extend(re.split(r'\r\n', data[6:]))
+    return payloads
+
+
+def split_parser(body, size):
+    parser = EventStreamParser()
+    payloads = []
+    for chunk in chunked(body, size):
+        parser.feed(chunk)
+        payloads.extend(parser.pop_payloads())
+    return payloads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--stream', help='Recorded event stream to replay')
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--app-size', type=int, default=100,
+                        help='Number of labels of the posted apps')
+    parser.add_argument('--chunk-size', type=int, default=16384)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.stream:
+        with open(args.stream, 'rb') as stream_file:
+            body = stream_file.read()
+    else:
+        body = make_stream(args.events, args.app_size)
+    print("%d bytes in chunks of %d bytes" % (len(body), args.chunk_size))
+    for name, split in [('previous', split_previous),
+                        ('parser', split_parser)]:
+        timings = []
+        for _ in range(args.runs):
+            start = time.time()
+            payloads = split(body, args.chunk_size)
+            timings.append(time.time() - start)
+        print("%-10s split %.3fs, %d payloads" %
+              (name, min(timings), len(payloads)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import unittest
+
+from config_diff import (ACTION_MAPS, ACTION_NONE, ACTION_RELOAD,
+                         ACTION_RUNTIME, ConfigDiff, MapDiff)
+
+RUNNING_CONFIG = '''global
+  stats socket /var/run/haproxy/socket expose-fd listeners level admin
+defaults
+  timeout connect 3s
+frontend nginx_10000
+  bind *:10000
+  mode http
+  use_backend nginx_10000
+
+backend nginx_10000
+  balance roundrobin
+  mode http
+  server agent1_1_1_1_1_1024 1.1.1.1:1024 id 1 check
+  server agent2_2_2_2_2_1025 2.2.2.2:1025 id 2 check
+'''
+
+DOMAIN_MAP = '/etc/haproxy/domain2backend.map'
+
+
+class TestConfigDiff(unittest.TestCase):
+
+    def test_identical_config(self):
+        diff = ConfigDiff(RUNNING_CONFIG, RUNNING_CONFIG)
+        self.assertFalse(diff.changed)
+        self.assertEqual(diff.action, ACTION_NONE)
+        self.assertEqual(diff.commands(), [])
+        self.assertEqual(diff.summary(), 'no effective changes')
+
+    def test_server_address_and_state_changes(self):
+        new_config = RUNNING_CONFIG.replace(
+            '2.2.2.2:1025 id 2 check',
+            '3.3.3.3:1026 id 2 check disabled').replace(
+            '1.1.1.1:1024 id 1 check',
+            '1.1.1.1:1024 id 1 check weight 10')
+        diff = ConfigDiff(RUNNING_CONFIG, new_config)
+        self.assertEqual(diff.action, ACTION_RUNTIME)
+        self.assertEqual(
+            diff.commands(),
+            ['set weight nginx_10000/agent1_1_1_1_1_1024 10',
+             'set server nginx_10000/agent2_2_2_2_2_1025 state maint',
+             'set server nginx_10000/agent2_2_2_2_2_1025 addr 3.3.3.3 '
+             'port 1026'])
+        self.assertEqual(diff.summary(), '2 servers updated')
+
+    def test_enabling_server_sets_address_first(self):
+        running_config = RUNNING_CONFIG.replace(
+            '2.2.2.2:1025 id 2 check', '0.0.0.0:1 id 2 check disabled')
+        self.assertEqual(
+            ConfigDiff(running_config, RUNNING_CONFIG).commands(),
+            ['set server nginx_10000/agent2_2_2_2_2_1025 addr 2.2.2.2 '
+             'port 1025',
+             'set server nginx_10000/agent2_2_2_2_2_1025 state ready'])
+
+    def test_other_changes_need_reload(self):
+        added_server = RUNNING_CONFIG + \
+            '  server agent3_3_3_3_3_1026 3.3.3.3:1026 id 3 check\n'
+        renamed_server = RUNNING_CONFIG.replace(
+            'server agent2_2_2_2_2_1025', 'server agent3_3_3_3_3_1026')
+        changed_option = RUNNING_CONFIG.replace('id 2 check', 'id 2')
+        changed_backend = RUNNING_CONFIG.replace('balance roundrobin',
+                                                 'balance leastconn')
+        host_name = RUNNING_CONFIG.replace('2.2.2.2:1025', 'agent2:1025')
+        for running_config, new_config in [
+                (RUNNING_CONFIG, added_server),
+                (RUNNING_CONFIG, renamed_server),
+                (RUNNING_CONFIG, changed_option),
+                (RUNNING_CONFIG, changed_backend),
+                (host_name, RUNNING_CONFIG),
+                ('', RUNNING_CONFIG)]:
+            self.assertEqual(
+                ConfigDiff(running_config, new_config).action,
+                ACTION_RELOAD)
+
+    def test_summary(self):
+        new_config = RUNNING_CONFIG.replace(
+            'balance roundrobin', 'balance leastconn').replace(
+            'server agent1_1_1_1_1_1024 1.1.1.1:1024 id 1 check\n', '') + \
+            '''  server agent3_3_3_3_3_1026 3.3.3.3:1026 id 3 check
+
+backend nginx_10001
+  balance roundrobin
+'''
+        diff = ConfigDiff(RUNNING_CONFIG, new_config)
+        self.assertEqual(diff.added_sections, ['backend nginx_10001'])
+        self.assertEqual(diff.changed_sections, ['backend nginx_10000'])
+        self.assertEqual(diff.added_servers,
+                         ['nginx_10000/agent3_3_3_3_3_1026'])
+        self.assertEqual(diff.removed_servers,
+                         ['nginx_10000/agent1_1_1_1_1_1024'])
+        self.assertEqual(diff.summary(),
+                         'added backend nginx_10001; '
+                         'changed backend nginx_10000; '
+                         '1 servers added; 1 servers removed')
+
+    def test_server_enables(self):
+        running_config = RUNNING_CONFIG.replace(
+            'id 2 check', 'id 2 check disabled')
+        new_config = RUNNING_CONFIG.replace(
+            'balance roundrobin', 'balance leastconn')
+        diff = ConfigDiff(running_config, new_config)
+        self.assertEqual(diff.action, ACTION_RELOAD)
+        self.assertEqual(
+            diff.server_enables(),
+            ['set server nginx_10000/agent2_2_2_2_2_1025 state ready'])
+
+    def test_map_changes(self):
+        running_map = 'a.example.com nginx_10000\nb.example.com nginx_10001\n'
+        new_map = 'b.example.com nginx_10002\nc.example.com nginx_10000\n'
+        diff = ConfigDiff(RUNNING_CONFIG, RUNNING_CONFIG,
+                          {DOMAIN_MAP: running_map}, {DOMAIN_MAP: new_map})
+        self.assertTrue(diff.changed)
+        self.assertEqual(diff.action, ACTION_MAPS)
+        self.assertEqual(
+            diff.commands(),
+            ['del map {0} a.example.com'.format(DOMAIN_MAP),
+             'set map {0} b.example.com nginx_10002'.format(DOMAIN_MAP),
+             'add map {0} c.example.com nginx_10000'.format(DOMAIN_MAP)])
+
+        new_config = RUNNING_CONFIG.replace('id 2 check',
+                                            'id 2 check weight 2')
+        diff = ConfigDiff(RUNNING_CONFIG, new_config,
+                          {DOMAIN_MAP: running_map}, {DOMAIN_MAP: new_map})
+        self.assertEqual(diff.action, ACTION_RUNTIME)
+        self.assertEqual(diff.commands()[0],
+                         'set weight nginx_10000/agent2_2_2_2_2_1025 2')
+
+    def test_reordered_map_needs_reload(self):
+        running_map = 'a.example.com nginx_10000\nb.example.com nginx_10001\n'
+        new_map = 'b.example.com nginx_10001\na.example.com nginx_10000\n'
+        self.assertFalse(MapDiff(DOMAIN_MAP, running_map, new_map).runtime)
+        diff = ConfigDiff(RUNNING_CONFIG, RUNNING_CONFIG,
+                          {DOMAIN_MAP: running_map}, {DOMAIN_MAP: new_map})
+        self.assertEqual(diff.action, ACTION_RELOAD)
+
+        # New entries can only be added at the end.
+        new_map = 'c.example.com nginx_10000\n' + running_map
+        self.assertFalse(MapDiff(DOMAIN_MAP, running_map, new_map).runtime)
+        new_map = running_map + 'c.example.com nginx_10000\n'
+        self.assertTrue(MapDiff(DOMAIN_MAP, running_map, new_map).runtime)
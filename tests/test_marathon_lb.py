@@ -1,11 +1,22 @@
+import argparse
 import copy
 import json
 import unittest
 import os
+import shutil
+import tempfile
 import string
 import random
+import threading
+import time
+
+import dateutil.parser
+import requests
+from mock import Mock, patch
 
 import marathon_lb
+import utils
+from config_diff import ConfigDiff
 
 
 class TestMarathonUpdateHaproxy(unittest.TestCase):
@@ -1252,6 +1263,81 @@ backend nginx_10000
 '''
         self.assertMultiLineEqual(config, expected)
 
+    def test_config_server_slots(self):
+        groups = ['external']
+        bind_http_https = True
+        ssl_certs = ""
+        templater = marathon_lb.ConfigTemplater()
+        strictMode = False
+
+        healthCheck = {
+            "path": "/",
+            "protocol": "HTTP",
+            "portIndex": 0,
+            "gracePeriodSeconds": 10,
+            "intervalSeconds": 2,
+            "timeoutSeconds": 10,
+            "maxConsecutiveFailures": 10
+        }
+        marathon_lb.SERVER_SLOT_ASSIGNER.reset()
+        self.addCleanup(marathon_lb.SERVER_SLOT_ASSIGNER.reset)
+
+        app = marathon_lb.MarathonService('/nginx', 10000, healthCheck,
+                                          strictMode)
+        app.groups = ['external']
+        app.server_slots = 3
+        app.add_backend("agent1", "1.1.1.1", 1024, False)
+        app.add_backend("agent2", "2.2.2.2", 1025, False)
+        running_config = marathon_lb.config([app], groups, bind_http_https,
+                                            ssl_certs, templater)
+
+        app = marathon_lb.MarathonService('/nginx', 10000, healthCheck,
+                                          strictMode)
+        app.groups = ['external']
+        app.server_slots = 3
+        app.add_backend("agent2", "2.2.2.2", 1025, False)
+        app.add_backend("agent3", "3.3.3.3", 1026, True)
+        config = marathon_lb.config([app], groups, bind_http_https,
+                                    ssl_certs, templater)
+        expected = self.base_config + '''
+frontend marathon_http_in
+  bind *:80
+  mode http
+
+frontend marathon_http_appid_in
+  bind *:9091
+  mode http
+  acl app__nginx hdr(x-marathon-app-id) -i /nginx
+  use_backend nginx_10000 if app__nginx
+
+frontend marathon_https_in
+  bind *:443 ssl crt /etc/ssl/cert.pem
+  mode http
+
+frontend nginx_10000
+  bind *:10000
+  mode http
+  use_backend nginx_10000
+
+backend nginx_10000
+  balance roundrobin
+  mode http
+  option forwardfor
+  http-request set-header X-Forwarded-Port %[dst_port]
+  http-request add-header X-Forwarded-Proto https if { ssl_fc }
+  option  httpchk GET /
+  timeout check 10s
+  server slot1 3.3.3.3:1026 id 26658 check inter 2s fall 11 disabled
+  server slot2 2.2.2.2:1025 id 2197 check inter 2s fall 11
+  server slot3 0.0.0.0:1 id 2587 check inter 2s fall 11 disabled
+  server slot4 0.0.0.0:1 id 6295 check inter 2s fall 11 disabled
+'''
+        self.assertMultiLineEqual(config, expected)
+        self.assertEqual(
+            ConfigDiff(running_config, config).commands(),
+            ['set server nginx_10000/slot1 state maint',
+             'set server nginx_10000/slot1 addr 3.3.3.3 port 1026'])
+
     def test_bridge_app_marathon15(self):
         with open('tests/marathon15_apps.json') as data_file:
             apps = json.load(data_file)
@@ -1309,6 +1395,85 @@ backend pywebserver_10101
 '''
         self.assertMultiLineEqual(config, expected)
 
+    def test_compact_apps_generate_the_same_config(self):
+        class Marathon:
+            def __init__(self, data):
+                self.data = data
+
+            def list(self):
+                return self.data
+
+            def health_check(self):
+                return True
+
+            def strict_mode(self):
+                return False
+
+        groups = ['external']
+        bind_http_https = True
+        ssl_certs = ""
+        templater = marathon_lb.ConfigTemplater()
+        for path in ['tests/marathon15_apps.json', 'tests/zdd_apps.json']:
+            with open(path) as data_file:
+                data = json.load(data_file)
+            compact_apps = [utils.compact_app(app) for app in data['apps']]
+            self.assertLess(len(json.dumps(compact_apps)),
+                            len(json.dumps(data['apps'])))
+
+            marathon_lb.CONFIG_FRAGMENTS.reset()
+            apps = marathon_lb.get_apps(Marathon(data['apps']))
+            expected = marathon_lb.config(apps, groups, bind_http_https,
+                                          ssl_certs, templater)
+            marathon_lb.CONFIG_FRAGMENTS.reset()
+            apps = marathon_lb.get_apps(Marathon(compact_apps))
+            config = marathon_lb.config(apps, groups, bind_http_https,
+                                        ssl_certs, templater)
+            self.assertMultiLineEqual(config, expected)
+
+    def test_config_fragments_are_reused(self):
+        class Marathon:
+            def __init__(self, data):
+                self.data = data
+
+            def list(self):
+                return self.data
+
+            def health_check(self):
+                return True
+
+            def strict_mode(self):
+                return False
+
+        groups = ['external']
+        templater = marathon_lb.ConfigTemplater()
+        with open('tests/marathon15_apps.json') as data_file:
+            data = json.load(data_file)
+
+        def generate():
+            apps = marathon_lb.get_apps(Marathon(copy.deepcopy(data['apps'])))
+            return apps, marathon_lb.config(apps, groups, True, "",
+                                            templater)
+
+        marathon_lb.CONFIG_FRAGMENTS.reset()
+        self.addCleanup(marathon_lb.CONFIG_FRAGMENTS.reset)
+        apps, expected = generate()
+        self.assertEqual(len(marathon_lb.CONFIG_FRAGMENTS.fragments),
+                         len(apps))
+        with patch('marathon_lb.generateServiceConfig',
+                   wraps=marathon_lb.generateServiceConfig) as generate_one:
+            _, config = generate()
+            self.assertMultiLineEqual(config, expected)
+            self.assertEqual(generate_one.call_count, 0)
+
+            data['apps'][0]['tasks'][0]['host'] = '10.0.0.99'
+            _, config = generate()
+            self.assertEqual(generate_one.call_count, 1)
+            self.assertIn('10.0.0.99', config)
+
+        marathon_lb.CONFIG_FRAGMENTS.reset()
+        _, uncached = generate()
+        self.assertMultiLineEqual(config, uncached)
+
     def test_zdd_app(self):
         with open('tests/zdd_apps.json') as data_file:
             zdd_apps = json.load(data_file)
@@ -2257,12 +2422,12 @@ backend nginx3_10000
         app2.add_backend("agent2", "2.2.2.2", 1025, False)
         apps = [app1, app2]
         haproxy_map = True
-        domain_map_array = []
-        app_map_array = []
+        domain_map = utils.HaproxyMap()
+        app_map = utils.HaproxyMap()
         config_file = "/etc/haproxy/haproxy.cfg"
         config = marathon_lb.config(apps, groups, bind_http_https, ssl_certs,
-                                    templater, haproxy_map, domain_map_array,
-                                    app_map_array, config_file)
+                                    templater, haproxy_map, domain_map,
+                                    app_map, config_file)
         expected = self.base_config + '''
 frontend marathon_http_in
   bind *:80
@@ -2314,10 +2479,7 @@ backend nginx_10000
         self.assertMultiLineEqual(config, expected)
 
         # Check the domain map
-        domain_config_map = {}
-        for element in domain_map_array:
-            for key, value in list(element.items()):
-                domain_config_map[key] = value
+        domain_config_map = dict(domain_map.items())
         expected_domain_map = {}
         expected_domain_map["server.nginx.net"] = "nginx_10000"
         expected_domain_map["server.nginx1.net"] = "nginx_10000"
@@ -2325,10 +2487,7 @@ backend nginx_10000
         self.assertEqual(domain_config_map, expected_domain_map)
 
         # Check the app map
-        app_config_map = {}
-        for element in app_map_array:
-            for key, value in list(element.items()):
-                app_config_map[key] = value
+        app_config_map = dict(app_map.items())
         expected_app_map = {}
         expected_app_map["/apache"] = "apache_10001"
         expected_app_map["/nginx"] = "nginx_10000"
@@ -2366,12 +2525,12 @@ backend nginx_10000
         app2.add_backend("agent2", "2.2.2.2", 1025, False)
         apps = [app1, app2]
         haproxy_map = True
-        domain_map_array = []
-        app_map_array = []
+        domain_map = utils.HaproxyMap()
+        app_map = utils.HaproxyMap()
         config_file = "/etc/haproxy/haproxy.cfg"
         config = marathon_lb.config(apps, groups, bind_http_https, ssl_certs,
-                                    templater, haproxy_map, domain_map_array,
-                                    app_map_array, config_file)
+                                    templater, haproxy_map, domain_map,
+                                    app_map, config_file)
         expected = self.base_config + '''
 frontend marathon_http_in
   bind *:80
@@ -2429,20 +2588,14 @@ backend nginx_10000
         self.assertMultiLineEqual(config, expected)
 
         # Check the domain map
-        domain_config_map = {}
-        for element in domain_map_array:
-            for key, value in list(element.items()):
-                domain_config_map[key] = value
+        domain_config_map = dict(domain_map.items())
         expected_domain_map = {}
         expected_domain_map["server.nginx.net"] = "nginx_10000"
         expected_domain_map["server.nginx1.net"] = "nginx_10000"
         self.assertEqual(domain_config_map, expected_domain_map)
 
         # Check the app map
-        app_config_map = {}
-        for element in app_map_array:
-            for key, value in list(element.items()):
-                app_config_map[key] = value
+        app_config_map = dict(app_map.items())
         expected_app_map = {}
         expected_app_map["/apache"] = "apache_10001"
         expected_app_map["/nginx"] = "nginx_10000"
@@ -2487,12 +2640,12 @@ backend nginx_10000
         app2.add_backend("agent2", "2.2.2.2", 1025, False)
         apps = [app1, app2]
         haproxy_map = True
-        domain_map_array = []
-        app_map_array = []
+        domain_map = utils.HaproxyMap()
+        app_map = utils.HaproxyMap()
         config_file = "/etc/haproxy/haproxy.cfg"
         config = marathon_lb.config(apps, groups, bind_http_https, ssl_certs,
-                                    templater, haproxy_map, domain_map_array,
-                                    app_map_array, config_file)
+                                    templater, haproxy_map, domain_map,
+                                    app_map, config_file)
         expected = self.base_config + '''
 userlist user_nginx2_10001
   user testuser password testpasswd
@@ -2556,19 +2709,13 @@ backend nginx2_10001
         self.assertMultiLineEqual(config, expected)
 
         # Check the domain map
-        domain_config_map = {}
-        for element in domain_map_array:
-            for key, value in list(element.items()):
-                domain_config_map[key] = value
+        domain_config_map = dict(domain_map.items())
         expected_domain_map = {}
         expected_domain_map["server.nginx.net"] = "nginx1_10000"
         self.assertEqual(domain_config_map, expected_domain_map)
 
         # Check the app map
-        app_config_map = {}
-        for element in app_map_array:
-            for key, value in list(element.items()):
-                app_config_map[key] = value
+        app_config_map = dict(app_map.items())
         expected_app_map = {}
         expected_app_map["/nginx2"] = "nginx2_10001"
         expected_app_map["/nginx1"] = "nginx1_10000"
@@ -2606,12 +2753,12 @@ backend nginx2_10001
         app2.add_backend("agent2", "2.2.2.2", 1025, False)
         apps = [app1, app2]
         haproxy_map = True
-        domain_map_array = []
-        app_map_array = []
+        domain_map = utils.HaproxyMap()
+        app_map = utils.HaproxyMap()
         config_file = "/etc/haproxy/haproxy.cfg"
         config = marathon_lb.config(apps, groups, bind_http_https, ssl_certs,
-                                    templater, haproxy_map, domain_map_array,
-                                    app_map_array, config_file)
+                                    templater, haproxy_map, domain_map,
+                                    app_map, config_file)
         expected = self.base_config + '''
 frontend marathon_http_in
   bind *:80
@@ -2672,20 +2819,14 @@ backend nginx_10000
         self.assertMultiLineEqual(config, expected)
 
         # Check the domain map
-        domain_config_map = {}
-        for element in domain_map_array:
-            for key, value in list(element.items()):
-                domain_config_map[key] = value
+        domain_config_map = dict(domain_map.items())
         expected_domain_map = {}
         expected_domain_map["server.nginx.net"] = "nginx_10000"
         expected_domain_map["server.nginx1.net"] = "nginx_10000"
         self.assertEqual(domain_config_map, expected_domain_map)
 
         # Check the app map
-        app_config_map = {}
-        for element in app_map_array:
-            for key, value in list(element.items()):
-                app_config_map[key] = value
+        app_config_map = dict(app_map.items())
         expected_app_map = {}
         expected_app_map["/apache"] = "apache_10001"
         expected_app_map["/nginx"] = "nginx_10000"
@@ -2723,12 +2864,12 @@ backend nginx_10000
         app2.redirectHttpToHttps = True
         apps = [app1, app2]
         haproxy_map = True
-        domain_map_array = []
-        app_map_array = []
+        domain_map = utils.HaproxyMap()
+        app_map = utils.HaproxyMap()
         config_file = "/etc/haproxy/haproxy.cfg"
         config = marathon_lb.config(apps, groups, bind_http_https, ssl_certs,
-                                    templater, haproxy_map, domain_map_array,
-                                    app_map_array, config_file)
+                                    templater, haproxy_map, domain_map,
+                                    app_map, config_file)
         expected = self.base_config + '''
 frontend marathon_http_in
   bind *:80
@@ -2783,10 +2924,7 @@ backend nginx_10000
         self.assertMultiLineEqual(config, expected)
 
         # Check the domain map
-        domain_config_map = {}
-        for element in domain_map_array:
-            for key, value in list(element.items()):
-                domain_config_map[key] = value
+        domain_config_map = dict(domain_map.items())
         expected_domain_map = {}
         expected_domain_map["server.nginx.net"] = "nginx_10000"
         expected_domain_map["server.nginx1.net"] = "nginx_10000"
@@ -2795,10 +2933,7 @@ backend nginx_10000
         self.assertEqual(domain_config_map, expected_domain_map)
 
         # Check the app map
-        app_config_map = {}
-        for element in app_map_array:
-            for key, value in list(element.items()):
-                app_config_map[key] = value
+        app_config_map = dict(app_map.items())
         expected_app_map = {}
         expected_app_map["/apache"] = "apache_10001"
         expected_app_map["/nginx"] = "nginx_10000"
@@ -3022,12 +3157,12 @@ backend nginx_10000
         app2.add_backend("agent2", "2.2.2.2", 1025, False)
         apps = [app1, app2]
         haproxy_map = True
-        domain_map_array = []
-        app_map_array = []
+        domain_map = utils.HaproxyMap()
+        app_map = utils.HaproxyMap()
         config_file = "/etc/haproxy/haproxy.cfg"
         config = marathon_lb.config(apps, groups, bind_http_https, ssl_certs,
-                                    templater, haproxy_map, domain_map_array,
-                                    app_map_array, config_file)
+                                    templater, haproxy_map, domain_map,
+                                    app_map, config_file)
         expected = self.base_config + '''
 frontend marathon_http_in
   bind *:80
@@ -3096,12 +3231,12 @@ backend nginx2_10001
         app2.add_backend("agent2", "2.2.2.2", 1025, False)
         apps = [app1, app2]
         haproxy_map = True
-        domain_map_array = []
-        app_map_array = []
+        domain_map = utils.HaproxyMap()
+        app_map = utils.HaproxyMap()
         config_file = "/etc/haproxy/haproxy.cfg"
         config = marathon_lb.config(apps, groups, bind_http_https, ssl_certs,
-                                    templater, haproxy_map, domain_map_array,
-                                    app_map_array, config_file)
+                                    templater, haproxy_map, domain_map,
+                                    app_map, config_file)
         expected = self.base_config + '''
 frontend marathon_http_in
   bind *:80
@@ -3192,12 +3327,12 @@ backend nginx2_10001
 
         apps = [app1, app2, app3, app4]
         haproxy_map = True
-        domain_map_array = []
-        app_map_array = []
+        domain_map = utils.HaproxyMap()
+        app_map = utils.HaproxyMap()
         config_file = "/etc/haproxy/haproxy.cfg"
         config = marathon_lb.config(apps, groups, bind_http_https, ssl_certs,
-                                    templater, haproxy_map, domain_map_array,
-                                    app_map_array, config_file,
+                                    templater, haproxy_map, domain_map,
+                                    app_map, config_file,
                                     group_https_by_vhost)
         expected = self.base_config + '''
 frontend marathon_http_in
@@ -3380,6 +3515,61 @@ class TestFunctions(unittest.TestCase):
         expected = ['k1', {'k3': ['k4', {}]}, 'k6']
         self.assertEquals(data, expected)
 
+    def test_backends_are_kept_sorted(self):
+        service = marathon_lb.MarathonService('/nginx', 10000, None, False)
+        service.add_backend('agent2', '2.2.2.2', 1025, False)
+        service.add_backend('agent1', '1.1.1.1', 1026, False)
+        service.add_backend('agent2', '2.2.2.2', 1024, False)
+        service.add_backend('agent1', '1.1.1.2', 1026, True)
+        self.assertEqual([(backend.host, backend.ip, backend.port)
+                          for backend in service.backends],
+                         [('agent1', '1.1.1.1', 1026),
+                          ('agent1', '1.1.1.2', 1026),
+                          ('agent2', '2.2.2.2', 1024),
+                          ('agent2', '2.2.2.2', 1025)])
+        with self.assertRaises(AttributeError):
+            service.unknown = True
+
+    def test_label_setters(self):
+        labels = {'HAPROXY_GROUP': 'external',
+                  'HAPROXY_0_VHOST': 'nginx.example.com',
+                  'HAPROXY_0_BACKEND_WEIGHT': '2',
+                  'HAPROXY_1_MODE': 'tcp',
+                  'HAPROXY_00_MODE': 'tcp',
+                  'HAPROXY_0_UNKNOWN': 'x'}
+        label_setters = {}
+        port_setters, app_setters = marathon_lb.get_label_setters(
+            labels, label_setters)
+        self.assertEqual(app_setters, [])
+        self.assertEqual(
+            dict((index, [(key, value) for _, key, _, value in setters])
+                 for index, setters in port_setters.items()),
+            {0: [('HAPROXY_{0}_BACKEND_WEIGHT', '2'),
+                 ('HAPROXY_{0}_VHOST', 'nginx.example.com')],
+             1: [('HAPROXY_{0}_MODE', 'tcp')]})
+
+        marathon_lb.LABEL_SETTERS.update(label_setters)
+        with patch('marathon_lb.PORT_LABEL_PATTERN') as pattern:
+            self.assertEqual(
+                marathon_lb.get_label_setters(dict(labels), {}),
+                (port_setters, app_setters))
+            pattern.match.assert_not_called()
+        marathon_lb.LABEL_SETTERS.clear()
+
+    def test_parse_timestamp(self):
+        for value in ['2016-02-01T14:13:42.499089',
+                      '2016-02-01T22:57:48.784Z',
+                      '2016-02-01T22:57:48Z',
+                      '2016-02-01T22:57:48.1234567+01:00',
+                      '2016-02-01T22:57:48-0530',
+                      '2016-02-01 22:57:48',
+                      'Feb 1 2016 22:57']:
+            parsed = marathon_lb.parse_timestamp(value)
+            expected = dateutil.parser.parse(value)
+            self.assertEqual(parsed, expected)
+            self.assertEqual(parsed.utcoffset(), expected.utcoffset())
+            self.assertIs(marathon_lb.parse_timestamp(value), parsed)
+
 
 class TestServerIdGeneration(unittest.TestCase):
     @staticmethod
@@ -3484,6 +3674,35 @@ class TestServerIdGeneration(unittest.TestCase):
             # name:
             self.assertEqual(server_ids[sn][1], server_ids[sn][2])
 
+    def test_assigned_server_ids_are_kept(self):
+        # 'yftjqzplpu' and 'ttccbfrdhi' hash to the same id, 28876. The
+        # server which got it first keeps it, whatever the order.
+        assigner = marathon_lb.ServerIdAssigner()
+        self.assertEqual(assigner.assign('nginx', ['ttccbfrdhi', 'a']),
+                         [28876, 25929])
+        self.assertEqual(
+            assigner.assign('nginx', ['0', 'yftjqzplpu', 'ttccbfrdhi']),
+            [17068, 21605, 28876])
+        self.assertEqual(assigner.assign('apache', ['yftjqzplpu']),
+                         [28876])
+
+        assigner.retain(['apache'])
+        self.assertEqual(assigner.assign('nginx', ['yftjqzplpu']), [28876])
+
+    def test_server_ids_are_loaded_from_config(self):
+        assigner = marathon_lb.ServerIdAssigner()
+        assigner.load('''backend nginx_10000
+  server agent1_1_1_1_1_1024 1.1.1.1:1024 id 1 check
+  server agent2_2_2_2_2_1025 2.2.2.2:1025 check id 2
+  server agent3_3_3_3_3_1026 3.3.3.3:1026 check
+''')
+        self.assertEqual(
+            assigner.assign('nginx_10000', ['agent3_3_3_3_3_1026',
+                                            'agent2_2_2_2_2_1025',
+                                            'agent1_1_1_1_1_1024']),
+            [marathon_lb.calculate_server_id('agent3_3_3_3_3_1026', set()),
+             2, 1])
+
     def test_if_server_name_cant_be_empty_string(self):
         with self.assertRaises(ValueError):
             marathon_lb.calculate_server_id('', set())
@@ -3491,3 +3710,784 @@ class TestServerIdGeneration(unittest.TestCase):
     def test_if_server_name_cant_be_none(self):
         with self.assertRaises(ValueError):
             marathon_lb.calculate_server_id(None, set())
+
+
+class TestReloadOrUpdateConfig(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(marathon_lb, 'args', create=True,
+                               new=argparse.Namespace(runtime_api=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_runtime_api_needs_admin_level(self):
+        running_config = 'global\n  stats socket /var/run/haproxy/socket\n'
+        diff = Mock(action='runtime')
+        diff.commands.return_value = ['set weight nginx_10000/slot1 1']
+        with patch('marathon_lb.apply_commands') as apply_commands, \
+                patch('marathon_lb.reloadConfig') as reload_config:
+            marathon_lb.reloadOrUpdateConfig(running_config, diff)
+            apply_commands.assert_not_called()
+            reload_config.assert_called_once_with()
+
+            reload_config.reset_mock()
+            marathon_lb.reloadOrUpdateConfig(
+                running_config.replace('socket\n', 'socket level admin\n'),
+                diff)
+            apply_commands.assert_called_once_with(
+                '/var/run/haproxy/socket',
+                ['set weight nginx_10000/slot1 1'])
+            reload_config.assert_not_called()
+
+    def test_unchanged_config_is_not_diffed(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        config_file = os.path.join(tmpdir, 'haproxy.cfg')
+        running_config = 'global\n  stats socket /var/run/haproxy/socket\n'
+        with open(config_file, 'w') as f:
+            f.write(running_config)
+        with patch('marathon_lb.ConfigDiff') as config_diff, \
+                patch('marathon_lb.reloadConfig') as reload_config:
+            self.assertEqual(marathon_lb.compareWriteAndReloadConfig(
+                running_config, config_file, utils.HaproxyMap(),
+                utils.HaproxyMap(), True), (False, True))
+        config_diff.assert_not_called()
+        reload_config.assert_not_called()
+
+
+class TestMarathonClient(unittest.TestCase):
+
+    def setUp(self):
+        self.marathon = marathon_lb.Marathon(
+            ['http://marathon1:8080', 'http://marathon2:8080'],
+            False, False, None, pool_size=4, retries=2)
+        self.responses = {}
+        self.requests = []
+        self.returned = []
+        self.headers = []
+        patcher = patch('requests.Session.request', self._request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        self.headers.append(kwargs.get('headers'))
+        status_code, data = self.responses.get(url, (None, None))
+        if status_code is None:
+            raise requests.exceptions.ConnectionError(url)
+        response = Mock(status_code=status_code, reason='', url=url)
+        if isinstance(data, ValueError):
+            response.json.side_effect = data
+            data = None
+        response.headers = {'ETag': '"v1"'}
+        response.json.return_value = data
+        body = json.dumps(data).encode('utf-8')
+        response.iter_content.return_value = [body[:10], body[10:]]
+        self.returned.append(response)
+        return response
+
+    def test_requests_share_a_pooled_session(self):
+        adapter = self.marathon._Marathon__session.get_adapter(
+            'https://marathon1:8080')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertEqual(adapter.max_retries.connect, 0)
+        self.assertEqual(adapter.max_retries.read, 0)
+
+        self.responses['http://marathon1:8080/v2/apps'] = \
+            (200, {'apps': []})
+        self.responses['http://marathon1:8080/v2/tasks'] = \
+            (200, {'tasks': []})
+        self.assertEqual(self.marathon.list(), [])
+        self.assertEqual(self.marathon.tasks(), [])
+        self.assertEqual(self.requests[-2:],
+                         [('GET', 'http://marathon1:8080/v2/apps'),
+                          ('GET', 'http://marathon1:8080/v2/tasks')])
+
+    def test_requests_go_to_the_leader(self):
+        self.responses['http://marathon1:8080/v2/leader'] = \
+            (200, {'leader': 'marathon2:8080'})
+        self.responses['http://marathon2:8080/v2/apps'] = \
+            (200, {'apps': []})
+        self.marathon.list()
+        self.marathon.list()
+        self.assertEqual(self.requests,
+                         [('GET', 'http://marathon1:8080/v2/leader'),
+                          ('GET', 'http://marathon2:8080/v2/apps'),
+                          ('GET', 'http://marathon2:8080/v2/apps')])
+
+    def test_leader_which_isnt_json_is_skipped(self):
+        self.responses['http://marathon1:8080/v2/leader'] = \
+            (200, ValueError('not JSON'))
+        self.responses['http://marathon2:8080/v2/leader'] = \
+            (200, {'leader': 'marathon2:8080'})
+        self.responses['http://marathon2:8080/v2/apps'] = \
+            (200, {'apps': []})
+        self.assertEqual(self.marathon.list(), [])
+        self.assertEqual(self.requests,
+                         [('GET', 'http://marathon1:8080/v2/leader'),
+                          ('GET', 'http://marathon2:8080/v2/leader'),
+                          ('GET', 'http://marathon2:8080/v2/apps')])
+
+    def test_failed_host_is_tried_last(self):
+        self.responses['http://marathon2:8080/v2/leader'] = \
+            (200, {'leader': 'marathon3:8080'})
+        self.responses['http://marathon2:8080/v2/apps'] = \
+            (200, {'apps': []})
+        self.marathon.list()
+        self.assertEqual(self.requests,
+                         [('GET', 'http://marathon1:8080/v2/leader'),
+                          ('GET', 'http://marathon2:8080/v2/leader'),
+                          ('GET', 'http://marathon2:8080/v2/apps')])
+
+        # Once marathon2 fails, marathon1 is still backing off and is tried
+        # last.
+        del self.responses['http://marathon2:8080/v2/apps']
+        self.responses['http://marathon1:8080/v2/apps'] = \
+            (200, {'apps': []})
+        self.requests = []
+        self.marathon.list()
+        self.assertEqual(self.requests,
+                         [('GET', 'http://marathon2:8080/v2/apps'),
+                          ('GET', 'http://marathon1:8080/v2/apps')])
+
+    def test_apps_are_streamed(self):
+        self.responses['http://marathon1:8080/v2/apps'] = \
+            (200, {'apps': [{'id': '/a', 'cmd': None},
+                            {'id': '/b', 'labels': {'x': None}}]})
+        apps = self.marathon.iter_apps()
+        self.assertEqual(next(apps), {'id': '/a'})
+        self.assertEqual(list(apps), [{'id': '/b', 'labels': {}}])
+
+    def test_streamed_responses_are_closed(self):
+        self.responses['http://marathon1:8080/v2/apps'] = (503, None)
+        self.responses['http://marathon2:8080/v2/apps'] = \
+            (200, {'apps': []})
+        self.assertEqual(self.marathon.list(), [])
+        self.assertEqual([response.url for response in self.returned],
+                         ['http://marathon1:8080/v2/apps',
+                          'http://marathon2:8080/v2/apps'])
+        self.assertTrue(all(response.close.called
+                            for response in self.returned))
+
+    def test_list_if_modified(self):
+        self.responses['http://marathon1:8080/v2/apps'] = \
+            (200, {'apps': [{'id': '/a'}]})
+        self.assertEqual(self.marathon.list_if_modified(),
+                         ([{'id': '/a'}], '"v1"', None))
+        self.responses['http://marathon1:8080/v2/apps'] = (304, None)
+        self.assertEqual(self.marathon.list_if_modified('"v1"'),
+                         (None, '"v1"', None))
+        self.assertEqual(self.headers[-1], {'If-None-Match': '"v1"'})
+
+    def test_all_hosts_failing_raises(self):
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.marathon.list()
+
+
+class TestRegenerateConfigIfChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config_file = os.path.join(self.tmpdir, 'haproxy.cfg')
+        self.marathon = Mock()
+        self.marathon.list_if_modified.return_value = \
+            ([{'id': '/nginx', 'tasks': []}], None, None)
+        self.templater = marathon_lb.ConfigTemplater()
+        patcher = patch.object(marathon_lb, 'args', create=True,
+                               new=argparse.Namespace(group=['external']))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('marathon_lb.regenerate_config',
+                        side_effect=self._regenerate_config)
+        self.regenerate_config = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config_valid = True
+
+    def _regenerate_config(self, *args):
+        with open(self.config_file, 'w') as f:
+            f.write('config')
+        return [], self.config_valid
+
+    def _poll(self):
+        marathon_lb.regenerate_config_if_changed(
+            self.marathon, self.config_file, ['external'], True, '',
+            self.templater, False, False)
+
+    def test_unchanged_apps_are_skipped(self):
+        self._poll()
+        self._poll()
+        self.assertEqual(self.regenerate_config.call_count, 1)
+
+        self.marathon.list_if_modified.return_value = \
+            ([{'id': '/nginx', 'tasks': [{'id': 'nginx.1'}]}], None, None)
+        self._poll()
+        self.assertEqual(self.regenerate_config.call_count, 2)
+
+    def test_health_check_timestamps_are_ignored(self):
+        def apps(alive, last_success):
+            return ([{'id': '/nginx', 'tasks': [{
+                'id': 'nginx.1', 'host': 'agent1', 'ports': [31000],
+                'healthCheckResults': [{
+                    'alive': alive, 'lastSuccess': last_success,
+                    'consecutiveFailures': 0}]}]}], None, None)
+
+        self.marathon.list_if_modified.return_value = \
+            apps(True, '2016-02-01T22:57:48.784Z')
+        self._poll()
+        self.marathon.list_if_modified.return_value = \
+            apps(True, '2016-02-01T22:57:51.784Z')
+        self._poll()
+        self.assertEqual(self.regenerate_config.call_count, 1)
+
+        self.marathon.list_if_modified.return_value = \
+            apps(False, '2016-02-01T22:57:51.784Z')
+        self._poll()
+        self.assertEqual(self.regenerate_config.call_count, 2)
+
+        # Without --health-check, the results of the health checks only
+        # matter for deployment groups.
+        self.marathon.health_check.return_value = False
+        self._poll()
+        self.marathon.list_if_modified.return_value = \
+            apps(True, '2016-02-01T22:57:51.784Z')
+        self._poll()
+        self.assertEqual(self.regenerate_config.call_count, 3)
+
+    def test_changed_config_file_is_regenerated(self):
+        self._poll()
+        with open(self.config_file, 'w') as f:
+            f.write('edited')
+        self._poll()
+        self.assertEqual(self.regenerate_config.call_count, 2)
+
+    def test_invalid_config_is_regenerated(self):
+        self.config_valid = False
+        self._poll()
+        self._poll()
+        self.assertEqual(self.regenerate_config.call_count, 2)
+
+    def test_conditional_fetch(self):
+        self.marathon.list_if_modified.return_value = \
+            ([{'id': '/nginx', 'tasks': []}], '"v1"', None)
+        self._poll()
+        self.marathon.list_if_modified.return_value = (None, '"v1"', None)
+        self._poll()
+        self.marathon.list_if_modified.assert_called_with('"v1"', None)
+        self.assertEqual(self.regenerate_config.call_count, 1)
+
+
+class TestMakeConfigValid(unittest.TestCase):
+
+    def setUp(self):
+        self.validated = []
+        for target, kwargs in [
+                ('marathon_lb.get_apps',
+                 {'side_effect': lambda marathon, apps, retain: list(apps)}),
+                ('marathon_lb.config',
+                 {'side_effect':
+                  lambda apps, *args, **kwargs: [a['id'] for a in apps]}),
+                ('marathon_lb.generateAndValidateTempConfig',
+                 {'side_effect': self._validate}),
+                ('marathon_lb.compareWriteAndReloadConfig', {}),
+                ('marathon_lb.INVALID_APP_VERSIONS', {'new': set()})]:
+            patcher = patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _validate(self, config, *args):
+        self.validated.append(config)
+        return not any(app_id.startswith('/bad') for app_id in config)
+
+    def _make_valid(self, apps):
+        self.validated = []
+        return marathon_lb.make_config_valid_and_regenerate(
+            None, apps, ['external'], True, '', None, False, [], [],
+            '/etc/haproxy/haproxy.cfg', False)
+
+    def test_invalid_apps_are_bisected(self):
+        apps = [{'id': '/app-%d' % i, 'version': '1'} for i in range(1000)]
+        apps[10]['id'] = '/bad-1'
+        apps[700]['id'] = '/bad-2'
+        valid_apps = self._make_valid(apps)
+        self.assertEqual(len(valid_apps), 998)
+        self.assertNotIn(apps[10], valid_apps)
+        self.assertNotIn(apps[700], valid_apps)
+        self.assertLess(len(self.validated), 50)
+        self.assertEqual(marathon_lb.INVALID_APP_VERSIONS,
+                         {('/bad-1', '1'), ('/bad-2', '1')})
+
+        # The next time, the same versions are excluded right away
+        self.assertEqual(len(self._make_valid(apps)), 998)
+        self.assertEqual(len(self.validated), 1)
+
+        apps[10]['version'] = '2'
+        self.assertEqual(len(self._make_valid(apps)), 998)
+        self.assertGreater(len(self.validated), 1)
+
+    def test_invalid_without_apps(self):
+        with patch('marathon_lb.generateAndValidateTempConfig',
+                   return_value=False) as validate:
+            self._make_valid([{'id': '/app-%d' % i} for i in range(100)])
+        self.assertEqual(validate.call_count, 1)
+        self.assertEqual(marathon_lb.INVALID_APP_VERSIONS, set())
+
+
+class TestMakeConfigValidAssignments(unittest.TestCase):
+
+    def setUp(self):
+        port_assigner = utils.ServicePortAssigner()
+        port_assigner.set_ports(10000, 10100)
+        slot_assigner = utils.ServerSlotAssigner()
+        slot_assigner.set_default_slots(4)
+        for target, kwargs in [
+                ('marathon_lb.SERVICE_PORT_ASSIGNER', {'new': port_assigner}),
+                ('marathon_lb.SERVER_SLOT_ASSIGNER', {'new': slot_assigner}),
+                ('marathon_lb.SERVER_ID_ASSIGNER',
+                 {'new': marathon_lb.ServerIdAssigner()}),
+                ('marathon_lb.CONFIG_FRAGMENTS',
+                 {'new': utils.FragmentCache()}),
+                ('marathon_lb.LABEL_SETTERS', {'new': {}}),
+                ('marathon_lb.INVALID_APP_VERSIONS', {'new': set()}),
+                ('marathon_lb.generateAndValidateTempConfig',
+                 {'side_effect': lambda config, *args: 'bad_' not in config}),
+                ('marathon_lb.compareWriteAndReloadConfig', {})]:
+            patcher = patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.marathon = Mock()
+        self.marathon.health_check.return_value = False
+        self.marathon.strict_mode.return_value = False
+        self.templater = marathon_lb.ConfigTemplater()
+
+    def _app(self, app_id, idx):
+        return {
+            'id': app_id,
+            'version': '1',
+            'labels': {'HAPROXY_GROUP': 'external'},
+            'ipAddress': {'discovery': {'ports': [{'number': 80}]}},
+            'portDefinitions': [],
+            'tasks': [{
+                'id': '%s.%d' % (app_id, task_idx),
+                'host': 'agent%d' % task_idx,
+                'ports': [],
+                'ipAddresses': [
+                    {'ipAddress': '10.0.%d.%d' % (idx, task_idx)}],
+                'state': 'TASK_RUNNING'
+            } for task_idx in range(2)]
+        }
+
+    def _assignments(self):
+        return (dict(marathon_lb.SERVICE_PORT_ASSIGNER.ports_by_app),
+                bytes(marathon_lb.SERVICE_PORT_ASSIGNER.used_ports),
+                copy.deepcopy(
+                    marathon_lb.SERVER_SLOT_ASSIGNER.slots_by_backend),
+                copy.deepcopy(marathon_lb.SERVER_ID_ASSIGNER.ids_by_backend),
+                set(marathon_lb.CONFIG_FRAGMENTS.fragments),
+                dict(marathon_lb.LABEL_SETTERS))
+
+    def test_bisection_keeps_assignments(self):
+        raw_apps = [self._app('/app-%d' % i, i) for i in range(8)]
+        raw_apps.insert(3, self._app('/bad', 9))
+        apps = marathon_lb.get_apps(self.marathon, copy.deepcopy(raw_apps))
+        generated_config = marathon_lb.config(apps, ['external'], False, '',
+                                              self.templater)
+        self.assertIn('bad_', generated_config)
+        assignments = self._assignments()
+
+        valid_apps = marathon_lb.make_config_valid_and_regenerate(
+            self.marathon, copy.deepcopy(raw_apps), ['external'], False, '',
+            self.templater, False, None, None, '/etc/haproxy/haproxy.cfg',
+            False)
+        self.assertEqual(len(valid_apps), 8)
+        self.assertNotIn('/bad', [app.appId for app in valid_apps])
+        self.assertEqual(marathon_lb.INVALID_APP_VERSIONS, {('/bad', '1')})
+        self.assertEqual(self._assignments(), assignments)
+
+    def test_bisection_merges_deployment_groups_once(self):
+        with open('tests/zdd_apps.json') as data_file:
+            raw_apps = json.load(data_file)['apps']
+        raw_apps.append(self._app('/bad', 9))
+        with patch('marathon_lb.compareWriteAndReloadConfig',
+                   return_value=(True, False)):
+            apps, _ = marathon_lb.regenerate_config(
+                self.marathon, '/etc/haproxy/haproxy.cfg', ['external'],
+                False, '', self.templater, False, False, raw_apps)
+        self.assertEqual([(app.appId, len(app.backends)) for app in apps],
+                         [('/nginx', 4)])
+        self.assertEqual(marathon_lb.INVALID_APP_VERSIONS, {('/bad', '1')})
+
+
+class TestValidationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cert = os.path.join(self.tmpdir, 'cert.pem')
+        with open(self.cert, 'w') as f:
+            f.write('cert')
+        self.config = 'frontend https\n  bind *:443 ssl crt {0}\n'.format(
+            self.tmpdir)
+
+    def test_key_depends_on_loaded_files(self):
+        key = marathon_lb.getValidationKey(self.config, '')
+        self.assertEqual(marathon_lb.getValidationKey(self.config, ''), key)
+        self.assertNotEqual(
+            marathon_lb.getValidationKey(self.config, 'a.com nginx\n'), key)
+
+        with open(self.cert, 'w') as f:
+            f.write('new cert')
+        self.assertNotEqual(marathon_lb.getValidationKey(self.config, ''),
+                            key)
+
+    def test_identical_config_is_validated_once(self):
+        config_file = os.path.join(self.tmpdir, 'haproxy.cfg')
+        with patch.object(marathon_lb, 'args', create=True,
+                          new=argparse.Namespace(dry=False,
+                                                 archive_versions=0)), \
+                patch('marathon_lb.VALIDATION_CACHE',
+                      new=marathon_lb.LRUCache(10)), \
+                patch('marathon_lb.moveTempFile'), \
+                patch('marathon_lb.validateConfig',
+                      return_value=True) as validate:
+            for _ in range(2):
+                self.assertTrue(marathon_lb.writeConfigAndValidate(
+                    self.config, config_file, '', '', '', '', False))
+            self.assertEqual(validate.call_count, 1)
+
+            with open(self.cert, 'w') as f:
+                f.write('new cert')
+            marathon_lb.writeConfigAndValidate(
+                self.config, config_file, '', '', '', '', False)
+            self.assertEqual(validate.call_count, 2)
+
+
+class TestReloadConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config_file = os.path.join(self.tmpdir, 'haproxy.cfg')
+        with open(self.config_file, 'w') as f:
+            f.write('global\n  stats socket /var/run/haproxy/socket\n')
+        patcher = patch.object(marathon_lb, 'args', create=True,
+                               new=argparse.Namespace(
+                                   command='reload-haproxy',
+                                   haproxy_config=self.config_file,
+                                   reload_interval=10,
+                                   max_reload_retries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('subprocess.check_call')
+        self.check_call = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('marathon_lb.get_haproxy_pids')
+        self.get_haproxy_pids = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_waits_for_new_process_on_stats_socket(self):
+        # The socket doesn't answer while the new process starts
+        pids = [100, None, 100, 200]
+        with patch('marathon_lb.get_haproxy_socket_pid',
+                   side_effect=pids) as get_pid:
+            count = marathon_lb.RELOAD_DURATIONS.count
+            marathon_lb.reloadConfig()
+        self.check_call.assert_called_once_with(['reload-haproxy'],
+                                                close_fds=True)
+        get_pid.assert_called_with('/var/run/haproxy/socket')
+        self.assertEqual(get_pid.call_count, 4)
+        self.get_haproxy_pids.assert_not_called()
+        self.assertEqual(marathon_lb.RELOAD_DURATIONS.count, count + 1)
+
+    def test_falls_back_to_pids(self):
+        self.get_haproxy_pids.side_effect = [{100}, {100}, {100, 200}]
+        with patch('marathon_lb.get_haproxy_socket_pid',
+                   return_value=None):
+            marathon_lb.reloadConfig()
+        self.assertEqual(self.get_haproxy_pids.call_count, 3)
+
+
+class TestMarathonPoller(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('marathon_lb.regenerate_config_if_changed',
+                        side_effect=self._poll)
+        self.regenerate = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('marathon_lb.reloadConfig')
+        self.reload = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('marathon_lb.validateConfig', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.poller = marathon_lb.MarathonPoller(
+            Mock(), '/etc/haproxy/haproxy.cfg', ['external'], True, '',
+            False, False, 60, 0.1)
+        self.polls = []
+
+    def _poll(self, *args):
+        self.polls.append(args)
+        if len(self.polls) == 1:
+            raise requests.exceptions.ConnectionError()
+        if len(self.polls) == 2:
+            self.poller.poll_now()
+        if len(self.polls) == 3:
+            self.poller.stop()
+
+    def test_delay_is_jittered(self):
+        delays = [self.poller.next_delay() for _ in range(100)]
+        self.assertTrue(all(54 <= delay <= 66 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_polls_until_stopped(self):
+        # A failed poll doesn't stop the loop, and waking it up makes it
+        # poll immediately.
+        with patch.object(self.poller, 'next_delay', return_value=30):
+            self.poller.poll_now()
+            self.poller.run()
+        self.assertEqual(len(self.polls), 3)
+        self.assertEqual(self.poller.polls_done, 2)
+        self.reload.assert_not_called()
+
+    def test_reload_existing_config(self):
+        self.poller.reload_existing_config()
+        with patch.object(self.poller, 'next_delay', return_value=0):
+            self.poller.run()
+        self.reload.assert_called_once_with()
+        self.assertEqual(len(self.polls), 3)
+
+
+class TestMarathonAppsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = marathon_lb.MarathonAppsCache()
+        self.cache.reset([{
+            'id': '/nginx',
+            'labels': {},
+            'healthChecks': [{'protocol': 'HTTP'}],
+            'tasks': [{
+                'id': 'nginx.1',
+                'host': 'agent1',
+                'ports': [1024],
+                'state': 'TASK_RUNNING',
+                'healthCheckResults': [{'alive': True}]
+            }]
+        }])
+
+    def _tasks(self):
+        return self.cache.snapshot()[0]['tasks']
+
+    def test_status_update_adds_task(self):
+        applied = self.cache.apply_event({
+            'eventType': 'status_update_event',
+            'appId': '/nginx',
+            'taskId': 'nginx.2',
+            'taskStatus': 'TASK_RUNNING',
+            'host': 'agent2',
+            'ports': [1025],
+            'ipAddresses': [{'ipAddress': '2.2.2.2'}]
+        })
+        self.assertTrue(applied)
+        self.assertEqual(self._tasks()[1], {
+            'id': 'nginx.2',
+            'appId': '/nginx',
+            'host': 'agent2',
+            'ports': [1025],
+            'ipAddresses': [{'ipAddress': '2.2.2.2'}],
+            'state': 'TASK_RUNNING'
+        })
+
+    def test_status_update_removes_terminal_task(self):
+        applied = self.cache.apply_event({
+            'eventType': 'status_update_event',
+            'appId': '/nginx',
+            'taskId': 'nginx.1',
+            'taskStatus': 'TASK_KILLED'
+        })
+        self.assertTrue(applied)
+        self.assertEqual(self._tasks(), [])
+
+    def test_status_update_keeps_health_results(self):
+        self.cache.apply_event({
+            'eventType': 'status_update_event',
+            'appId': '/nginx',
+            'taskId': 'nginx.1',
+            'taskStatus': 'TASK_UNREACHABLE'
+        })
+        task = self._tasks()[0]
+        self.assertEqual(task['state'], 'TASK_UNREACHABLE')
+        self.assertEqual(task['healthCheckResults'], [{'alive': True}])
+
+    def test_health_status_changed_by_instance_id(self):
+        self.cache.reset([{
+            'id': '/nginx',
+            'healthChecks': [{'protocol': 'HTTP'}],
+            'tasks': [{'id': 'nginx.instance-1234._app.1'}]
+        }])
+        applied = self.cache.apply_event({
+            'eventType': 'health_status_changed_event',
+            'appId': '/nginx',
+            'instanceId': 'nginx.instance-1234',
+            'alive': False
+        })
+        self.assertTrue(applied)
+        self.assertEqual(self._tasks()[0]['healthCheckResults'],
+                         [{'alive': False}])
+
+    def test_unknown_app_or_task_is_rejected(self):
+        self.assertFalse(self.cache.apply_event({
+            'eventType': 'status_update_event',
+            'appId': '/apache',
+            'taskId': 'apache.1',
+            'taskStatus': 'TASK_RUNNING'
+        }))
+        self.assertFalse(self.cache.apply_event({
+            'eventType': 'health_status_changed_event',
+            'appId': '/nginx',
+            'taskId': 'nginx.3',
+            'alive': True
+        }))
+        self.assertFalse(marathon_lb.MarathonAppsCache().apply_event({
+            'eventType': 'status_update_event',
+            'appId': '/nginx',
+            'taskId': 'nginx.1',
+            'taskStatus': 'TASK_RUNNING'
+        }))
+
+    def test_snapshot_is_not_mutated_by_get_apps(self):
+        snapshot = self.cache.snapshot()
+        snapshot[0]['id'] = '/other'
+        snapshot[0]['tasks'][0]['draining'] = True
+        self.assertEqual(self.cache.snapshot()[0]['id'], '/nginx')
+        self.assertNotIn('draining', self._tasks()[0])
+
+
+class TestMarathonEventProcessor(unittest.TestCase):
+
+    def _processor(self, debounce, max_delay):
+        return marathon_lb.MarathonEventProcessor(
+            Mock(), '/etc/haproxy/haproxy.cfg', ['external'], True, '',
+            False, False, debounce=debounce, max_delay=max_delay)
+
+    def _wait_for(self, mock, calls):
+        deadline = time.time() + 5
+        while mock.call_count < calls and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_events_are_coalesced(self):
+        with patch.object(marathon_lb.MarathonEventProcessor,
+                          'do_reset') as do_reset:
+            processor = self._processor(debounce=0.3, max_delay=5)
+            for _ in range(10):
+                processor.reset_from_tasks()
+            processor.start()
+            for _ in range(10):
+                processor.reset_from_tasks()
+                time.sleep(0.01)
+            self._wait_for(do_reset, 1)
+            time.sleep(0.5)
+            processor.stop()
+
+        self.assertEqual(do_reset.call_count, 1)
+        self.assertEqual(processor.events_received, 21)
+        self.assertEqual(processor.updates_done, 1)
+
+    def test_max_delay_bounds_coalescing(self):
+        with patch.object(marathon_lb.MarathonEventProcessor,
+                          'do_reset') as do_reset:
+            processor = self._processor(debounce=1, max_delay=0.2)
+            processor.start()
+            start = time.time()
+            while time.time() - start < 1:
+                processor.reset_from_tasks()
+                time.sleep(0.02)
+            processor.stop()
+
+        self.assertGreater(do_reset.call_count, 1)
+
+    def test_fetching_overlaps_applying(self):
+        marathon = Mock()
+        marathon.list.side_effect = lambda: [
+            {'id': '/app-%d' % marathon.list.call_count, 'labels': {}}]
+        applying = threading.Event()
+        release = threading.Event()
+
+        def regenerate_config(*args):
+            applying.set()
+            release.wait(5)
+            return [], True
+
+        with patch('marathon_lb.regenerate_config',
+                   side_effect=regenerate_config) as regenerate:
+            processor = marathon_lb.MarathonEventProcessor(
+                marathon, '/etc/haproxy/haproxy.cfg', ['external'], True,
+                '', False, False)
+            processor.start()
+            self.assertTrue(applying.wait(5))
+
+            # While the first snapshot is being applied, events are still
+            # received and the next snapshots fetched.
+            processor.reset_from_tasks()
+            self._wait_for(marathon.list, 2)
+            processor.reset_from_tasks()
+            self._wait_for(marathon.list, 3)
+            self.assertEqual(regenerate.call_count, 1)
+
+            release.set()
+            self._wait_for(regenerate, 2)
+            time.sleep(0.1)
+            processor.stop()
+
+        # Only the latest of the snapshots fetched in the meantime is
+        # applied.
+        self.assertEqual(marathon.list.call_count, 3)
+        self.assertEqual([call[0][-1][0]['id']
+                          for call in regenerate.call_args_list],
+                         ['/app-1', '/app-3'])
+        self.assertEqual(processor.snapshots_skipped, 1)
+
+    def test_events_of_unserved_apps_are_dropped(self):
+        apps = [
+            {'id': '/served', 'labels': {'HAPROXY_GROUP': 'external'}},
+            {'id': '/port-group', 'labels': {'HAPROXY_1_GROUP': 'external'}},
+            {'id': '/internal', 'labels': {'HAPROXY_GROUP': 'internal'}},
+            {'id': '/no-group', 'labels': {}},
+            {'id': '/blue', 'labels': {'HAPROXY_GROUP': 'internal',
+                                       'HAPROXY_DEPLOYMENT_GROUP': 'app'}}]
+        self.assertEqual(
+            marathon_lb.get_unserved_app_ids(['external'], apps),
+            {'/internal', '/no-group'})
+        self.assertEqual(marathon_lb.get_unserved_app_ids(['*'], apps),
+                         frozenset())
+
+        marathon = Mock()
+        marathon.list.return_value = apps
+        processor = marathon_lb.MarathonEventProcessor(
+            marathon, '/etc/haproxy/haproxy.cfg', ['external'], True, '',
+            False, False)
+        with patch('marathon_lb.regenerate_config',
+                   return_value=([], True)):
+            processor.do_reset()
+
+        def event(event_type, app_id):
+            return json.dumps({'eventType': event_type, 'appId': app_id,
+                               'taskId': app_id[1:] + '.1'})
+
+        self.assertFalse(processor.is_relevant(
+            event('status_update_event', '/internal')))
+        self.assertFalse(processor.is_relevant(
+            event('health_status_changed_event', '/no-group')))
+        self.assertTrue(processor.is_relevant(
+            event('status_update_event', '/served')))
+        self.assertTrue(processor.is_relevant(
+            event('status_update_event', '/unknown')))
+        self.assertTrue(processor.is_relevant(
+            event('api_post_event', '/internal')))
+        self.assertEqual(processor.events_dropped, 2)
+
+        # The app definition may have changed, so the events of all apps
+        # are kept until the apps have been fetched again.
+        processor.handle_event({'eventType': 'api_post_event'})
+        self.assertTrue(processor.is_relevant(
+            event('status_update_event', '/internal')))
@@ -0,0 +1,96 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+import runtime_api
+from runtime_api import RuntimeApi, RuntimeApiError
+
+RUNNING_CONFIG = '''global
+  stats socket /var/run/haproxy/socket expose-fd listeners level admin
+defaults
+  timeout connect 3s
+'''
+
+
+class TestStatsSocket(unittest.TestCase):
+
+    def test_get_stats_socket(self):
+        self.assertEqual(runtime_api.get_stats_socket(RUNNING_CONFIG),
+                         '/var/run/haproxy/socket')
+        self.assertIsNone(runtime_api.get_stats_socket('global\n'))
+
+    def test_get_stats_socket_level(self):
+        self.assertEqual(runtime_api.get_stats_socket_level(RUNNING_CONFIG),
+                         'admin')
+        self.assertEqual(runtime_api.get_stats_socket_level(
+            'global\n  stats socket /var/run/haproxy/socket\n'), 'operator')
+        self.assertIsNone(runtime_api.get_stats_socket_level('global\n'))
+
+
+class TestRuntimeApi(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'socket')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(5)
+        self.commands = []
+        self.responses = {}
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.close()
+        os.remove(self.socket_path)
+        os.rmdir(self.tmpdir)
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            command = conn.makefile().readline().strip()
+            self.commands.append(command)
+            conn.sendall(self.responses.get(command, '\n').encode('utf-8'))
+            conn.close()
+
+    def test_execute(self):
+        self.responses['show info'] = 'Pid: 42\n'
+        self.assertEqual(RuntimeApi(self.socket_path).execute('show info'),
+                         'Pid: 42\n')
+
+    def test_show_info(self):
+        self.responses['show info'] = \
+            'Name: HAProxy\nVersion: 1.8.4\nPid: 42\nUptime: 0d 0h00m01s\n\n'
+        info = RuntimeApi(self.socket_path).show_info()
+        self.assertEqual(info['Pid'], '42')
+        self.assertEqual(info['Uptime'], '0d 0h00m01s')
+
+    def test_update_error(self):
+        self.responses['set server a/b state ready'] = 'No such server.\n'
+        with self.assertRaises(RuntimeApiError):
+            RuntimeApi(self.socket_path).update('set server a/b state ready')
+
+    def test_apply_commands_stops_at_first_failure(self):
+        self.responses['set server a/b addr 1.1.1.1 port 80'] = \
+            "IP changed from '0.0.0.0' to '1.1.1.1' by 'stats socket " \
+            "command'\n"
+        self.responses['set server a/c state ready'] = 'No such server.\n'
+        self.assertFalse(runtime_api.apply_commands(
+            self.socket_path,
+            ['set server a/b addr 1.1.1.1 port 80',
+             'set server a/c state ready',
+             'set server a/d state ready']))
+        self.assertEqual(self.commands,
+                         ['set server a/b addr 1.1.1.1 port 80',
+                          'set server a/c state ready'])
+
+    def test_unreachable_socket(self):
+        self.assertFalse(runtime_api.apply_commands(
+            os.path.join(self.tmpdir, 'missing'),
+            ['set server a/b state ready']))
@@ -1,3 +1,4 @@
+import json
 import unittest
 
 from mock import Mock, patch
@@ -5,7 +6,7 @@ from mock import Mock, patch
 from common import cleanup_json
 
 import utils
-from utils import ServicePortAssigner
+from utils import ServerSlotAssigner, ServicePortAssigner
 
 
 class TestUtils(unittest.TestCase):
@@ -279,6 +280,30 @@ class TestServicePortAssigner(unittest.TestCase):
         self.assertNotEquals(ports2, self.assigner.get_service_ports(app2))
         self.assertNotEquals(ports1, self.assigner.get_service_ports(app1))
 
+    def test_ip_per_task_ports_are_kept(self):
+        """
+        Check that an app keeps its ports when another app which got its
+        ports first goes away, and that the ports of the app are released
+        when it goes away itself.
+        """
+        # app1 and app2 clash, so app2 doesn't get the ports it would get on
+        # its own.
+        app1 = _get_app(idx=1, num_ports=5, num_tasks=1)
+        app2 = _get_app(idx=3, num_ports=5, num_tasks=1)
+        ports1 = self.assigner.get_service_ports(app1)
+        ports2 = self.assigner.get_service_ports(app2)
+        self.assigner.retain()
+
+        self.assertEquals(ports2, self.assigner.get_service_ports(app2))
+        self.assigner.retain()
+        self.assertEquals(list(self.assigner.ports_by_app.values()), ports2)
+        self.assertEquals(sum(self.assigner.used_ports), 5)
+
+        self.assigner.retain()
+        self.assertEquals(self.assigner.ports_by_app, {})
+        self.assertEquals(sum(self.assigner.used_ports), 0)
+        self.assertEquals(ports1, self.assigner.get_service_ports(app1))
+
     def test_ip_per_task_max_clash(self):
         """
         Check that ports are assigned by linear scan when we max out the
@@ -445,6 +470,101 @@ class TestServicePortAssigner(unittest.TestCase):
                           [])
 
 
+class TestServerSlotAssigner(unittest.TestCase):
+
+    def setUp(self):
+        self.assigner = ServerSlotAssigner()
+        self.servers = [('1.1.1.1', 1024), ('2.2.2.2', 1025),
+                        ('3.3.3.3', 1026)]
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(self.assigner.assign('nginx_10000', self.servers))
+
+    def test_pool_is_padded_to_power_of_two(self):
+        self.assertEqual(self.assigner.assign('nginx_10000', self.servers, 3),
+                         [0, 1, 2, None])
+        self.assertEqual(
+            len(self.assigner.assign('nginx_10000', self.servers, 1)), 4)
+        self.assigner.set_default_slots(8)
+        self.assertEqual(
+            len(self.assigner.assign('nginx_10000', self.servers)), 8)
+        self.assertIsNone(
+            self.assigner.assign('nginx_10000', self.servers, 0))
+
+    def test_servers_keep_their_slots(self):
+        self.assigner.assign('nginx_10000', self.servers, 4)
+        servers = [('2.2.2.2', 1025), ('3.3.3.3', 1026), ('4.4.4.4', 1027)]
+        self.assertEqual(self.assigner.assign('nginx_10000', servers, 4),
+                         [2, 0, 1, None])
+
+        # Servers keep their slots when the pool grows.
+        servers.extend([('5.5.5.5', 1028), ('6.6.6.6', 1029)])
+        self.assertEqual(self.assigner.assign('nginx_10000', servers, 4),
+                         [2, 0, 1, 3, 4, None, None, None])
+
+    def test_retain(self):
+        self.assigner.assign('nginx_10000', self.servers, 4)
+        self.assigner.retain(['nginx_10001'])
+        self.assertEqual(
+            self.assigner.assign('nginx_10000', self.servers[1:], 4),
+            [0, 1, None, None])
+
+    def test_load(self):
+        self.assigner.load('''backend nginx_10000
+  server slot1 0.0.0.0:1 id 1 disabled
+  server slot2 2.2.2.2:1025 id 2
+  server slot3 1.1.1.1:1024 id 3
+  server slot4 3.3.3.3:1026 id 4 disabled
+backend nginx_10001
+  server agent1_1_1_1_1_1024 1.1.1.1:1024 id 1
+''')
+        self.assertEqual(self.assigner.slots_by_backend, {
+            'nginx_10000': {('2.2.2.2', 1025): 1,
+                            ('1.1.1.1', 1024): 2,
+                            ('3.3.3.3', 1026): 3}})
+        self.assertEqual(self.assigner.assign('nginx_10000', self.servers, 4),
+                         [None, 1, 0, 2])
+
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {'apps': [
+            {'id': '/app-%d' % i, 'cmd': None, 'labels': {'name': u'\xe9' * i},
+             'tasks': [{'id': 'task-%d' % i, 'ports': [None, i]}]}
+            for i in range(20)]}
+        self.body = json.dumps(self.data).encode('utf-8')
+
+    def _chunks(self, size):
+        return [self.body[i:i + size] for i in range(0, len(self.body), size)]
+
+    def test_chunk_boundaries(self):
+        expected = cleanup_json(self.data)['apps']
+        for size in [1, 2, 7, 100, len(self.body)]:
+            apps = utils.iter_json_array(self._chunks(size), 'apps',
+                                         utils.drop_null_values)
+            self.assertEqual(list(apps), expected)
+
+    def test_yields_before_the_end_of_the_document(self):
+        chunks = iter(self._chunks(50))
+        apps = utils.iter_json_array(chunks, 'apps')
+        self.assertEqual(next(apps)['id'], '/app-0')
+        self.assertTrue(len(list(chunks)) > 0)
+
+    def test_other_keys_first(self):
+        apps = utils.iter_json_array([b'{"x": 1, "apps": [{"id": 1}]}'],
+                                     'apps')
+        self.assertEqual(list(apps), [{'id': 1}])
+
+    def test_empty_array(self):
+        self.assertEqual(
+            list(utils.iter_json_array([b'{"apps"', b': [ ]}'], 'apps')), [])
+
+    def test_truncated_document(self):
+        with self.assertRaises(ValueError):
+            list(utils.iter_json_array(self._chunks(50)[:-2], 'apps'))
+
+
 def _get_app(idx=1, num_ports=3, num_tasks=1, ip_per_task=True,
              inc_service_ports=False):
     app = {
@@ -470,6 +590,78 @@ def _get_app(idx=1, num_ports=3, num_tasks=1, ip_per_task=True,
     return app
 
 
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = utils.Histogram([0.1, 1, 10])
+        for value in [0.05, 0.1, 0.5, 20, 30]:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 0, 2])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(str(histogram),
+                         '<=0.1: 2, <=1: 1, <=10: 0, >10: 2')
+
+
+class TestHaproxyMap(unittest.TestCase):
+
+    def test_duplicates_are_added_once(self):
+        haproxy_map = utils.HaproxyMap()
+        haproxy_map.add('b.example.com', 'nginx_10001')
+        haproxy_map.add('a.example.com', 'nginx_10000')
+        haproxy_map.add('b.example.com', 'nginx_10001')
+        haproxy_map.add('b.example.com', 'nginx_10002')
+        self.assertEqual(len(haproxy_map), 3)
+        self.assertEqual(haproxy_map.render(),
+                         'b.example.com nginx_10001\n'
+                         'a.example.com nginx_10000\n'
+                         'b.example.com nginx_10002\n')
+        self.assertEqual(utils.HaproxyMap().render(), '')
+
+
+class TestEventStreamParser(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = (
+            u': keep-alive comment\r\n'
+            u'event: status_update_event\r\n'
+            u'data: {"eventType": "status_update_event", "appId": "/\xe9"}'
+            u'\r\n\r\n'
+            u'event: api_post_event\n'
+            u'data:{"eventType": "api_post_event"}\n'
+            u'data: {"eventType": "second"}\n\n'
+            u'data: {"eventType": "crlf"}\r\n'
+            u'data: \r\n'
+        ).encode('utf-8')
+        self.expected = [
+            u'{"eventType": "status_update_event", "appId": "/\xe9"}',
+            u'{"eventType": "api_post_event"}',
+            u'{"eventType": "second"}',
+            u'{"eventType": "crlf"}',
+            u'']
+
+    def _parse(self, size):
+        parser = utils.EventStreamParser()
+        payloads = []
+        for i in range(0, len(self.stream), size):
+            parser.feed(self.stream[i:i + size])
+            payloads.extend(parser.pop_payloads())
+        return payloads
+
+    def test_chunk_boundaries(self):
+        for size in [1, 2, 3, 7, 64, len(self.stream)]:
+            self.assertEqual(self._parse(size), self.expected)
+
+    def test_incomplete_line_is_kept(self):
+        parser = utils.EventStreamParser()
+        parser.feed(b'data: {"a": 1}\r\ndata: {"b"')
+        self.assertEqual(parser.pop_payloads(), [u'{"a": 1}'])
+        parser.feed(b': 2}\r')
+        self.assertEqual(parser.pop_payloads(), [])
+        parser.feed(b'\n')
+        self.assertEqual(parser.pop_payloads(), [u'{"b": 2}'])
+        self.assertEqual(parser.pop_payloads(), [])
+
+
 def _get_task(idx):
     return {
         "id": "task-%d" % idx,
@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 
+import bisect
+import codecs
 import hashlib
-from io import BytesIO
+import json
 import logging
+import re
 import socket
+from collections import OrderedDict
 
 import pycurl
 
 from common import DCOSAuth
+from config_diff import parse_config
 from lrucache import LRUCache
 
 logger = logging.getLogger('utils')
@@ -15,6 +20,25 @@ logger = logging.getLogger('utils')
 # The maximum number of clashes to allow when assigning a port.
 MAX_CLASHES = 50
 
+# Server slots are named slot1, slot2, ... and unused slots point to 0.0.0.0.
+SLOT_NAME_PATTERN = re.compile(r'^slot(\d+)$')
+UNUSED_SLOT_IP = '0.0.0.0'
+
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+# The fields of apps and tasks which marathon-lb uses. Marathon can't leave
+# out the others, so they are dropped once an app has been decoded.
+APP_FIELDS = frozenset([
+    'id', 'version', 'versionInfo', 'labels', 'instances', 'ports',
+    'portDefinitions', 'ipAddress', 'networks', 'container', 'healthChecks',
+    'tasks'])
+CONTAINER_FIELDS = frozenset(['type', 'docker', 'portMappings'])
+DOCKER_FIELDS = frozenset(['network', 'portMappings'])
+TASK_FIELDS = frozenset([
+    'id', 'appId', 'host', 'ports', 'ipAddresses', 'state',
+    'healthCheckResults', 'slaveId', 'version'])
+
 
 class ServicePortAssigner(object):
     """
@@ -39,7 +63,9 @@ class ServicePortAssigner(object):
     using the application name to generate service port (while preventing
     clashes when the port is already claimed by another app).  The assigner
     provides a deterministic set of ports for a given ordered set of port
-    requests.
+    requests.  An app keeps its ports until retain() is called without the
+    app having asked for them, so ports don't move when other apps come and
+    go.
     """
     def __init__(self):
         self.min_port = None
@@ -48,6 +74,9 @@ class ServicePortAssigner(object):
         self.can_assign = False
         self.next_port = None
         self.ports_by_app = {}
+        # A byte per port of the range, set if the port is assigned
+        self.used_ports = bytearray()
+        self.__used = set()
 
     def _assign_new_service_port(self, app, task_port):
         assert self.can_assign
@@ -58,33 +87,35 @@ class ServicePortAssigner(object):
 
         # We don't want to be searching forever, so limit the number of times
         # we clash to the number of remaining ports.
-        ports = self.ports_by_app.values()
-        port = None
+        offset = None
         for i in range(MAX_CLASHES):
             hash_str = "%s-%s-%s" % (app['id'], task_port, i)
             hash_val = hashlib.sha1(hash_str.encode("utf-8")).hexdigest()
             hash_int = int(hash_val[:8], 16)
-            trial_port = self.min_port + (hash_int % self.max_ports)
-            if trial_port not in ports:
-                port = trial_port
+            trial_offset = hash_int % self.max_ports
+            if not self.used_ports[trial_offset]:
+                offset = trial_offset
                 break
-        if port is None:
-            for port in range(self.min_port, self.max_port + 1):
-                if port not in ports:
-                    break
+        if offset is None:
+            offset = self.used_ports.find(0)
 
         # We must have assigned a unique port by now since we know there were
         # some available.
-        assert port and port not in ports, port
+        assert offset >= 0 and not self.used_ports[offset], offset
 
+        self.used_ports[offset] = 1
+        port = self.min_port + offset
         logger.debug("Assigned new port: %d", port)
         return port
 
     def _get_service_port(self, app, task_port):
         key = (app['id'], task_port)
-        port = (self.ports_by_app.get(key) or
-                self._assign_new_service_port(app, task_port))
-        self.ports_by_app[key] = port
+        self.__used.add(key)
+        port = self.ports_by_app.get(key)
+        if port is None:
+            port = self._assign_new_service_port(app, task_port)
+            if port is not None:
+                self.ports_by_app[key] = port
         return port
 
     def set_ports(self, min_port, max_port):
@@ -100,12 +131,25 @@ class ServicePortAssigner(object):
         self.max_port = max_port
         self.max_ports = max_port - min_port + 1
         self.can_assign = self.min_port and self.max_port
+        self.used_ports = bytearray(self.max_ports)
 
     def reset(self):
         """
         Reset the assigner so that ports are newly assigned.
         """
         self.ports_by_app = {}
+        self.used_ports = bytearray(self.max_ports or 0)
+        self.__used = set()
+
+    def retain(self):
+        """
+        Release the ports of the apps which didn't ask for them since the
+        previous call, i.e. of the apps which no longer exist.
+        """
+        for key in set(self.ports_by_app) - self.__used:
+            port = self.ports_by_app.pop(key)
+            self.used_ports[port - self.min_port] = 0
+        self.__used = set()
 
     def get_service_ports(self, app):
         """
@@ -145,10 +189,157 @@ class ServicePortAssigner(object):
         return ports
 
 
+class ServerSlotAssigner(object):
+    """
+    Helper class to assign backend servers to a pool of server slots.
+
+    Adding or removing a `server` line requires HAProxy to be reloaded, but
+    the address and state of an existing server can be changed through the
+    runtime API.  When server slots are enabled, each backend is emitted with
+    a pool of server lines named slot1, slot2, ... whose size is the next
+    power of two which fits both the requested number of slots and the
+    current number of servers.  Unused slots are disabled and point to
+    0.0.0.0, so scaling an app within its pool only changes addresses and
+    states.
+
+    A server keeps its slot for as long as it is part of the backend.  The
+    assignments are seeded from the running HAProxy config on startup, so
+    they survive restarts of marathon-lb.
+    """
+    def __init__(self):
+        self.default_slots = 0
+        self.slots_by_backend = {}
+
+    def set_default_slots(self, slots):
+        """
+        Set the number of slots for apps which don't set one by label.
+        :param slots: The number of slots, 0 disables server slots.
+        """
+        self.default_slots = slots
+
+    def reset(self):
+        """
+        Reset the assigner so that slots are newly assigned.
+        """
+        self.slots_by_backend = {}
+
+    def load(self, config):
+        """
+        Seed the slot assignments from an existing HAProxy config.
+        :param config: The text of the config.
+        """
+        for section in parse_config(config).values():
+            for server in section.servers.values():
+                match = SLOT_NAME_PATTERN.match(server.name)
+                if not match or server.ip == UNUSED_SLOT_IP:
+                    continue
+                self.slots_by_backend.setdefault(server.backend, {})[
+                    (server.ip, server.port)] = int(match.group(1)) - 1
+
+    def retain(self, backends):
+        """
+        Forget the assignments of backends which no longer exist.
+        :param backends: The names of the backends to keep.
+        """
+        backends = set(backends)
+        for backend in list(self.slots_by_backend):
+            if backend not in backends:
+                del self.slots_by_backend[backend]
+
+    def assign(self, backend, servers, slots=None):
+        """
+        Assign the servers of a backend to slots.
+        :param backend: The name of the backend.
+        :param servers: The (ip, port) of each server, in a stable order.
+        :param slots: The number of slots requested for the backend, or None
+        to use the default.
+        :return: A list with an entry per slot, holding the index of the
+        server assigned to the slot or None for unused slots.  None if server
+        slots are disabled for the backend.
+        """
+        if slots is None:
+            slots = self.default_slots
+        if slots <= 0:
+            self.slots_by_backend.pop(backend, None)
+            return None
+
+        size = 1
+        while size < max(slots, len(servers)):
+            size *= 2
+
+        previous = self.slots_by_backend.get(backend, {})
+        pool = [None] * size
+        unassigned = []
+        for idx, server in enumerate(servers):
+            slot = previous.get(server)
+            if slot is not None and slot < size and pool[slot] is None:
+                pool[slot] = idx
+            else:
+                unassigned.append(idx)
+
+        free_slots = (slot for slot, idx in enumerate(pool) if idx is None)
+        for idx, slot in zip(unassigned, free_slots):
+            pool[slot] = idx
+
+        self.slots_by_backend[backend] = {
+            servers[idx]: slot for slot, idx in enumerate(pool)
+            if idx is not None}
+        return pool
+
+
+class EventStreamParser(object):
+    """
+    Incremental parser of a text/event-stream, which collects the payload of
+    each `data:` line.
+
+    The received bytes are appended to a single buffer which is only
+    scanned once, and the consumed lines are dropped from it once per fed
+    chunk, so that large events spread over many chunks aren't copied over
+    and over again. Lines other than `data:` lines are skipped without being
+    copied. Lines end with LF or CRLF (Marathon doesn't end lines with a lone
+    CR, which event streams also allow).
+    """
+
+    def __init__(self):
+        self.__buffer = bytearray()
+        # Offset in the buffer up to which there's no line feed
+        self.__scanned = 0
+        self.__payloads = []
+
+    def feed(self, data):
+        buffer = self.__buffer
+        buffer += data
+        end = buffer.find(b'\n', self.__scanned)
+        if end < 0:
+            self.__scanned = len(buffer)
+            return
+        start = 0
+        with memoryview(buffer) as view:
+            while end >= 0:
+                if buffer.startswith(b'data:', start):
+                    begin = start + 5
+                    stop = end
+                    if buffer[stop - 1] == 0x0d and stop > begin:
+                        stop -= 1
+                    if begin < stop and buffer[begin] == 0x20:
+                        begin += 1
+                    self.__payloads.append(str(view[begin:stop], 'utf-8'))
+                start = end + 1
+                end = buffer.find(b'\n', start)
+        del buffer[:start]
+        self.__scanned = len(buffer)
+
+    def pop_payloads(self):
+        payloads = self.__payloads
+        self.__payloads = []
+        return payloads
+
+
 class CurlHttpEventStream(object):
     def __init__(self, url, auth, verify):
         self.url = url
-        self.received_buffer = BytesIO()
+        self.received_bytes = 0
+        self.parser = EventStreamParser()
 
         headers = ['Cache-Control: no-cache', 'Accept: text/event-stream']
 
@@ -156,7 +347,7 @@ class CurlHttpEventStream(object):
         self.curl.setopt(pycurl.URL, url)
         self.curl.setopt(pycurl.ENCODING, 'gzip')
         self.curl.setopt(pycurl.CONNECTTIMEOUT, 10)
-        self.curl.setopt(pycurl.WRITEDATA, self.received_buffer)
+        self.curl.setopt(pycurl.WRITEFUNCTION, self._write)
 
         # Marathon >= 1.7.x returns 30x responses for /v2/events responses
         # when they're coming from a non-leader. So we follow redirects.
@@ -195,14 +386,9 @@ class CurlHttpEventStream(object):
 
     SELECT_TIMEOUT = 10
 
-    def _any_data_received(self):
-        return self.received_buffer.tell() != 0
-
-    def _get_received_data(self):
-        result = self.received_buffer.getvalue()
-        self.received_buffer.truncate(0)
-        self.received_buffer.seek(0)
-        return result
+    def _write(self, data):
+        self.received_bytes += len(data)
+        self.parser.feed(data)
 
     def _check_status_code(self):
         if self.status_code == 0:
@@ -217,12 +403,16 @@ class CurlHttpEventStream(object):
                 break
         return num_handles
 
-    def _iter_chunks(self):
+    def iter_data(self):
+        """
+        Iterate over the payloads of the `data:` lines of the stream.
+        """
         while True:
             remaining = self._perform_on_curl()
-            if self._any_data_received():
+            if self.received_bytes:
                 self._check_status_code()
-                yield self._get_received_data()
+                for payload in self.parser.pop_payloads():
+                    yield payload
             if remaining == 0:
                 break
             self.curlmulti.select(self.SELECT_TIMEOUT)
@@ -234,31 +424,177 @@ class CurlHttpEventStream(object):
         for f in self.curlmulti.info_read()[2]:
             raise pycurl.error(*f[1:])
 
-    def iter_lines(self):
-        chunks = self._iter_chunks()
-        return self._split_lines_from_chunks(chunks)
 
-    @staticmethod
-    def _split_lines_from_chunks(chunks):
-        # same behaviour as requests' Response.iter_lines(...)
+def drop_null_values(obj):
+    """
+    JSON object hook dropping the keys whose value is null, which is what
+    common.cleanup_json does to each object of an already decoded document.
+    """
+    return {k: v for k, v in obj.items() if v is not None}
 
-        pending = None
-        for chunk in chunks:
 
-            if pending is not None:
-                chunk = pending + chunk
-            lines = chunk.splitlines()
+def _project(obj, fields):
+    return {k: v for k, v in obj.items() if k in fields}
 
-            if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
-                pending = lines.pop()
-            else:
-                pending = None
 
-            for line in lines:
-                yield line
+def compact_app(app):
+    """
+    Drop the fields of an app (and of its container and tasks) which
+    marathon-lb doesn't use.
+    """
+    app = _project(app, APP_FIELDS)
+    if 'container' in app:
+        app['container'] = _project(app['container'], CONTAINER_FIELDS)
+        if 'docker' in app['container']:
+            app['container']['docker'] = \
+                _project(app['container']['docker'], DOCKER_FIELDS)
+    if 'tasks' in app:
+        app['tasks'] = [_project(task, TASK_FIELDS) for task in app['tasks']]
+    return app
+
+
+def iter_json_array(chunks, key, object_hook=None):
+    """
+    Incrementally decode the array `key` of the top level JSON object which
+    is read from `chunks` (bytes), and yield its elements one at a time, so
+    that neither the whole document nor all of its decoded elements have to
+    be held in memory at once.
+
+    Documents which don't start with that array are decoded in one go.
+    """
+    decoder = json.JSONDecoder(object_hook=object_hook)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    prefix = re.compile(r'\s*\{\s*"%s"\s*:\s*\[' % re.escape(key))
+    chunks = iter(chunks)
+
+    buf = ''
+    eof = False
+    while '[' not in buf and not eof:
+        chunk = next(chunks, None)
+        eof = chunk is None
+        buf += text_decoder.decode(chunk or b'', final=eof)
+    match = prefix.match(buf)
+    if not match:
+        buf += ''.join(text_decoder.decode(chunk) for chunk in chunks)
+        buf += text_decoder.decode(b'', final=True)
+        for element in decoder.decode(buf)[key]:
+            yield element
+        return
+
+    pos = match.end()
+    pending_needed = 0
+    while True:
+        pos = JSON_SEPARATORS.match(buf, pos).end()
+        if pos < len(buf):
+            if buf[pos] == ']':
+                return
+            if len(buf) - pos >= pending_needed or eof:
+                try:
+                    element, pos = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    # The element isn't complete yet. Only retry once the
+                    # pending text doubled, so that decoding large elements
+                    # stays linear.
+                    pending_needed = 2 * (len(buf) - pos)
+                else:
+                    pending_needed = 0
+                    yield element
+                    continue
+        elif eof:
+            raise ValueError("unterminated JSON array %r" % key)
+
+        chunk = next(chunks, None)
+        eof = chunk is None
+        buf = buf[pos:] + text_decoder.decode(chunk or b'', final=eof)
+        pos = 0
+
+
+class FragmentCache(object):
+    """
+    Rendered pieces of the config by name, along with a key of the inputs
+    they were rendered from. The fragments which weren't looked up since the
+    previous call to retain() are dropped by it.
+    """
+
+    def __init__(self):
+        self.fragments = {}
+        self.hits = 0
+        self.misses = 0
+        self.__used = set()
+
+    def reset(self):
+        self.fragments = {}
+        self.__used = set()
+
+    def get(self, name, key):
+        self.__used.add(name)
+        entry = self.fragments.get(name)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def set(self, name, key, fragment):
+        self.__used.add(name)
+        self.fragments[name] = (key, fragment)
+
+    def retain(self):
+        for name in set(self.fragments) - self.__used:
+            del self.fragments[name]
+        self.__used = set()
+        self.hits = 0
+        self.misses = 0
+
+
+class HaproxyMap(object):
+    """
+    The entries of a haproxy map file, in the order they were first added.
+    Adding an entry which is already in the map does nothing.
+    """
+
+    def __init__(self):
+        self.__entries = OrderedDict()
+
+    def add(self, key, value):
+        self.__entries.setdefault((key, value), None)
+
+    def items(self):
+        return list(self.__entries)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def render(self):
+        return ''.join('{0} {1}\n'.format(key, value)
+                       for key, value in self.__entries)
+
+
+class Histogram(object):
+    """
+    Counts of observed values in buckets, given by the increasing upper
+    bounds of the buckets. Values above the last bound are counted in an
+    extra bucket.
+    """
 
-        if pending is not None:
-            yield pending
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def __str__(self):
+        labels = ['<={0}'.format(bound) for bound in self.bounds]
+        labels.append('>{0}'.format(self.bounds[-1]))
+        return ', '.join('{0}: {1}'.format(label, count)
+                         for label, count in zip(labels, self.counts))
 
 
 def resolve_ip(host):